@@ -0,0 +1,60 @@
+"""
+Shared fixtures: an in-process mock of the Unit4 /documents API and a runner
+for unit4_audit.main() configured through UNIT4_* variables
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import unit4_audit  # noqa: E402
+from unit4_mock_server import MockUnit4Server  # noqa: E402
+
+
+@pytest.fixture
+def mock_api():
+    """
+    Starts MockUnit4Server with the given options; stopped after the test
+    """
+    servers = []
+
+    def start(**options) -> MockUnit4Server:
+        server = MockUnit4Server({"docs": 20, "doc_size": 2000, "latency_ms": 0, "jitter_ms": 0, **options}).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def run_audit(monkeypatch, tmp_path):
+    """
+    Runs unit4_audit.main(argv) against `server` with output under tmp_path/art
+    and any extra UNIT4_* settings; returns the exit code
+    """
+    for key in list(os.environ):
+        if key.startswith("UNIT4_"):
+            monkeypatch.delenv(key)
+    out_dir = tmp_path / "art"
+
+    def run(server: MockUnit4Server, *argv: str, **env: str) -> int:
+        values = {
+            "UNIT4_BASE": server.url.rsplit("/documents", 1)[0],
+            "UNIT4_USER": "x",
+            "UNIT4_PASS": "x",
+            "UNIT4_OUT_DIR": str(out_dir),
+            "UNIT4_MIN_INTERVAL": "0",
+            **env,
+        }
+        for key, value in values.items():
+            monkeypatch.setenv(key, value)
+        return unit4_audit.main(list(argv))
+
+    run.out_dir = out_dir
+    return run
@@ -0,0 +1,67 @@
+"""
+By-name layout (docs/<docType>_docs/<fileName>): documents sharing a
+fileName and trees written before the manifest existed
+"""
+
+import json
+import shutil
+
+
+def stored_files(out_dir):
+    return sorted(p for p in (out_dir / "docs").rglob("*") if p.is_file() and p.name != "manifest.jsonl")
+
+
+def test_shared_file_names_with_workers_keep_every_document(mock_api, run_audit):
+    server = mock_api(name_pool=10)
+    assert run_audit(server, UNIT4_DOWNLOAD_WORKERS="4") == 0
+
+    files = stored_files(run_audit.out_dir)
+    assert len(files) == 40
+    assert sum("__" in p.name for p in files) == 20
+    assert run_audit(server, "--verify") == 0
+
+
+def legacy_tree(server, run_audit):
+    """
+    Runs once, then keeps only the files, as a run from before the
+    manifest / journal left them
+    """
+    assert run_audit(server) == 0
+    for name in ("checkpoints", "items", "json", "csv", "metrics", "summaries"):
+        shutil.rmtree(run_audit.out_dir / name, ignore_errors=True)
+    (run_audit.out_dir / "docs" / "manifest.jsonl").unlink()
+    return stored_files(run_audit.out_dir)
+
+
+def shard_metrics(out_dir, key):
+    return sum(json.loads(p.read_text()).get(key, 0) for p in (out_dir / "metrics").glob("*_docs_metrics.json"))
+
+
+def test_tree_without_manifest_is_replaced_in_place(mock_api, run_audit):
+    server = mock_api()
+    legacy = legacy_tree(server, run_audit)
+    damaged = next(p for p in legacy if p.suffix == ".pdf")
+    damaged.write_bytes(b"<html>error page</html>")
+
+    assert run_audit(server) == 0
+
+    assert stored_files(run_audit.out_dir) == legacy
+    assert damaged.read_bytes().startswith(b"%PDF-")
+    assert run_audit(server, "--verify") == 0
+
+
+def test_upgrade_over_existing_tree_adopts_files_without_refetching(mock_api, run_audit):
+    server = mock_api()
+    legacy = legacy_tree(server, run_audit)
+    contents = {p: p.read_bytes() for p in legacy}
+
+    assert run_audit(server) == 0
+
+    assert stored_files(run_audit.out_dir) == legacy
+    assert {p: p.read_bytes() for p in legacy} == contents
+    assert shard_metrics(run_audit.out_dir, "files_adopted") == 40
+    assert shard_metrics(run_audit.out_dir, "files_downloaded") == 0
+    # Adopted documents are current from now on
+    assert run_audit(server) == 0
+    assert shard_metrics(run_audit.out_dir, "files_skipped") == 40
+    assert run_audit(server, "--verify") == 0
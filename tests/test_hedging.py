@@ -0,0 +1,24 @@
+"""
+Hedged downloads: every backup request is counted like the primary, so the
+hedge share is measured against the requests the server actually received
+"""
+
+import json
+
+
+def test_hedged_backups_are_counted_as_requests(mock_api, run_audit):
+    # seed 4 puts the slow responses after the latency warmup, where a p95 hedge can fire
+    server = mock_api(docs=150, latency_ms=5, rate_slow=0.03, slow_ms=300, seed=4)
+
+    assert run_audit(server, UNIT4_HEDGE="true", UNIT4_DOC_TYPES="REPINV") == 0
+
+    metrics = [json.loads(p.read_text()) for p in (run_audit.out_dir / "metrics").glob("*_metrics.json")]
+    requests_total = sum(m["requests_total"] for m in metrics)
+    status_total = sum(
+        count for m in metrics for statuses in m["status_counts"].values() for count in statuses.values()
+    )
+    hedged = sum(m.get("hedged_requests", 0) for m in metrics)
+
+    assert hedged > 0
+    assert requests_total == status_total == server.stats["requests"]
+    assert hedged <= 0.05 * requests_total
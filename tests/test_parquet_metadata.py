@@ -0,0 +1,23 @@
+"""
+Parquet metadata: size and sha256 are filled in on the run that downloads
+the documents, not only on the next one
+"""
+
+import hashlib
+
+import pytest
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+
+def test_first_run_parquet_has_size_and_sha256(mock_api, run_audit):
+    server = mock_api()
+
+    assert run_audit(server, UNIT4_PARQUET="true", UNIT4_DOC_TYPES="REPINV") == 0
+
+    table = pq.read_table(run_audit.out_dir / "parquet" / "repinv_docs_metadata.parquet").to_pylist()
+    assert len(table) == 20
+    for row in table:
+        blob = (run_audit.out_dir / "docs" / "repinv_docs" / row["fileName"]).read_bytes()
+        assert row["size"] == len(blob)
+        assert row["sha256"] == hashlib.sha256(blob).hexdigest()
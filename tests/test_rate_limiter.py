@@ -0,0 +1,55 @@
+"""
+AdaptiveRateLimiter: bounded slowdowns, time-based recovery and resume clamp
+"""
+
+import threading
+import time
+
+import unit4_audit
+
+
+def test_concurrent_429_burst_slows_down_once():
+    limiter = unit4_audit.AdaptiveRateLimiter(0.25, floor_sec=0.25, ceiling_sec=5.0)
+    barrier = threading.Barrier(8)
+
+    def hit() -> None:
+        barrier.wait()
+        limiter.observe(429)
+
+    threads = [threading.Thread(target=hit) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert limiter.min_interval_sec == 0.5
+    assert limiter.slowdowns == 1
+
+
+def test_separate_bursts_each_slow_down():
+    limiter = unit4_audit.AdaptiveRateLimiter(0.01, floor_sec=0.01, ceiling_sec=5.0)
+    limiter.observe(429)
+    time.sleep(0.05)
+    limiter.observe(503)
+    assert limiter.slowdowns == 2
+    assert abs(limiter.min_interval_sec - 0.03) < 1e-9
+
+
+def test_recovery_is_bounded_by_time_not_request_count():
+    limiter = unit4_audit.AdaptiveRateLimiter(5.0, floor_sec=0.25, ceiling_sec=5.0, recovery_sec=0.01)
+    deadline = time.monotonic() + 1.0
+    while limiter.min_interval_sec > 0.26 and time.monotonic() < deadline:
+        limiter.observe(200, 20)
+        time.sleep(0.011)
+    assert limiter.min_interval_sec <= 0.26
+    assert limiter.speedups < 20
+
+
+def test_reloaded_interval_is_clamped(tmp_path):
+    path = tmp_path / "rate_limiter_prod.json"
+    throttled = unit4_audit.AdaptiveRateLimiter(5.0, floor_sec=0.25, ceiling_sec=5.0)
+    throttled.state_path = path
+    throttled.persist()
+
+    resumed = unit4_audit.AdaptiveRateLimiter.load(path, 0.25, 0.25, ceiling_sec=5.0)
+    assert resumed.min_interval_sec == 1.0
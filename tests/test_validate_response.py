@@ -0,0 +1,55 @@
+"""
+validate_response on rejected responses: the body preview stays within the
+byte budget and the streamed response is closed
+"""
+
+import io
+
+import requests
+
+import unit4_audit
+
+
+class TrackedBody(io.BytesIO):
+    def __init__(self, data: bytes):
+        super().__init__(data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        chunk = super().read(size)
+        self.bytes_read += len(chunk)
+        return chunk
+
+
+def rejected_response(status: int, body: bytes) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status
+    response.raw = TrackedBody(body)
+    response.encoding = "utf-8"
+    return response
+
+
+def test_rejected_response_is_previewed_within_budget_and_closed():
+    response = rejected_response(404, b"x" * (4 * 1024 * 1024))
+    budget = unit4_audit.MemoryBudget()
+    metrics = {}
+
+    assert unit4_audit.validate_response(response, budget, metrics) is False
+
+    assert response.raw.closed
+    assert response.raw.bytes_read <= 500
+    assert budget.received == metrics["bytes_received"] == response.raw.bytes_read
+
+
+def test_auth_failure_is_closed_without_budget():
+    response = rejected_response(401, b"denied")
+
+    assert unit4_audit.validate_response(response) is False
+    assert response.raw.closed
+
+
+def test_accepted_response_is_left_open():
+    response = rejected_response(200, b"{}")
+
+    assert unit4_audit.validate_response(response) is True
+    assert not response.raw.closed
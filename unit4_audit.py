@@ -2,19 +2,59 @@
 
 import os
 import sys
+import argparse
+import contextlib
+import cProfile
+import random
+import tracemalloc
 import time
 import json
 import base64
 import re
 import hashlib
+import gzip
+import lzma
 import csv
+import io
+import mmap
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import multiprocessing
+import zipfile
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+import queue
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 from pathlib import Path
-from typing import Any, Optional
+from bisect import bisect_left
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from dotenv import load_dotenv
 
+try:  # optional: only needed for the Parquet metadata sink (UNIT4_PARQUET)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+try:  # optional: only needed to extract PDF text (UNIT4_EXTRACT_TEXT)
+    import pypdf
+except ImportError:
+    pypdf = None
+
+try:  # POSIX only: cross-process rate budget for sharded runs
+    import fcntl
+except ImportError:
+    fcntl = None
+
 
 load_dotenv()
 
@@ -22,43 +62,291 @@ load_dotenv()
 # -----------------------------
 # RATE LIMITING & METRICS
 # -----------------------------
+_METRICS_LOCK = threading.RLock()
+
+
+class SharedRateBudget:
+    """
+    Cross-process side of RateLimiter for sharded runs: the next free slot
+    and any pause live in a small file under an exclusive flock, so every
+    shard process draws from one request budget. Times are time.monotonic(),
+    which is system-wide on Linux and macOS
+    """
+
+    _FORMAT = "dd"
+
+    def __init__(self, path: Path, reset: bool = False) -> None:
+        if fcntl is None:
+            raise RuntimeError("a cross-process rate budget needs fcntl (POSIX)")
+        self.path = path
+        with open(path, "wb" if reset else "ab"):
+            pass
+
+    def _update(self, change: Callable[[float, float], tuple[Any, float, float]]) -> Any:
+        size = struct.calcsize(self._FORMAT)
+        with open(self.path, "r+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                raw = f.read(size)
+                next_ts, paused_until = struct.unpack(self._FORMAT, raw) if len(raw) == size else (0.0, 0.0)
+                result, next_ts, paused_until = change(next_ts, paused_until)
+                f.seek(0)
+                f.write(struct.pack(self._FORMAT, next_ts, paused_until))
+                f.truncate()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return result
+
+    def reserve(self, interval: float, burst: int) -> tuple[float, float]:
+        """
+        Claims the next slot; returns (now, slot) like RateLimiter.wait computes them
+        """
+        def take(next_ts: float, paused_until: float) -> tuple[Any, float, float]:
+            now = time.monotonic()
+            slot = max(now, paused_until, next_ts - (burst - 1) * interval)
+            return (now, slot), max(next_ts, slot) + interval, paused_until
+
+        return self._update(take)
+
+    def pause(self, seconds: float) -> None:
+        until = time.monotonic() + seconds
+        self._update(lambda next_ts, paused_until: (None, next_ts, max(paused_until, until)))
+
+
 class RateLimiter:
-    def __init__(self, min_interval_sec: float = 0.25) -> None:
+    """
+    Thread-safe token bucket shared by every worker of a run.
+    Refills one token every `min_interval_sec`, holding up to `burst` tokens,
+    so the global request rate holds no matter how many threads call wait().
+    With `shared`, slots and pauses come from a SharedRateBudget so the rate
+    also holds across the processes of a sharded run.
+    """
+
+    def __init__(self, min_interval_sec: float = 0.25, burst: int = 1, shared: SharedRateBudget | None = None) -> None:
         self.min_interval_sec = min_interval_sec
-        self._last_ts = 0.0
+        self.burst = max(1, burst)
+        self.shared = shared
+        self._next_ts = 0.0
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """
+        Blocks every caller of wait() for `seconds` (429 / 5xx / circuit-breaker)
+        """
+        if self.shared is not None:
+            self.shared.pause(seconds)
+            return
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
 
     def wait(self, metrics: dict | None = None) -> None:
-        now = time.time()
-        elapsed = now - self._last_ts
-        if elapsed < self.min_interval_sec:
-            sleep_sec = self.min_interval_sec - elapsed
-            sleep_with_metrics(sleep_sec, metrics)
-        self._last_ts = time.time()
+        interval = max(self.min_interval_sec, 0.0)
+        if self.shared is not None:
+            now, slot = self.shared.reserve(interval, self.burst)
+        else:
+            with self._lock:
+                now = time.monotonic()
+                slot = max(now, self._paused_until, self._next_ts - (self.burst - 1) * interval)
+                self._next_ts = max(self._next_ts, slot) + interval
+        sleep_with_metrics(slot - now, metrics)
+
+    def observe(self, status_code: int | None, latency_ms: int | None = None) -> None:
+        """
+        Server feedback hook (status, or None on timeout); fixed-rate limiter ignores it
+        """
+
+    def snapshot(self) -> dict:
+        return {"rate_interval_sec": self.min_interval_sec}
+
+    def persist(self) -> None:
+        """
+        Saves learned state, if any; fixed-rate limiter has none
+        """
+
+
+# Hard ceilings on request rate, as the minimum interval allowed per environment
+ENV_MIN_INTERVAL_FLOOR = {
+    "PROD": 0.25,
+    "CIPTEST": 0.1,
+}
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """
+    RateLimiter whose interval follows server feedback: doubles on 429,
+    grows 1.5x on 5xx / timeouts and 1.25x when latency (EWMA) climbs past
+    `latency_factor` times its healthy baseline. One burst is one slowdown:
+    feedback landing within an interval (or a round trip) of the previous
+    slowdown, e.g. the other workers' 429s from the same burst, is ignored.
+    After `recovery_sec` without a slowdown, healthy responses halve the
+    excess over `floor_sec` (the per environment ceiling on rate) once per
+    `recovery_sec`, so recovering from `ceiling_sec` takes seconds of clean
+    traffic, not thousands of requests
+    """
+
+    def __init__(
+        self,
+        min_interval_sec: float = 0.25,
+        floor_sec: float = 0.25,
+        ceiling_sec: float = 5.0,
+        burst: int = 1,
+        recovery_sec: float = 10.0,
+        latency_factor: float = 2.0,
+        shared: SharedRateBudget | None = None
+    ) -> None:
+        super().__init__(min(ceiling_sec, max(floor_sec, min_interval_sec)), burst, shared)
+        self.floor_sec = floor_sec
+        self.ceiling_sec = ceiling_sec
+        self.recovery_sec = recovery_sec
+        self.latency_factor = latency_factor
+        self._latency_ewma: float | None = None
+        self._latency_baseline: float | None = None
+        self._slowed_at = float("-inf")
+        self._changed_at = time.monotonic()
+        self.slowdowns = 0
+        self.speedups = 0
+        self.state_path: Path | None = None
+
+    def _slow_down(self, factor: float) -> None:
+        now = time.monotonic()
+        window = max(self.min_interval_sec, (self._latency_ewma or 0.0) / 1000)
+        if now - self._slowed_at < window:
+            return
+        self.min_interval_sec = min(self.ceiling_sec, max(self.floor_sec, self.min_interval_sec * factor))
+        self._slowed_at = self._changed_at = now
+        self.slowdowns += 1
+
+    def _recover(self) -> None:
+        now = time.monotonic()
+        if self.min_interval_sec <= self.floor_sec or now - self._changed_at < self.recovery_sec:
+            return
+        self.min_interval_sec = self.floor_sec + (self.min_interval_sec - self.floor_sec) / 2
+        self._changed_at = now
+        self.speedups += 1
+
+    def observe(self, status_code: int | None, latency_ms: int | None = None) -> None:
+        with self._lock:
+            if status_code == 429:
+                self._slow_down(2.0)
+                return
+            if status_code is None or status_code >= 500:
+                self._slow_down(1.5)
+                return
+            if latency_ms is not None:
+                ewma = self._latency_ewma
+                ewma = latency_ms if ewma is None else 0.8 * ewma + 0.2 * latency_ms
+                self._latency_ewma = ewma
+                if self._latency_baseline is None or ewma < self._latency_baseline:
+                    self._latency_baseline = ewma
+                if ewma > self.latency_factor * max(self._latency_baseline, 50.0):
+                    self._slow_down(1.25)
+                    self._latency_baseline = ewma / self.latency_factor
+                    return
+            self._recover()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "rate_interval_sec": round(self.min_interval_sec, 4),
+                "rate_floor_sec": self.floor_sec,
+                "rate_slowdowns": self.slowdowns,
+                "rate_speedups": self.speedups,
+            }
+
+    def persist(self) -> None:
+        if self.state_path is None:
+            return
+        save_checkpoint(self.state_path, {
+            "interval": self.min_interval_sec,
+            "floor": self.floor_sec,
+            "updatedAt": time.strftime("%Y-%m-%d %H:%M:%S"),
+        })
+
+    @classmethod
+    def load(
+        cls,
+        path: Path,
+        min_interval_sec: float,
+        floor_sec: float,
+        max_resume_factor: float = 4.0,
+        **kwargs: Any
+    ) -> "AdaptiveRateLimiter":
+        """
+        Resumes from the interval learned by a previous run (saved to `path`
+        by persist()), if any, but never slower than `max_resume_factor` x
+        the floor: a run that ended throttled does not start the next one there
+        """
+        learned = load_checkpoint(path).get("interval")
+        start = min(float(learned), max_resume_factor * max(floor_sec, min_interval_sec)) if learned else min_interval_sec
+        limiter = cls(start, floor_sec=floor_sec, **kwargs)
+        limiter.state_path = path
+        return limiter
+
+
+def incr_metric(metrics: dict | None, key: str, amount: float = 1) -> None:
+    if metrics is None:
+        return
+    with _METRICS_LOCK:
+        metrics[key] = metrics.get(key, 0) + amount
+
+
+def update_metrics(metrics: dict | None, values: dict) -> None:
+    if metrics is None:
+        return
+    with _METRICS_LOCK:
+        metrics.update(values)
 
 
 def sleep_with_metrics(seconds: float, metrics: dict | None = None) -> None:
     if seconds <= 0:
         return
     time.sleep(seconds)
-    if metrics is not None:
-        metrics["sleep_seconds"] = metrics.get("sleep_seconds", 0.0) + seconds
+    incr_metric(metrics, "sleep_seconds", seconds)
 
 
 def backoff_seconds(attempt: int, base: float = 1.5, cap: float = 30.0) -> float:
     return min(cap, base * (2 ** attempt))
 
 
-def load_jsonl_items(path: Path) -> list[dict]:
+class Unit4FetchError(RuntimeError):
+    """
+    Raised by fetch_all_documents when a page cannot be fetched
+    """
+
+
+def iter_jsonl_items(path: Path) -> Iterator[dict]:
     if not path.exists():
-        return []
-    items = []
+        return
     with open(path, "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
             if not line:
                 continue
-            items.append(json.loads(line))
-    return items
+            yield json.loads(line)
+
+
+def jsonl_envelope(path: Path, total: int) -> dict:
+    """
+    Lazy `{total, items}` envelope over a JSONL file, re-readable per stage
+    """
+    return {"total": total, "items": iter_jsonl_items(path)}
+
+
+def count_jsonl_lines(path: Path, chunk_size: int = 1024 * 1024) -> int:
+    """
+    Counts the lines of a JSONL file written by append_jsonl_items
+    without parsing them
+    """
+    if not path.exists():
+        return 0
+    lines = 0
+    last = b"\n"
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            lines += chunk.count(b"\n")
+            last = chunk[-1:]
+    return lines + (last != b"\n")
 
 
 def append_jsonl_items(path: Path, items: list[dict]) -> None:
@@ -66,8 +354,14 @@ def append_jsonl_items(path: Path, items: list[dict]) -> None:
         return
     with open(path, "a", encoding="utf-8") as f:
         for item in items:
-            f.write(json.dumps(item, ensure_ascii=False))
-            f.write("\n")
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+
+def relative_to_root(path: Path, root: Path) -> str:
+    try:
+        return path.relative_to(root).as_posix()
+    except ValueError:
+        return path.as_posix()
 
 
 def load_checkpoint(path: Path) -> dict:
@@ -80,567 +374,4340 @@ def load_checkpoint(path: Path) -> dict:
 
 
 def save_checkpoint(path: Path, data: dict) -> None:
-    path.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
+    # Shard processes may save the same file (rate_limiter_<env>.json), so
+    # each writes its own temp file and renames it into place
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.part")
+    tmp_path.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp_path, path)
 
 
 def save_metrics(path: Path, metrics: dict) -> None:
-    path.write_text(json.dumps(metrics, indent=2, ensure_ascii=False), encoding="utf-8")
+    with _METRICS_LOCK:
+        payload = json.dumps(metrics, indent=2, ensure_ascii=False)
+    # Saved periodically mid-run, so never leave a half-written file behind
+    tmp_path = path.with_name(f".{path.name}.part")
+    tmp_path.write_text(payload, encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def finish_metrics(
+    path: Path,
+    metrics: dict,
+    session: requests.Session | None = None,
+    conn_baseline: dict | None = None,
+    rate_limiter: RateLimiter | None = None,
+    telemetry: "Telemetry | None" = None
+) -> None:
+    """
+    Stamps endTime, connection reuse counters, rate limiter state and
+    latency percentiles for this docType and saves (plus the Prometheus textfile)
+    """
+    # The telemetry flush thread may be serializing `metrics` right now
+    update_metrics(metrics, {"endTime": time.strftime("%Y-%m-%d %H:%M:%S")})
+    if rate_limiter is not None:
+        update_metrics(metrics, rate_limiter.snapshot())
+        rate_limiter.persist()
+    if session is not None:
+        stats = connection_stats(session)
+        baseline = conn_baseline or {}
+        update_metrics(metrics, {key: value - baseline.get(key, 0) for key, value in stats.items()})
+    if telemetry is not None:
+        telemetry.annotate(metrics)
+    save_metrics(path, metrics)
+    if telemetry is not None:
+        if telemetry.profile:
+            table_path = path.with_name(path.name.replace("_metrics.json", "_stages.txt"))
+            table_path.write_text(telemetry.stage_table(metrics), encoding="utf-8")
+        telemetry.write_prometheus()
 
 
-def record_failure_and_maybe_break(metrics: dict | None, threshold: int = 5, cooldown_sec: int = 60) -> None:
+def record_failure_and_maybe_break(
+    metrics: dict | None,
+    threshold: int = 5,
+    cooldown_sec: int = 60,
+    rate_limiter: RateLimiter | None = None
+) -> None:
     if metrics is None:
         return
-    metrics["consecutive_failures"] = metrics.get("consecutive_failures", 0) + 1
-    if metrics["consecutive_failures"] >= threshold:
+    with _METRICS_LOCK:
+        metrics["consecutive_failures"] = metrics.get("consecutive_failures", 0) + 1
+        tripped = metrics["consecutive_failures"] >= threshold
+        if tripped:
+            metrics["consecutive_failures"] = 0
+    if tripped:
         print(f"[circuit-breaker] {threshold} failures, cooling down {cooldown_sec}s...")
+        if rate_limiter is not None:
+            rate_limiter.pause(cooldown_sec)
         sleep_with_metrics(cooldown_sec, metrics)
-        metrics["consecutive_failures"] = 0
 
 
 def record_success(metrics: dict | None) -> None:
     if metrics is None:
         return
-    metrics["consecutive_failures"] = 0
+    with _METRICS_LOCK:
+        metrics["consecutive_failures"] = 0
 
 
 # -----------------------------
-# HTTP
+# MEMORY BUDGET
 # -----------------------------
-def make_request(
-    url: str,
-    params: dict,
-    auth: HTTPBasicAuth,
-    timeout: int = 120
-) -> tuple[requests.Response, int]:
+class BudgetExceeded(RuntimeError):
     """
-    Executes a GET request and returns response + latency in ms
+    Raised when a response or the run goes over its MemoryBudget;
+    `reason` is "response" or "run"
     """
-    headers = {"Accept": "application/json"}
 
-    t0 = time.time()
-    response = requests.get(
-        url,
-        params=params,
-        headers=headers,
-        auth=auth,
-        timeout=timeout
-    )
-    latency_ms = int((time.time() - t0) * 1000)
-
-    return response, latency_ms
+    def __init__(self, reason: str, message: str) -> None:
+        super().__init__(message)
+        self.reason = reason
 
 
-# -----------------------------
-# VALIDATION & LOGGING
-# -----------------------------
-def validate_response(r: requests.Response) -> bool:
+def current_rss_mb() -> float:
     """
-    Validates HTTP response and prints useful debug info
+    Resident set size of this process in MB (/proc on Linux; elsewhere the
+    peak reported by getrusage)
     """
-    if r.status_code in (401, 403):
-        print("[smoke] auth failed")
-        print("WWW-Authenticate:", r.headers.get("WWW-Authenticate"))
-        print("Body:", r.text[:500])
-        return False
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
 
-    if r.status_code not in (200, 201):
-        print("[smoke] unexpected status code:", r.status_code)
-        print("Body:", r.text[:500])
-        return False
 
-    return True
+def content_length(response: requests.Response) -> int | None:
+    try:
+        return int(response.headers["Content-Length"])
+    except (KeyError, TypeError, ValueError):
+        return None
 
 
-def print_json_preview(r: requests.Response) -> dict | None:
+class MemoryBudget:
     """
-    Prints a short JSON preview and returns parsed JSON
+    Byte and RSS limits for everything read from the API, shared by all
+    threads of a run. Bodies parsed in memory are capped per response,
+    checked against Content-Length before reading and again while reading;
+    every byte received counts against the per-run cap; RSS is sampled at
+    most every `rss_sample_sec`. Trips are counted in the metrics
     """
-    ct = r.headers.get("Content-Type", "")
-    if "application/json" not in ct:
-        print("[smoke] non-json content-type:", ct)
-        return None
 
-    data = r.json()
+    def __init__(
+        self,
+        max_response_bytes: int = 256 * 1024 * 1024,
+        max_run_bytes: int | None = None,
+        max_rss_mb: float | None = None,
+        rss_sample_sec: float = 1.0
+    ) -> None:
+        self.max_response_bytes = max_response_bytes
+        self.max_run_bytes = max_run_bytes or None
+        self.max_rss_mb = max_rss_mb or None
+        self.rss_sample_sec = rss_sample_sec
+        self.received = 0
+        self._rss_mb = 0.0
+        self._rss_at = float("-inf")
+        self._lock = threading.Lock()
 
-    if isinstance(data, dict):
-        preview = {k: data[k] for k in list(data.keys())[:8]}
-    elif isinstance(data, list):
-        preview = data[:1]
-    else:
-        preview = data
+    def trip(self, metrics: dict | None, reason: str, message: str) -> BudgetExceeded:
+        incr_metric(metrics, "budget_trips")
+        incr_metric(metrics, f"budget_trips_{reason}")
+        return BudgetExceeded(reason, message)
 
-    print("[smoke] json preview:")
-    print(json.dumps(preview, indent=2)[:1500])
+    def rss_mb(self, metrics: dict | None = None) -> float:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._rss_at >= self.rss_sample_sec:
+                self._rss_mb = current_rss_mb()
+                self._rss_at = now
+            rss = self._rss_mb
+        if metrics is not None:
+            with _METRICS_LOCK:
+                metrics["rss_peak_mb"] = round(max(metrics.get("rss_peak_mb", 0), rss), 1)
+        return rss
 
-    return data
+    def under_pressure(self, metrics: dict | None = None) -> bool:
+        """
+        Samples RSS (recording the peak) and reports whether it is over max_rss_mb
+        """
+        rss = self.rss_mb(metrics)
+        if self.max_rss_mb is None or rss <= self.max_rss_mb:
+            return False
+        incr_metric(metrics, "budget_trips")
+        incr_metric(metrics, "budget_trips_rss")
+        return True
+
+    def check_run(self, metrics: dict | None = None, incoming: int = 0) -> None:
+        if self.max_run_bytes is not None and self.received + incoming > self.max_run_bytes:
+            raise self.trip(metrics, "run", f"run budget of {self.max_run_bytes} bytes exhausted")
+
+    def admit(self, response: requests.Response, metrics: dict | None = None) -> None:
+        """
+        Checks Content-Length (when sent) before a body is read into memory.
+        Raises BudgetExceeded without consuming the body
+        """
+        length = content_length(response)
+        if length is None:
+            return
+        self.check_run(metrics, incoming=length)
+        if length > self.max_response_bytes:
+            raise self.trip(metrics, "response", f"Content-Length {length} over {self.max_response_bytes} bytes")
+
+    def iter_content(
+        self,
+        response: requests.Response,
+        chunk_size: int = 256 * 1024,
+        metrics: dict | None = None,
+        cap: int | None = None
+    ) -> Iterator[bytes]:
+        """
+        response.iter_content, charging every chunk to the run budget and
+        aborting (closing the connection) once more than `cap` bytes arrived
+        """
+        read = 0
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if not chunk:
+                    continue
+                read += len(chunk)
+                if cap is not None and read > cap:
+                    raise self.trip(metrics, "response", f"body over {cap} bytes while reading")
+                with self._lock:
+                    self.received += len(chunk)
+                incr_metric(metrics, "bytes_received", len(chunk))
+                self.check_run(metrics)
+                yield chunk
+        except BudgetExceeded:
+            response.close()
+            raise
+
+    def read(self, response: requests.Response, metrics: dict | None = None) -> bytes:
+        """
+        Reads a streamed response body into memory within max_response_bytes
+        """
+        self.admit(response, metrics)
+        return b"".join(self.iter_content(response, metrics=metrics, cap=self.max_response_bytes))
+
+    def read_json(self, response: requests.Response, metrics: dict | None = None) -> Any:
+        return json.loads(self.read(response, metrics))
 
 
 # -----------------------------
-# DOCUMENT HANDLING
+# TELEMETRY
 # -----------------------------
-def download_documents(
-    data: dict,
-    output_dir: str = ".",
-    auth: HTTPBasicAuth = None,
-    base_url: str = None,
-    max_retries: int = 3,
-    timeout: int = 180,
-    rate_limiter: RateLimiter | None = None,
-    metrics: dict | None = None
-) -> bool:
+# Upper bounds (ms) of the latency histogram buckets; +Inf is implicit
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000)
+
+
+class LatencyHistogram:
     """
-    Downloads document content either from fileContent or by fetching individually
+    Cumulative-bucket latency histogram (Prometheus style); quantiles are
+    interpolated inside the bucket they fall in. Not thread-safe on its own
     """
-    if not isinstance(data, dict) or "items" not in data:
-        print("FAIL: respuesta inesperada")
-        return False
 
-    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    def __init__(self, buckets: tuple[int, ...] = LATENCY_BUCKETS_MS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
 
-    total_docs = len(data["items"])
-    downloaded = 0
-    failed = 0
-    rate_limiter = rate_limiter or RateLimiter()
+    def observe(self, latency_ms: float) -> None:
+        self.counts[bisect_left(self.buckets, latency_ms)] += 1
+        self.count += 1
+        self.sum_ms += latency_ms
+        self.max_ms = max(self.max_ms, float(latency_ms))
 
-    for idx, doc in enumerate(data["items"], 1):
-        b64 = doc.get("fileContent", "").strip()
-        filename = doc.get("fileName", f"document_{idx}.bin")
-        filename = filename.replace("/", "_").replace("\\", "_")
-        doc_id = doc.get("id")
-        filepath = Path(output_dir) / filename
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for i, n in enumerate(self.counts):
+            upper = self.buckets[i] if i < len(self.buckets) else self.max_ms
+            if n and seen + n >= rank:
+                return round(min(self.max_ms, lower + (upper - lower) * (rank - seen) / n), 1)
+            seen += n
+            lower = upper
+        return self.max_ms
 
-        if filepath.exists() and filepath.stat().st_size > 0:
-            print(f"  [{idx}/{total_docs}] SKIP {filename} (already exists)")
-            if metrics is not None:
-                metrics["files_skipped"] = metrics.get("files_skipped", 0) + 1
-            continue
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.sum_ms / self.count, 1) if self.count else 0.0,
+            "p50_ms": self.quantile(0.50),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+            "max_ms": self.max_ms,
+        }
+
+
+class Telemetry:
+    """
+    Run-wide request telemetry: latency histograms, response status counts
+    and in-flight gauges per shard and endpoint, plus a timeline of rates
+    sampled from the shard metrics at every flush. flush() writes it all
+    into the current shard's metrics JSON and, when `prom_path` is set, into a
+    Prometheus textfile (node-exporter textfile collector); start() flushes
+    every `interval_sec` from a background thread.
+    With `profile`, span() also times the stages of each request and
+    document (throttle, headers, body, JSON parse, Base64 decode, sha256,
+    disk write) per shard, for the stage breakdown in metrics/
+    """
+
+    # metrics keys diffed between flushes into per-second rates
+    TIMELINE_COUNTERS = ("requests_total", "http_429", "http_5xx", "timeouts", "bytes_received", "files_downloaded")
+    # metrics keys exported to Prometheus as unit4_<key>{shard=...}
+    EXPORTED_COUNTERS = (
+        "requests_total", "http_429", "http_5xx", "timeouts", "files_downloaded", "files_skipped",
+        "files_failed", "bytes_downloaded", "bytes_received", "sleep_seconds", "budget_trips",
+    )
+
+    def __init__(
+        self,
+        prom_path: Path | None = None,
+        interval_sec: float = 15.0,
+        timeline_size: int = 240,
+        profile: bool = False
+    ) -> None:
+        self.prom_path = prom_path
+        self.profile = profile
+        self.stages: dict[tuple[str, str], LatencyHistogram] = {}
+        self.interval_sec = interval_sec
+        self.timeline_size = timeline_size
+        self.shard = ""
+        self.histograms: dict[tuple[str, str], LatencyHistogram] = {}
+        self.statuses: dict[tuple[str, str, str], int] = {}
+        self.in_flight: dict[str, int] = {}
+        self.runs: dict[str, tuple[dict, Path]] = {}
+        self._sample: tuple[float, dict] = (time.monotonic(), {})
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def track(self, shard: str, metrics: dict, metrics_path: Path) -> None:
+        """
+        Makes `metrics` (saved to `metrics_path`) the target of flushes and
+        `shard` the label of requests from now on
+        """
+        with self._lock:
+            self.shard = shard
+            self.runs[shard] = (metrics, metrics_path)
+            self._sample = (time.monotonic(), {})
+
+    def begin(self, endpoint: str) -> None:
+        with self._lock:
+            self.in_flight[endpoint] = self.in_flight.get(endpoint, 0) + 1
 
-        if not b64 and auth and base_url:
-            params = {
-                "companyId": "P2",
-                "indexes": "P2",
-                "id": doc_id,
-                "withFileContent": True,
+    def end(self, endpoint: str, status: int | str, latency_ms: int) -> None:
+        with self._lock:
+            self.in_flight[endpoint] = self.in_flight.get(endpoint, 0) - 1
+            key = (self.shard, endpoint)
+            self.histograms.setdefault(key, LatencyHistogram()).observe(latency_ms)
+            status_key = (self.shard, endpoint, str(status))
+            self.statuses[status_key] = self.statuses.get(status_key, 0) + 1
+            if self.profile:
+                self.stages.setdefault((self.shard, "http_headers"), LatencyHistogram()).observe(latency_ms)
+
+    @contextlib.contextmanager
+    def _span(self, stage: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.perf_counter() - t0) * 1000
+            with self._lock:
+                self.stages.setdefault((self.shard, stage), LatencyHistogram()).observe(elapsed_ms)
+
+    def span(self, stage: str) -> contextlib.AbstractContextManager:
+        """
+        Times the with-block as `stage` of the current shard; a no-op unless profiling
+        """
+        return self._span(stage) if self.profile else contextlib.nullcontext()
+
+    def stage_table(self, metrics: dict) -> str:
+        """
+        Stage breakdown of `metrics`' shard as a fixed-width table, largest
+        total first; sleeps other than throttling show up as backoff_sleep
+        """
+        stages = dict(metrics.get("stages", {}))
+        throttle_sec = stages.get("throttle", {}).get("total_sec", 0.0)
+        backoff_sec = max(0.0, metrics.get("sleep_seconds", 0) - throttle_sec)
+        if backoff_sec:
+            stages["backoff_sleep"] = {"count": None, "total_sec": round(backoff_sec, 3)}
+        grand = sum(s["total_sec"] for s in stages.values()) or 1.0
+        lines = [
+            f"Stage breakdown for {metrics.get('shard', '')} (stages can overlap across worker threads)",
+            f"{'stage':<16} {'count':>8} {'total s':>10} {'share':>7} {'mean ms':>9} {'p95 ms':>9} {'max ms':>9}",
+        ]
+        for stage, s in sorted(stages.items(), key=lambda kv: -kv[1]["total_sec"]):
+            count = "" if s.get("count") is None else s["count"]
+            timings = [f"{s[key]:.1f}" if key in s else "" for key in ("mean_ms", "p95_ms", "max_ms")]
+            lines.append(
+                f"{stage:<16} {count:>8} {s['total_sec']:>10.3f} {100 * s['total_sec'] / grand:>6.1f}% "
+                + " ".join(f"{t:>9}" for t in timings)
+            )
+        return "\n".join(lines) + "\n"
+
+    def annotate(self, metrics: dict) -> None:
+        """
+        Adds latency percentiles, status counts, in-flight gauges and a new
+        timeline sample (rates since the previous one) to `metrics`
+        """
+        shard = metrics.get("shard", "")
+        now = time.monotonic()
+        with _METRICS_LOCK:
+            counters = {key: metrics.get(key, 0) for key in self.TIMELINE_COUNTERS}
+        with self._lock:
+            latency = {ep: h.summary() for (sh, ep), h in self.histograms.items() if sh == shard}
+            statuses: dict[str, dict[str, int]] = {}
+            for (sh, ep, code), n in self.statuses.items():
+                if sh == shard:
+                    statuses.setdefault(ep, {})[code] = n
+            in_flight = dict(self.in_flight)
+            stages = {
+                stage: {**h.summary(), "total_sec": round(h.sum_ms / 1000, 3)}
+                for (sh, stage), h in self.stages.items() if sh == shard
             }
+            sampled_at, previous = self._sample
+            current = shard == self.shard
+            if current:
+                self._sample = (now, counters)
 
-            for attempt in range(max_retries):
-                try:
-                    print(f"  [{idx}/{total_docs}] Fetching {filename}...", end=" ")
-                    rate_limiter.wait(metrics)
-                    response, _ = make_request(base_url, params, auth, timeout=timeout)
-
-                    if metrics is not None:
-                        metrics["requests_total"] = metrics.get("requests_total", 0) + 1
-
-                    if response.status_code == 429:
-                        if metrics is not None:
-                            metrics["http_429"] = metrics.get("http_429", 0) + 1
-                        retry_after = response.headers.get("Retry-After")
-                        wait_sec = float(retry_after) if retry_after else backoff_seconds(attempt)
-                        print(f"RATE-LIMIT (wait {wait_sec:.1f}s)")
-                        sleep_with_metrics(wait_sec, metrics)
-                        record_failure_and_maybe_break(metrics)
-                        continue
+        values = {"latency": latency, "status_counts": statuses, "in_flight": in_flight}
+        if self.profile:
+            values["stages"] = stages
+        elapsed = now - sampled_at
+        if current and elapsed >= 1:
+            point = {"at": time.strftime("%Y-%m-%d %H:%M:%S"), "in_flight": sum(in_flight.values())}
+            for key, value in counters.items():
+                point[f"{key}_per_sec"] = round((value - previous.get(key, 0)) / elapsed, 2)
+            with _METRICS_LOCK:
+                timeline = metrics.setdefault("timeline", [])
+                timeline.append(point)
+                del timeline[:-self.timeline_size]
+        update_metrics(metrics, values)
 
-                    if response.status_code >= 500:
-                        if metrics is not None:
-                            metrics["http_5xx"] = metrics.get("http_5xx", 0) + 1
-                        wait_sec = backoff_seconds(attempt)
-                        print(f"SERVER-ERR (wait {wait_sec:.1f}s)")
-                        sleep_with_metrics(wait_sec, metrics)
-                        record_failure_and_maybe_break(metrics)
-                        continue
+    def prometheus_text(self) -> str:
+        def labels(**kv: str) -> str:
+            return "{" + ",".join(f'{k}="{v}"' for k, v in kv.items()) + "}"
 
-                    if not validate_response(response):
-                        if metrics is not None:
-                            metrics["http_other"] = metrics.get("http_other", 0) + 1
-                        print(f"FAIL (status {response.status_code})")
-                        sleep_with_metrics(2, metrics)
-                        record_failure_and_maybe_break(metrics)
-                        continue
+        lines = [
+            "# HELP unit4_request_duration_seconds Time to response headers from the Unit4 API.",
+            "# TYPE unit4_request_duration_seconds histogram",
+        ]
+        with self._lock:
+            for (shard, endpoint), h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, n in zip([*h.buckets, None], h.counts):
+                    cumulative += n
+                    le = "+Inf" if bound is None else f"{bound / 1000:g}"
+                    lines.append(f"unit4_request_duration_seconds_bucket{labels(shard=shard, endpoint=endpoint, le=le)} {cumulative}")
+                lines.append(f"unit4_request_duration_seconds_sum{labels(shard=shard, endpoint=endpoint)} {h.sum_ms / 1000:.3f}")
+                lines.append(f"unit4_request_duration_seconds_count{labels(shard=shard, endpoint=endpoint)} {h.count}")
+            lines += [
+                "# HELP unit4_responses_total Responses by status code (timeout / error when there was none).",
+                "# TYPE unit4_responses_total counter",
+            ]
+            for (shard, endpoint, code), n in sorted(self.statuses.items()):
+                lines.append(f"unit4_responses_total{labels(shard=shard, endpoint=endpoint, code=code)} {n}")
+            lines += [
+                "# HELP unit4_requests_in_flight Requests waiting on response headers.",
+                "# TYPE unit4_requests_in_flight gauge",
+            ]
+            for endpoint, n in sorted(self.in_flight.items()):
+                lines.append(f"unit4_requests_in_flight{labels(shard=self.shard, endpoint=endpoint)} {n}")
+            runs = list(self.runs.items())
 
-                    response_data = response.json()
-                    items = response_data.get("items", [])
-                    if items:
-                        b64 = items[0].get("fileContent", "").strip()
+        for key in self.EXPORTED_COUNTERS:
+            lines.append(f"# TYPE unit4_{key} gauge")
+            for shard, (metrics, _) in runs:
+                with _METRICS_LOCK:
+                    value = metrics.get(key, 0)
+                lines.append(f"unit4_{key}{labels(shard=shard)} {value}")
+        lines += [
+            "# HELP unit4_last_flush_timestamp_seconds When this file was written; alert if it stops moving.",
+            "# TYPE unit4_last_flush_timestamp_seconds gauge",
+            f"unit4_last_flush_timestamp_seconds {time.time():.0f}",
+        ]
+        return "\n".join(lines) + "\n"
 
-                    if not b64:
-                        print("FAIL (no fileContent)")
-                        sleep_with_metrics(2, metrics)
-                        continue
+    def write_prometheus(self) -> None:
+        if self.prom_path is None:
+            return
+        # Write-then-rename: the textfile collector must never see a partial file
+        tmp_path = self.prom_path.with_name(f".{self.prom_path.name}.part")
+        tmp_path.write_text(self.prometheus_text(), encoding="utf-8")
+        os.replace(tmp_path, self.prom_path)
 
-                    record_success(metrics)
-                    break
+    def flush(self) -> None:
+        with self._lock:
+            run = self.runs.get(self.shard)
+        if run is not None:
+            metrics, metrics_path = run
+            self.annotate(metrics)
+            save_metrics(metrics_path, metrics)
+        self.write_prometheus()
 
-                except requests.exceptions.Timeout:
-                    if attempt < max_retries - 1:
-                        print(f"TIMEOUT (retry {attempt + 1}/{max_retries})")
-                        if metrics is not None:
-                            metrics["timeouts"] = metrics.get("timeouts", 0) + 1
-                        sleep_with_metrics(2 + attempt, metrics)
-                        record_failure_and_maybe_break(metrics)
-                        continue
-                    print("TIMEOUT (max retries)")
+    def start(self) -> None:
+        if self.interval_sec <= 0 or self._thread is not None:
+            return
+
+        def loop() -> None:
+            while not self._stop.wait(self.interval_sec):
+                try:
+                    self.flush()
                 except Exception as e:
-                    print(f"FAIL ({e})")
-                    sleep_with_metrics(2, metrics)
-                    record_failure_and_maybe_break(metrics)
+                    print(f"[metrics] flush failed: {e}")
 
-            if not b64:
-                failed += 1
-                continue
+        self._thread = threading.Thread(target=loop, name="unit4-metrics", daemon=True)
+        self._thread.start()
 
-        if not b64:
-            print(f"  [{idx}/{total_docs}] SKIP {filename} (no fileContent)")
-            failed += 1
-            continue
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write_prometheus()
 
-        try:
-            b64_clean = re.sub(r"^data:.*;base64,", "", b64)
-            binary = base64.b64decode(b64_clean)
-
-            sha256 = hashlib.sha256(binary).hexdigest()
-            filepath.write_bytes(binary)
-            size_kb = len(binary) / 1024
-            print(f"OK ({size_kb:.1f} KB)")
-            downloaded += 1
-            if metrics is not None:
-                metrics["files_downloaded"] = metrics.get("files_downloaded", 0) + 1
-                metrics["bytes_downloaded"] = metrics.get("bytes_downloaded", 0) + len(binary)
-            record_success(metrics)
-        except Exception as e:
-            print(f"FAIL ({e})")
-            failed += 1
-            if metrics is not None:
-                metrics["files_failed"] = metrics.get("files_failed", 0) + 1
-            record_failure_and_maybe_break(metrics)
 
-    print(f"\n[summary] Downloaded: {downloaded}/{total_docs}, Failed: {failed}")
-    return failed == 0
+def stage_span(telemetry: Telemetry | None, stage: str) -> contextlib.AbstractContextManager:
+    return telemetry.span(stage) if telemetry is not None else contextlib.nullcontext()
+
+
+class ShardProfiler:
+    """
+    Optional per-shard profilers: tracemalloc peak and top allocation sites
+    (`memory`) and a cProfile dump (`cpu`). cProfile only sees the thread
+    that started it, so with download workers it covers listing and the
+    dispatch loop, not the downloads themselves
+    """
 
+    def __init__(self, memory: bool = False, cpu: bool = False) -> None:
+        self.memory = memory
+        self._cpu = cProfile.Profile() if cpu else None
 
+    def start(self) -> None:
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(5)
+            tracemalloc.reset_peak()
+        if self._cpu is not None:
+            self._cpu.enable()
+
+    def stop(self, metrics: dict, prof_path: Path, top: int = 10) -> None:
+        if self._cpu is not None:
+            self._cpu.disable()
+            self._cpu.dump_stats(prof_path)
+            update_metrics(metrics, {"cprofile": str(prof_path)})
+        if self.memory and tracemalloc.is_tracing():
+            _, peak = tracemalloc.get_traced_memory()
+            stats = tracemalloc.take_snapshot().statistics("lineno")[:top]
+            update_metrics(metrics, {
+                "tracemalloc_peak_mb": round(peak / (1024 * 1024), 2),
+                "tracemalloc_top": [
+                    f"{Path(stat.traceback[0].filename).name}:{stat.traceback[0].lineno} {stat.size / 1024:.0f} KB"
+                    for stat in stats
+                ],
+            })
+
+
+# -----------------------------
+# HTTP
 # -----------------------------
-def extract_metadata(data: dict) -> list[dict[str, Any]]:
+def build_session(auth: HTTPBasicAuth | None = None, pool_size: int = 10) -> requests.Session:
     """
-    Extracts metadata from API response items (excluding fileContent)
+    Builds the long-lived HTTP client shared by pagination and downloads:
+    keep-alive connection pool sized for the download workers, gzip/deflate
+    negotiation and auth attached once
     """
-    if not isinstance(data, dict) or "items" not in data:
-        return []
+    session = requests.Session()
+    session.auth = auth
+    session.headers.update({
+        "Accept": "application/json",
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive",
+    })
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
-    metadata_list = []
-    for doc in data["items"]:
-        metadata = {
-            "id": doc.get("id"),
-            "fileName": doc.get("fileName"),
-            "mimeType": doc.get("mimeType"),
-            "docType": doc.get("docType"),
-            "companyId": doc.get("companyId"),
-            "status": doc.get("status"),
-            "revisionNo": doc.get("revisionNo"),
-            "updatedAt": doc.get("lastUpdate", {}).get("updatedAt"),
-            "updatedBy": doc.get("lastUpdate", {}).get("updatedBy"),
-        }
-        metadata_list.append(metadata)
 
-    return metadata_list
+def connection_stats(session: requests.Session | None) -> dict:
+    """
+    Returns counters of new vs reused connections across the session pools
+    """
+    opened = sent = 0
+    if session is not None:
+        adapters = {id(a): a for a in session.adapters.values()}.values()
+        for adapter in adapters:
+            poolmanager = getattr(adapter, "poolmanager", None)
+            if poolmanager is None:
+                continue
+            pools = poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                opened += pool.num_connections
+                sent += pool.num_requests
+    return {
+        "connections_new": opened,
+        "connections_reused": max(0, sent - opened),
+    }
 
 
-def save_metadata_csv(metadata_list: list[dict], filename: str) -> bool:
+def make_request(
+    url: str,
+    params: dict,
+    auth: HTTPBasicAuth,
+    timeout: float = 120,
+    session: requests.Session | None = None,
+    stream: bool = False,
+    telemetry: Telemetry | None = None,
+    endpoint: str = "documents"
+) -> tuple[requests.Response, int]:
     """
-    Saves metadata list to CSV file
+    Executes a GET request and returns response + latency in ms.
+    Uses the pooled `session` when given, a one-off connection otherwise.
+    With stream=True only the headers are read; latency is time to headers.
+    Every attempt (timeouts included) is recorded in `telemetry` under `endpoint`
     """
-    if not metadata_list:
-        print(f"No metadata to save for {filename}")
-        return False
+    headers = {"Accept": "application/json"}
+    status: int | str = "error"
 
+    if telemetry is not None:
+        telemetry.begin(endpoint)
+    t0 = time.time()
     try:
-        with open(filename, "w", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=metadata_list[0].keys())
-            writer.writeheader()
-            writer.writerows(metadata_list)
-        print(f"✓ Metadata saved: {filename} ({len(metadata_list)} rows)")
-        return True
-    except Exception as e:
-        print(f"Error saving metadata: {e}")
-        return False
+        if session is not None:
+            response = session.get(
+                url,
+                params=params,
+                timeout=timeout,
+                stream=stream
+            )
+        else:
+            response = requests.get(
+                url,
+                params=params,
+                headers=headers,
+                auth=auth,
+                timeout=timeout,
+                stream=stream
+            )
+        status = response.status_code
+    except requests.exceptions.Timeout:
+        status = "timeout"
+        raise
+    finally:
+        latency_ms = int((time.time() - t0) * 1000)
+        if telemetry is not None:
+            telemetry.end(endpoint, status, latency_ms)
+
+    return response, latency_ms
 
 
-def save_response_json(data: dict, filename: str) -> bool:
+class AdaptiveTimeouts:
     """
-    Saves full API response to JSON file (excluding fileContent to keep size reasonable)
+    Per-endpoint request timeouts learned from observed time to headers:
+    `factor` x p99 of the last `window` latencies, plus the expected payload
+    at `min_bytes_per_sec`, clamped to [floor_sec, ceiling_sec]; the ceiling
+    (the configured timeout) applies until `warmup` samples arrived. A retry
+    after a timeout doubles the budget per attempt, up to the ceiling. Timed
+    out requests count as their full timeout and 5xx answers as their
+    latency, so a degrading server widens the timeout instead of narrowing it.
+    With `hedge`, a content fetch still waiting past the p95 latency gets one
+    duplicate request (see hedged_request), at most `max_hedge_ratio` of all
+    requests, so normal operation adds no load. The hedge executor carries
+    the primaries too, so it is sized for `max_workers` concurrent requests
+    (twice the download workers). Thread-safe
     """
-    if not data or "items" not in data:
-        print(f"No data to save for {filename}")
-        return False
 
-    try:
-        data_clean = data.copy()
-        data_clean["items"] = [
-            {k: v for k, v in item.items() if k != "fileContent"}
-            for item in data_clean.get("items", [])
-        ]
+    def __init__(
+        self,
+        ceiling_sec: float = 180.0,
+        floor_sec: float = 10.0,
+        factor: float = 3.0,
+        window: int = 200,
+        warmup: int = 20,
+        min_bytes_per_sec: int = 512 * 1024,
+        hedge: bool = False,
+        hedge_quantile: float = 0.95,
+        max_hedge_ratio: float = 0.05,
+        max_workers: int = 32
+    ) -> None:
+        self.ceiling_sec = ceiling_sec
+        self.floor_sec = min(floor_sec, ceiling_sec)
+        self.factor = factor
+        self.window = window
+        self.warmup = warmup
+        self.min_bytes_per_sec = min_bytes_per_sec
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.max_hedge_ratio = max_hedge_ratio
+        self.max_workers = max_workers
+        self.requests = 0
+        self.hedges = 0
+        self._latencies: dict[str, deque] = {}
+        self._lock = threading.Lock()
+        self._executor: ThreadPoolExecutor | None = None
 
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump(data_clean, f, indent=2, ensure_ascii=False)
+    def observe(self, endpoint: str, latency_ms: int) -> None:
+        with self._lock:
+            self._latencies.setdefault(endpoint, deque(maxlen=self.window)).append(latency_ms)
+            self.requests += 1
 
-        size_mb = Path(filename).stat().st_size / (1024 * 1024)
-        print(f"✓ Response JSON saved: {filename} ({size_mb:.1f} MB)")
-        return True
-    except Exception as e:
-        print(f"Error saving response JSON: {e}")
-        return False
+    def quantile_ms(self, endpoint: str, q: float) -> float | None:
+        with self._lock:
+            samples = sorted(self._latencies.get(endpoint, ()))
+        if len(samples) < self.warmup:
+            return None
+        return float(samples[min(len(samples) - 1, int(q * len(samples)))])
 
+    def timeout(self, endpoint: str, expected_bytes: int | None = None, attempt: int = 0) -> float:
+        p99 = self.quantile_ms(endpoint, 0.99)
+        if p99 is None:
+            return self.ceiling_sec
+        seconds = self.factor * p99 / 1000 + (expected_bytes or 0) / self.min_bytes_per_sec
+        return min(self.ceiling_sec, max(self.floor_sec, seconds) * (2 ** attempt))
 
-# ----
-# PAGINATION & BATCH PROCESSING
-# ----
-def fetch_all_documents(
+    def hedge_delay(self, endpoint: str) -> float | None:
+        """
+        Seconds to wait for headers before hedging, or None when hedging is
+        off, not warmed up or over its share of requests
+        """
+        if not self.hedge:
+            return None
+        delay_ms = self.quantile_ms(endpoint, self.hedge_quantile)
+        if delay_ms is None:
+            return None
+        with self._lock:
+            if self.hedges + 1 > self.max_hedge_ratio * (self.requests + 1):
+                return None
+        return delay_ms / 1000
+
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="unit4-hedge")
+            return self._executor
+
+    def acquire_hedge(self) -> bool:
+        """
+        Takes one hedge from the `max_hedge_ratio` share, checked and counted
+        under one lock so concurrent workers cannot overshoot it; the hedge is
+        itself a request sent, so it counts towards `requests` too
+        """
+        with self._lock:
+            if self.hedges + 1 > self.max_hedge_ratio * (self.requests + 1):
+                return False
+            self.hedges += 1
+            self.requests += 1
+            return True
+
+    def snapshot(self) -> dict:
+        return {
+            "timeout_list_sec": round(self.timeout("list"), 1),
+            "timeout_content_sec": round(self.timeout("content"), 1),
+            "hedges_issued": self.hedges,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def hedged_request(
     url: str,
-    params_base: dict,
+    params: dict,
     auth: HTTPBasicAuth,
-    limit: int = 50,
-    max_retries: int = 3,
-    rate_limiter: RateLimiter | None = None,
+    timeouts: AdaptiveTimeouts,
+    timeout: float,
+    delay: float,
+    rate_limiter: RateLimiter,
+    session: requests.Session | None = None,
     metrics: dict | None = None,
-    checkpoint_path: Path | None = None,
-    items_path: Path | None = None,
-    min_limit: int = 10
-) -> Optional[list[dict]]:
+    telemetry: Telemetry | None = None,
+    endpoint: str = "content"
+) -> tuple[requests.Response, int]:
     """
-    Fetches ALL documents using pagination with retry logic
-    Returns list of all items, or None if failed
+    make_request(stream=True) that, when no headers arrived within `delay`
+    seconds, sends one duplicate (after waiting its turn in the rate budget)
+    and returns whichever answers first; the other response is closed when
+    it lands. Without a hedge left in the budget it just waits for the
+    first request. Latency counts from the first request.
+    Raises what the last outstanding request raised when none answers
     """
-    rate_limiter = rate_limiter or RateLimiter()
+    def close_late(future) -> None:
+        if future.exception() is None:
+            future.result()[0].close()
 
-    all_items: list[dict] = []
-    start = 0
-    page = 1
-    current_limit = limit
-
-    if items_path is not None and items_path.exists():
-        all_items = load_jsonl_items(items_path)
-        start = len(all_items)
-        if metrics is not None:
-            metrics["resumed_items"] = start
+    t0 = time.time()
+    executor = timeouts.executor()
+    request = dict(timeout=timeout, session=session, stream=True, telemetry=telemetry, endpoint=endpoint)
+    primary = executor.submit(make_request, url, params, auth, **request)
+    done, _ = wait([primary], timeout=delay)
+    if done:
+        return primary.result()
 
-    if checkpoint_path is not None:
-        checkpoint = load_checkpoint(checkpoint_path)
-        start = max(start, int(checkpoint.get("start", 0)))
-        if start:
-            page = (start // max(current_limit, 1)) + 1
+    if not timeouts.acquire_hedge():
+        response, _ = primary.result()
+        return response, int((time.time() - t0) * 1000)
 
-    print(f"Starting pagination (limit={current_limit})...")
+    rate_limiter.wait(metrics)
+    incr_metric(metrics, "hedged_requests")
+    incr_metric(metrics, "requests_total")
+    backup = executor.submit(make_request, url, params, auth, **request)
+    pending = {primary, backup}
+    error: BaseException | None = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        answered = [f for f in done if f.exception() is None]
+        error = next((f.exception() for f in done if f.exception() is not None), error)
+        if not answered:
+            continue
+        winner = answered[0]
+        for loser in [*answered[1:], *pending]:
+            loser.add_done_callback(close_late)
+        if winner is backup:
+            incr_metric(metrics, "hedge_wins")
+        return winner.result()[0], int((time.time() - t0) * 1000)
+    raise error
 
-    while True:
-        params = {**params_base, "start": start, "limit": current_limit}
 
-        for attempt in range(max_retries):
+# -----------------------------
+# VALIDATION & LOGGING
+# -----------------------------
+def error_body_preview(
+    r: requests.Response,
+    budget: MemoryBudget | None = None,
+    metrics: dict | None = None,
+    limit: int = 500
+) -> str:
+    """
+    First `limit` bytes of a response body, read through `budget` when given;
+    the rest of the body is never downloaded
+    """
+    if budget is not None:
+        chunks = budget.iter_content(r, limit, metrics, cap=budget.max_response_bytes)
+    else:
+        chunks = r.iter_content(chunk_size=limit)
+    head = next((chunk for chunk in chunks if chunk), b"")
+    return head[:limit].decode(r.encoding or "utf-8", errors="replace")
+
+
+def validate_response(
+    r: requests.Response,
+    budget: MemoryBudget | None = None,
+    metrics: dict | None = None
+) -> bool:
+    """
+    Validates HTTP response and prints useful debug info. A rejected response
+    is closed after previewing its body, so its pooled connection is released
+    """
+    if r.status_code in (200, 201):
+        return True
+
+    try:
+        if r.status_code in (401, 403):
+            print("[smoke] auth failed")
+            print("WWW-Authenticate:", r.headers.get("WWW-Authenticate"))
+        else:
+            print("[smoke] unexpected status code:", r.status_code)
+        print("Body:", error_body_preview(r, budget, metrics))
+    finally:
+        r.close()
+    return False
+
+
+def print_json_preview(r: requests.Response) -> dict | None:
+    """
+    Prints a short JSON preview and returns parsed JSON
+    """
+    ct = r.headers.get("Content-Type", "")
+    if "application/json" not in ct:
+        print("[smoke] non-json content-type:", ct)
+        return None
+
+    data = r.json()
+
+    if isinstance(data, dict):
+        preview = {k: data[k] for k in list(data.keys())[:8]}
+    elif isinstance(data, list):
+        preview = data[:1]
+    else:
+        preview = data
+
+    print("[smoke] json preview:")
+    print(json.dumps(preview, indent=2)[:1500])
+
+    return data
+
+
+# -----------------------------
+# DOCUMENT HANDLING
+# -----------------------------
+class Base64FieldDecoder:
+    """
+    Incremental decoder for the Base64 `fileContent` value of a JSON body.
+    Bytes are fed as they arrive; the value is located, unescaped, stripped of
+    any `data:...;base64,` prefix and decoded in 4-char aligned pieces into
+    `sink` while hashing, so memory stays bounded by the chunk size
+    """
+
+    def __init__(self, sink, field: str = "fileContent") -> None:
+        self.sink = sink
+        self.size = 0
+        self.found = False
+        self._needle = f'"{field}"'.encode()
+        self._state = "search"
+        self._buf = b""
+        self._pending = b""
+        self._prefix_done = False
+        self._hash = hashlib.sha256()
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    @property
+    def done(self) -> bool:
+        return self._state == "done"
+
+    def feed(self, chunk: bytes) -> None:
+        data = self._buf + chunk
+        self._buf = b""
+        while data and self._state != "done":
+            if self._state == "search":
+                pos = data.find(self._needle)
+                if pos < 0:
+                    self._buf = data[-(len(self._needle) - 1):]
+                    return
+                data = data[pos + len(self._needle):]
+                self._state = "colon"
+            elif self._state in ("colon", "quote"):
+                data = data.lstrip()
+                if not data:
+                    return
+                expected = b":" if self._state == "colon" else b'"'
+                if data[:1] == expected:
+                    data = data[1:]
+                    self._state = "quote" if self._state == "colon" else "value"
+                    self.found = self._state == "value"
+                elif self._state == "quote" and data[:1] == b"n":
+                    self._state = "done"
+                else:
+                    self._state = "search"
+            else:
+                end = data.find(b'"')
+                segment = data if end < 0 else data[:end]
+                if segment.endswith(b"\\") and end < 0:
+                    segment, self._buf = segment[:-1], b"\\"
+                self._consume(segment)
+                if end < 0:
+                    return
+                self._flush(final=True)
+                self._state = "done"
+
+    def _consume(self, segment: bytes) -> None:
+        if b"\\" in segment:
+            segment = (
+                segment.replace(b"\\/", b"/")
+                .replace(b"\\n", b"")
+                .replace(b"\\r", b"")
+                .replace(b"\\t", b"")
+            )
+        self._pending += segment.translate(None, b" \t\r\n")
+        if not self._prefix_done:
+            if self._pending.startswith(b"data:"):
+                marker = self._pending.find(b";base64,")
+                if marker < 0:
+                    return
+                self._pending = self._pending[marker + len(b";base64,"):]
+            elif len(self._pending) < len(b"data:") and b"data:".startswith(self._pending):
+                return
+            self._prefix_done = True
+        self._flush()
+
+    def _flush(self, final: bool = False) -> None:
+        cut = len(self._pending) if final else len(self._pending) - len(self._pending) % 4
+        if cut <= 0:
+            return
+        binary = base64.b64decode(self._pending[:cut])
+        self._pending = self._pending[cut:]
+        self._hash.update(binary)
+        self.sink.write(binary)
+        self.size += len(binary)
+
+
+def stream_document_to_temp(
+    response: requests.Response,
+    directory: Path,
+    chunk_size: int = 256 * 1024,
+    budget: MemoryBudget | None = None,
+    metrics: dict | None = None
+) -> tuple[Path, str, int] | None:
+    """
+    Streams the response body through Base64FieldDecoder into a `.part`
+    temp file inside `directory`; bytes received count against `budget`.
+    Returns (temp path, sha256, size), or None when the body carries no fileContent
+    """
+    chunks = (
+        budget.iter_content(response, chunk_size, metrics)
+        if budget is not None
+        else response.iter_content(chunk_size=chunk_size)
+    )
+    fd, tmp_name = tempfile.mkstemp(prefix=".unit4-", suffix=".part", dir=directory)
+    tmp_path = Path(tmp_name)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            decoder = Base64FieldDecoder(f)
+            for chunk in chunks:
+                if chunk:
+                    decoder.feed(chunk)
+        if not decoder.found or decoder.size == 0:
+            tmp_path.unlink(missing_ok=True)
+            return None
+        if not decoder.done:
+            raise ValueError("truncated fileContent")
+        os.chmod(tmp_path, 0o644)
+        return tmp_path, decoder.sha256, decoder.size
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    finally:
+        response.close()
+
+
+class DocumentManifest:
+    """
+    Append-only JSONL manifest shared by every docType under docs/:
+    id -> revisionNo, sha256, size, mimeType, fileName and stored path.
+    The latest line per id wins; the whole index lives in memory so skip
+    decisions are a dict lookup instead of a stat() per file
+    """
+
+    def __init__(self, path: Path, compact: bool = True) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._by_id: dict[str, dict] = {}
+        self._by_path: dict[str, str] = {}
+        self._shas: set[str] = set()
+        lines = 0
+        if path.exists():
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    lines += 1
+                    self._index(entry)
+        # Shard processes append to the same file, so only the parent compacts
+        if compact and lines > 2 * len(self._by_id) + 100:
+            self.compact()
+        self._fh = open(path, "a", encoding="utf-8")
+        # Files older than this were not written by the current run
+        self.opened_at = time.time()
+        self._read_offset = path.stat().st_size
+
+    def _index(self, entry: dict) -> None:
+        if entry.get("deleted"):
+            old = self._by_id.pop(entry["id"], None)
+            if old is not None and self._by_path.get(old["path"]) == entry["id"]:
+                del self._by_path[old["path"]]
+            # A copy found bad must not satisfy dedup either
+            if entry.get("invalid"):
+                self._shas.discard(entry.get("sha256"))
+            return
+        self._by_id[entry["id"]] = entry
+        self._by_path[entry["path"]] = entry["id"]
+        self._shas.add(entry["sha256"])
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def lookup(self, doc_id: str | None) -> dict | None:
+        return self._by_id.get(doc_id)
+
+    def is_current(self, doc: dict) -> bool:
+        """
+        True when the stored copy matches the listed revisionNo and, when both
+        sides carry one, lastUpdate.updatedAt
+        """
+        entry = self._by_id.get(doc.get("id"))
+        if entry is None or entry.get("revisionNo") != doc.get("revisionNo"):
+            return False
+        updated_at = doc.get("lastUpdate", {}).get("updatedAt")
+        return not (updated_at and entry.get("updatedAt") and entry["updatedAt"] != updated_at)
+
+    def entries(self, doc_type: str | None = None, company_id: str | None = None) -> list[dict]:
+        return [
+            e for e in self._by_id.values()
+            if (doc_type is None or e.get("docType") == doc_type)
+            and (company_id is None or e.get("companyId") == company_id)
+        ]
+
+    def has_blob(self, sha256: str) -> bool:
+        return sha256 in self._shas
+
+    def owner_of(self, relpath: str) -> str | None:
+        return self._by_path.get(relpath)
+
+    def refresh(self) -> None:
+        """
+        Indexes the lines other shard processes appended since the last read
+        (re-reading this process' own lines is harmless)
+        """
+        with self._lock:
+            with open(self.path, "rb") as f:
+                f.seek(self._read_offset)
+                chunk = f.read()
+            # A line still being written by another process is left for later
+            complete = chunk[:chunk.rfind(b"\n") + 1]
+            self._read_offset += len(complete)
+            for line in complete.decode("utf-8").splitlines():
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self._index(entry)
+
+    def claim(self, relpath: str, doc_id: str) -> bool:
+        """
+        Reserves `relpath` for `doc_id` before its fetch, so concurrent
+        workers downloading documents that share a fileName cannot both
+        target it. False when another id already holds the path
+        """
+        with self._lock:
+            if self._by_path.get(relpath, doc_id) != doc_id:
+                return False
+            self._by_path[relpath] = doc_id
+            return True
+
+    def release(self, relpath: str, doc_id: str) -> None:
+        """
+        Drops a claim whose download failed, unless the path holds a copy
+        recorded for `doc_id`
+        """
+        with self._lock:
+            entry = self._by_id.get(doc_id)
+            if self._by_path.get(relpath) == doc_id and (entry is None or entry["path"] != relpath):
+                del self._by_path[relpath]
+
+    def record(self, doc: dict, sha256: str, size: int, relpath: str) -> dict:
+        entry = {
+            "id": doc.get("id"),
+            "revisionNo": doc.get("revisionNo"),
+            "sha256": sha256,
+            "size": size,
+            "mimeType": doc.get("mimeType"),
+            "fileName": doc.get("fileName"),
+            "path": relpath,
+            "docType": doc.get("docType"),
+            "companyId": doc.get("companyId"),
+            "updatedAt": doc.get("lastUpdate", {}).get("updatedAt"),
+        }
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock:
+            self._index(entry)
+            self._fh.write(line + "\n")
+            self._fh.flush()
+        return entry
+
+    def record_deletion(self, entry: dict) -> None:
+        line = json.dumps({**entry, "deleted": True, "deletedAt": time.strftime("%Y-%m-%d %H:%M:%S")}, ensure_ascii=False)
+        with self._lock:
+            self._index({"id": entry["id"], "deleted": True})
+            self._fh.write(line + "\n")
+            self._fh.flush()
+
+    def forget(self, entry: dict, reason: str) -> None:
+        """
+        Drops a stored copy that failed verification, so the next run fetches it again
+        """
+        tombstone = {**entry, "deleted": True, "invalid": reason, "deletedAt": time.strftime("%Y-%m-%d %H:%M:%S")}
+        line = json.dumps(tombstone, ensure_ascii=False)
+        with self._lock:
+            self._index(tombstone)
+            self._fh.write(line + "\n")
+            self._fh.flush()
+
+    def compact(self) -> None:
+        tmp_path = self.path.with_suffix(".jsonl.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in self._by_id.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def close(self) -> None:
+        with self._lock:
+            self._fh.close()
+
+
+class DocumentJournal:
+    """
+    Per-document work queue in SQLite (WAL mode), one file shared by every
+    shard and process of a run: id -> shard, state (pending / in_flight /
+    done / failed), attempts, last error, bytes, sha256 and the listed item,
+    so failed documents can be retried without relisting. Writes are
+    buffered and committed in batches of `batch_size` or every `flush_sec`
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS documents (
+            id TEXT PRIMARY KEY,
+            shard TEXT,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            bytes INTEGER,
+            sha256 TEXT,
+            item TEXT,
+            updated_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS documents_shard_state ON documents (shard, state);
+    """
+
+    def __init__(self, path: Path, batch_size: int = 200, flush_sec: float = 2.0) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_sec = flush_sec
+        self._lock = threading.Lock()
+        self._ops: list[tuple[str, tuple]] = []
+        self._flushed_at = time.monotonic()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._states: dict[str, str] = dict(self._conn.execute("SELECT id, state FROM documents"))
+
+    def _queue(self, sql: str, params: tuple) -> None:
+        with self._lock:
+            self._ops.append((sql, params))
+            due = len(self._ops) >= self.batch_size or time.monotonic() - self._flushed_at >= self.flush_sec
+        if due:
+            self.flush()
+
+    def state(self, doc_id: str | None) -> str | None:
+        return self._states.get(doc_id)
+
+    def enqueue(self, items: Iterable[dict], shard: str) -> None:
+        """
+        Records listed items as pending; a known id keeps its state and only
+        has its item refreshed
+        """
+        now = time.strftime("%Y-%m-%d %H:%M:%S")
+        for item in items:
+            doc_id = item.get("id")
+            if doc_id is None:
+                continue
+            self._states.setdefault(doc_id, "pending")
+            item_json = json.dumps({k: v for k, v in item.items() if k != "fileContent"}, ensure_ascii=False)
+            self._queue(
+                "INSERT INTO documents (id, shard, item, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET shard = excluded.shard, item = excluded.item",
+                (doc_id, shard, item_json, now)
+            )
+
+    def start(self, doc_id: str | None) -> None:
+        if doc_id is None:
+            return
+        self._states[doc_id] = "in_flight"
+        self._queue(
+            "UPDATE documents SET state = 'in_flight', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+            (time.strftime("%Y-%m-%d %H:%M:%S"), doc_id)
+        )
+
+    def finish(
+        self,
+        doc_id: str | None,
+        outcome: str,
+        error: str | None = None,
+        size: int | None = None,
+        sha256: str | None = None
+    ) -> None:
+        """
+        Settles a document from download_document's outcome: "downloaded" and
+        "skipped" are done, anything else failed with `error`
+        """
+        if doc_id is None:
+            return
+        state = "failed" if outcome == "failed" else "done"
+        self._states[doc_id] = state
+        self._queue(
+            "UPDATE documents SET state = ?, last_error = ?, bytes = COALESCE(?, bytes), "
+            "sha256 = COALESCE(?, sha256), updated_at = ? WHERE id = ?",
+            (state, error if state == "failed" else None, size, sha256, time.strftime("%Y-%m-%d %H:%M:%S"), doc_id)
+        )
+
+    def requeue(self, doc_id: str, shard: str, item: dict, error: str) -> None:
+        """
+        Marks a document failed (creating its row from `shard` / `item` when
+        the journal never saw it) so --retry-failed fetches it again
+        """
+        self._states[doc_id] = "failed"
+        self._queue(
+            "INSERT INTO documents (id, shard, state, last_error, item, updated_at) VALUES (?, ?, 'failed', ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET state = 'failed', last_error = excluded.last_error, "
+            "bytes = NULL, sha256 = NULL, updated_at = excluded.updated_at",
+            (doc_id, shard, error, json.dumps(item, ensure_ascii=False), time.strftime("%Y-%m-%d %H:%M:%S"))
+        )
+
+    def failed_items(self, shard: str) -> list[dict]:
+        self.flush()
+        rows = self._conn.execute(
+            "SELECT item FROM documents WHERE shard = ? AND state = 'failed' AND item IS NOT NULL ORDER BY rowid",
+            (shard,)
+        )
+        return [json.loads(item) for (item,) in rows]
+
+    def counts(self, shard: str) -> dict[str, int]:
+        self.flush()
+        rows = self._conn.execute("SELECT state, COUNT(*) FROM documents WHERE shard = ? GROUP BY state", (shard,))
+        return dict(rows)
+
+    def flush(self) -> None:
+        with self._lock:
+            ops, self._ops = self._ops, []
+            self._flushed_at = time.monotonic()
+            if not ops:
+                return
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, params in ops:
+                    self._conn.execute(sql, params)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+
+class JournalSink:
+    """
+    observe_pages sink that enqueues every listed item of `shard` as pending;
+    items of a resumed listing (`replay`) the journal has never seen are
+    enqueued up front
+    """
+
+    def __init__(self, journal: DocumentJournal, shard: str, replay: Iterable[dict] = ()) -> None:
+        self.journal = journal
+        self.shard = shard
+        self.journal.enqueue((item for item in replay if journal.state(item.get("id")) is None), shard)
+
+    def write_page(self, items: list[dict]) -> None:
+        self.journal.enqueue(items, self.shard)
+
+    def close(self) -> None:
+        self.journal.flush()
+
+
+class SegmentStore:
+    """
+    Packed document storage (UNIT4_DOCS_LAYOUT=packed): contents are
+    appended to large segment files under docs/segments/ and located through
+    index.jsonl (id -> segment, offset, length, sha256; the latest line per
+    id wins). Each process appends to its own segments, rolling over at
+    `segment_bytes`, and identical contents are stored once. Reads are
+    zero-copy slices of an mmap of the segment
+    """
+
+    def __init__(self, root: Path, segment_bytes: int = 1024 * 1024 * 1024) -> None:
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._by_id: dict[str, dict] = {}
+        self._by_sha: dict[str, dict] = {}
+        self._maps: dict[str, mmap.mmap] = {}
+        self.index_path = root / "index.jsonl"
+        if self.index_path.exists():
+            for entry in iter_jsonl_items(self.index_path):
+                if entry.get("invalid"):
+                    self._by_id.pop(entry["id"], None)
+                    self._by_sha.pop(entry["sha256"], None)
+                    continue
+                self._by_id[entry["id"]] = entry
+                self._by_sha.setdefault(entry["sha256"], entry)
+        self._writer = f"{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}"
+        self._serial = 0
+        self._segment: str | None = None
+        self._fh = None
+        self._index_fh = open(self.index_path, "a", encoding="utf-8")
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def lookup(self, doc_id: str | None) -> dict | None:
+        return self._by_id.get(doc_id)
+
+    @staticmethod
+    def relpath(entry: dict) -> str:
+        """
+        Manifest `path` of a packed document: segments/<segment>#<offset>
+        """
+        return f"segments/{entry['segment']}#{entry['offset']}"
+
+    def _open_segment(self) -> None:
+        if self._fh is not None:
+            self._fh.close()
+        self._serial += 1
+        self._segment = f"seg-{self._writer}-{self._serial:04d}.bin"
+        self._fh = open(self.root / self._segment, "ab")
+
+    def put(self, doc_id: str, sha256: str, size: int, tmp_path: Path | None = None, data: bytes | None = None) -> tuple[dict, bool]:
+        """
+        Appends a document from `data` or a complete temp file (which is
+        removed) and indexes it. Returns (index entry, stored) where stored is
+        False if an identical content was already packed
+        """
+        with self._lock:
+            existing = self._by_sha.get(sha256)
+            stored = existing is None
+            if stored:
+                if self._fh is None or self._fh.tell() + size > self.segment_bytes:
+                    self._open_segment()
+                offset = self._fh.tell()
+                if data is not None:
+                    self._fh.write(data)
+                else:
+                    with open(tmp_path, "rb") as src:
+                        shutil.copyfileobj(src, self._fh, 1024 * 1024)
+                self._fh.flush()
+                segment = self._segment
+            else:
+                segment, offset = existing["segment"], existing["offset"]
+            entry = {"id": doc_id, "segment": segment, "offset": offset, "length": size, "sha256": sha256}
+            self._by_id[doc_id] = entry
+            self._by_sha.setdefault(sha256, entry)
+            self._index_fh.write(json.dumps(entry) + "\n")
+            self._index_fh.flush()
+        if tmp_path is not None:
+            tmp_path.unlink(missing_ok=True)
+        return entry, stored
+
+    def forget(self, doc_id: str) -> None:
+        """
+        Unindexes a packed copy that failed verification; its bytes stay in
+        the segment as dead space and identical content is packed anew
+        """
+        with self._lock:
+            entry = self._by_id.pop(doc_id, None)
+            if entry is None:
+                return
+            self._by_sha.pop(entry["sha256"], None)
+            self._index_fh.write(json.dumps({"id": doc_id, "sha256": entry["sha256"], "invalid": True}) + "\n")
+            self._index_fh.flush()
+
+    def read(self, doc_id: str) -> memoryview:
+        """
+        Zero-copy view of a packed document (valid until close())
+        """
+        entry = self._by_id[doc_id]
+        with self._lock:
+            m = self._maps.get(entry["segment"])
+            if m is None or len(m) < entry["offset"] + entry["length"]:
+                with open(self.root / entry["segment"], "rb") as f:
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[entry["segment"]] = m
+        return memoryview(m)[entry["offset"]:entry["offset"] + entry["length"]]
+
+    def export(self, manifest: DocumentManifest, dest: Path) -> int:
+        """
+        Rebuilds the by-name layout under `dest` (<docType>_docs/<fileName>,
+        prefixed with the companyId when there are several) from the packed
+        documents in `manifest`. Returns the number of files written
+        """
+        entries = [e for e in manifest.entries() if e["id"] in self._by_id]
+        single_company = len({e.get("companyId") for e in entries}) <= 1
+        written = 0
+        for entry in entries:
+            folder = f"{(entry.get('docType') or 'unknown').lower()}_docs"
+            if not single_company:
+                folder = f"{(entry.get('companyId') or 'unknown').lower()}_{folder}"
+            name = (entry.get("fileName") or f"{entry['id']}.bin").replace("/", "_").replace("\\", "_")
+            path = dest / folder / name
+            if path.exists():
+                path = path.with_name(f"{path.stem}__{entry['id']}{path.suffix}")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(self.read(entry["id"]))
+            written += 1
+        return written
+
+    def close(self) -> None:
+        with self._lock:
+            for m in self._maps.values():
+                m.close()
+            self._maps.clear()
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+            self._index_fh.close()
+
+
+def write_temp_file(directory: Path, binary: bytes) -> Path:
+    fd, tmp_name = tempfile.mkstemp(prefix=".unit4-", suffix=".part", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(binary)
+        os.chmod(tmp_name, 0o644)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+    return Path(tmp_name)
+
+
+def inspect_legacy_file(path: Path, mime_type: str | None, chunk_size: int = 1024 * 1024) -> tuple[str, int] | None:
+    """
+    Hashes a by-name file no manifest entry owns (a tree written before the
+    manifest / journal existed) so it can be adopted instead of fetched
+    again. Returns (sha256, size), or None when it is empty or does not
+    start with the magic bytes of `mime_type` (see MAGIC_BYTES)
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        head = f.read(chunk_size)
+        magic = MAGIC_BYTES.get((mime_type or "").lower())
+        if not head or (magic and not head.startswith(magic)):
+            return None
+        while head:
+            digest.update(head)
+            size += len(head)
+            head = f.read(chunk_size)
+    return digest.hexdigest(), size
+
+
+def place_document(
+    tmp_path: Path,
+    sha256: str,
+    filepath: Path,
+    docs_root: Path,
+    content_addressed: bool = False,
+    manifest: DocumentManifest | None = None,
+    doc_id: str | None = None,
+    overwrite: bool = True
+) -> tuple[Path, bool]:
+    """
+    Moves a complete temp file to its final location with an atomic rename:
+    `filepath` for the by-name layout or docs/<sha[:2]>/<sha> when content
+    addressed. Without `overwrite` a by-name file that appeared meanwhile
+    (another shard process storing the same fileName) is kept and the
+    document lands on <stem>__<doc_id> instead.
+    Returns (final path, stored) where stored is False if an identical blob
+    was already present
+    """
+    if not content_addressed:
+        if not overwrite:
             try:
-                rate_limiter.wait(metrics)
-                response, latency_ms = make_request(url, params, auth, timeout=180)
+                # O_EXCL placeholder: creating the name is the cross-process claim
+                os.close(os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                filepath = filepath.with_name(f"{filepath.stem}__{doc_id}{filepath.suffix}")
+        os.replace(tmp_path, filepath)
+        return filepath, True
+
+    blob = docs_root / sha256[:2] / sha256
+    if (manifest is not None and manifest.has_blob(sha256)) or blob.exists():
+        tmp_path.unlink(missing_ok=True)
+        return blob, False
+    blob.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(tmp_path, blob)
+    return blob, True
+
+
+def download_document(
+    idx: int,
+    total_docs: int,
+    doc: dict,
+    output_dir: str = ".",
+    auth: HTTPBasicAuth = None,
+    base_url: str = None,
+    max_retries: int = 3,
+    timeout: float = 180,
+    rate_limiter: RateLimiter | None = None,
+    metrics: dict | None = None,
+    session: requests.Session | None = None,
+    stream: bool = False,
+    chunk_size: int = 256 * 1024,
+    manifest: DocumentManifest | None = None,
+    content_addressed: bool = False,
+    docs_root: Path | None = None,
+    budget: MemoryBudget | None = None,
+    telemetry: Telemetry | None = None,
+    company_id: str | None = None,
+    journal: DocumentJournal | None = None,
+    store: SegmentStore | None = None,
+    timeouts: AdaptiveTimeouts | None = None
+) -> str:
+    """
+    Downloads a single document; safe to call from several worker threads.
+    With stream=True the body is decoded straight to disk (bounded memory);
+    otherwise it is read within `budget`, and a body over budget (or RSS
+    pressure) downgrades that document to the streaming path.
+    Files land under `output_dir` by name, or under `docs_root` by sha256
+    when content_addressed, or appended to `store` when packed; either way
+    the result is recorded in `manifest`.
+    With `timeouts` each attempt gets a timeout sized from observed latency
+    and the previous size of the document, and a slow fetch may be hedged.
+    The attempt, its outcome and the last error are recorded in `journal`;
+    with one, an existing file is only trusted once the journal marked it done.
+    Returns "downloaded", "skipped" or "failed"
+    """
+    rate_limiter = rate_limiter or RateLimiter()
+    budget = budget or MemoryBudget()
+    docs_root = docs_root or Path(output_dir)
+    b64 = doc.get("fileContent", "").strip()
+    streamed = None
+    filename = doc.get("fileName", f"document_{idx}.bin")
+    filename = filename.replace("/", "_").replace("\\", "_")
+    doc_id = doc.get("id")
+    filepath = Path(output_dir) / filename
+    prefix = f"  [{idx}/{total_docs or '?'}] {filename}"
+    last_error = None
+
+    claimed = None
+
+    def settle(outcome: str, size: int | None = None, sha256: str | None = None) -> str:
+        if claimed is not None and outcome == "failed":
+            manifest.release(claimed, doc_id)
+        if journal is not None:
+            journal.finish(doc_id, outcome, last_error, size, sha256)
+        return outcome
+
+    if manifest is not None and manifest.is_current(doc):
+        print(f"{prefix} SKIP (in manifest)")
+        incr_metric(metrics, "files_skipped")
+        return settle("skipped")
+
+    overwrite = True
+    if not content_addressed and store is None:
+        legacy = False
+        if filepath.exists() and filepath.stat().st_size > 0:
+            relpath = relative_to_root(filepath, docs_root)
+            owner = manifest.owner_of(relpath) if manifest else None
+            if owner is None and manifest is not None:
+                # Another shard process may have stored it under this name
+                manifest.refresh()
+                owner = manifest.owner_of(relpath)
+            if owner is None and manifest is None and (journal is None or journal.state(doc_id) == "done"):
+                print(f"{prefix} SKIP (already exists)")
+                incr_metric(metrics, "files_skipped")
+                return settle("skipped")
+            # No document owns it and it predates this run (e.g. written
+            # before the manifest existed): adopted when it looks like the
+            # listed mimeType, otherwise replaced in place, never duplicated
+            legacy = owner is None and (manifest is None or filepath.stat().st_mtime < manifest.opened_at)
+            adopted = inspect_legacy_file(filepath, doc.get("mimeType")) if legacy and manifest is not None else None
+            if adopted is not None and manifest.claim(relpath, doc_id):
+                sha256, size = adopted
+                manifest.record(doc, sha256, size, relpath)
+                print(f"{prefix} ADOPT (existing file, {size / 1024:.1f} KB)")
+                incr_metric(metrics, "files_adopted")
+                return settle("skipped", size, sha256)
+        if manifest is not None:
+            # Claimed before the fetch: another worker may be storing the same fileName
+            if not manifest.claim(relative_to_root(filepath, docs_root), doc_id):
+                filepath = filepath.with_name(f"{filepath.stem}__{doc_id}{filepath.suffix}")
+                manifest.claim(relative_to_root(filepath, docs_root), doc_id)
+                legacy = False
+            claimed = relative_to_root(filepath, docs_root)
+        # Otherwise only a path this document was recorded at may be replaced;
+        # any other file there may belong to a concurrent writer of this run
+        known = manifest.lookup(doc_id) if manifest is not None else None
+        overwrite = legacy or (known is not None and known["path"] == relative_to_root(filepath, docs_root))
 
-                if metrics is not None:
-                    metrics["requests_total"] = metrics.get("requests_total", 0) + 1
-                    metrics["latency_ms_total"] = metrics.get("latency_ms_total", 0) + latency_ms
+    if journal is not None:
+        journal.start(doc_id)
+
+    if not b64 and auth and base_url:
+        company_id = doc.get("companyId") or company_id
+        params = {
+            "companyId": company_id,
+            "indexes": company_id,
+            "id": doc_id,
+            "withFileContent": True,
+        }
+
+        stream_body = stream
+        # Base64 body of the stored revision, if any: a hint for the timeout
+        known = manifest.lookup(doc_id) if manifest is not None else None
+        expected_bytes = known["size"] * 4 // 3 if known else None
+        for attempt in range(max_retries):
+            try:
+                budget.check_run(metrics)
+                with stage_span(telemetry, "throttle"):
+                    rate_limiter.wait(metrics)
+                if timeouts is None:
+                    response, latency_ms = make_request(
+                        base_url, params, auth, timeout=timeout, session=session, stream=True,
+                        telemetry=telemetry, endpoint="content"
+                    )
+                else:
+                    request_timeout = timeouts.timeout("content", expected_bytes, attempt)
+                    delay = timeouts.hedge_delay("content")
+                    if delay is None:
+                        response, latency_ms = make_request(
+                            base_url, params, auth, timeout=request_timeout, session=session, stream=True,
+                            telemetry=telemetry, endpoint="content"
+                        )
+                    else:
+                        response, latency_ms = hedged_request(
+                            base_url, params, auth, timeouts, request_timeout, delay, rate_limiter,
+                            session=session, metrics=metrics, telemetry=telemetry
+                        )
+                    timeouts.observe("content", latency_ms)
+                rate_limiter.observe(response.status_code, latency_ms)
+                incr_metric(metrics, "requests_total")
 
                 if response.status_code == 429:
-                    if metrics is not None:
-                        metrics["http_429"] = metrics.get("http_429", 0) + 1
+                    response.close()
+                    incr_metric(metrics, "http_429")
                     retry_after = response.headers.get("Retry-After")
                     wait_sec = float(retry_after) if retry_after else backoff_seconds(attempt)
-                    print(f"  ⚠ Rate limited on page {page} (wait {wait_sec:.1f}s)")
+                    print(f"{prefix} RATE-LIMIT (wait {wait_sec:.1f}s)")
+                    last_error = "http 429"
+                    rate_limiter.pause(wait_sec)
                     sleep_with_metrics(wait_sec, metrics)
-                    record_failure_and_maybe_break(metrics)
+                    record_failure_and_maybe_break(metrics, rate_limiter=rate_limiter)
                     continue
 
                 if response.status_code >= 500:
-                    if metrics is not None:
-                        metrics["http_5xx"] = metrics.get("http_5xx", 0) + 1
+                    response.close()
+                    incr_metric(metrics, "http_5xx")
                     wait_sec = backoff_seconds(attempt)
-                    print(f"  ⚠ Server error on page {page} (wait {wait_sec:.1f}s)")
+                    print(f"{prefix} SERVER-ERR (wait {wait_sec:.1f}s)")
+                    last_error = f"http {response.status_code}"
+                    rate_limiter.pause(wait_sec)
                     sleep_with_metrics(wait_sec, metrics)
-                    current_limit = max(min_limit, current_limit // 2)
-                    record_failure_and_maybe_break(metrics)
+                    record_failure_and_maybe_break(metrics, rate_limiter=rate_limiter)
                     continue
 
-                if not validate_response(response):
-                    if metrics is not None:
-                        metrics["http_other"] = metrics.get("http_other", 0) + 1
-                    print(f"  ✗ Page {page} failed (status {response.status_code})")
-                    record_failure_and_maybe_break(metrics)
-                    return None
-
-                data = response.json()
-                items = data.get("items", [])
-                total = data.get("total", 0)
-                count = len(items)
-
-                if count == 0:
-                    print(f"  ✓ Page {page}: No more documents (total collected: {len(all_items)})")
-                    return all_items
-
-                all_items.extend(items)
-                if items_path is not None:
-                    append_jsonl_items(items_path, items)
+                if not validate_response(response, budget, metrics):
+                    incr_metric(metrics, "http_other")
+                    print(f"{prefix} FAIL (status {response.status_code})")
+                    last_error = f"http {response.status_code}"
+                    sleep_with_metrics(2, metrics)
+                    record_failure_and_maybe_break(metrics, rate_limiter=rate_limiter)
+                    continue
 
-                print(f"  ✓ Page {page}: {count} docs | Total so far: {len(all_items)}/{total} | Latency: {latency_ms}ms")
+                if not stream_body:
+                    try:
+                        budget.admit(response, metrics)
+                        if budget.under_pressure(metrics):
+                            raise BudgetExceeded("rss", f"RSS over {budget.max_rss_mb} MB")
+                    except BudgetExceeded as e:
+                        if e.reason == "run":
+                            raise
+                        print(f"{prefix} BUDGET ({e}), streaming to disk")
+                        incr_metric(metrics, "budget_downgrades")
+                        stream_body = True
 
-                start += count
-                page += 1
+                if stream_body:
+                    tmp_dir = docs_root if content_addressed or store is not None else filepath.parent
+                    with stage_span(telemetry, "stream_to_disk"):
+                        streamed = stream_document_to_temp(
+                            response, tmp_dir, chunk_size=chunk_size, budget=budget, metrics=metrics
+                        )
+                else:
+                    with stage_span(telemetry, "http_body"):
+                        body = b"".join(budget.iter_content(response, chunk_size, metrics, cap=budget.max_response_bytes))
+                    with stage_span(telemetry, "json_parse"):
+                        response_data = json.loads(body)
+                    del body
+                    items = response_data.get("items", [])
+                    if items:
+                        b64 = items[0].get("fileContent", "").strip()
 
-                if checkpoint_path is not None:
-                    save_checkpoint(checkpoint_path, {
-                        "start": start,
-                        "total": total,
-                        "collected": len(all_items),
-                        "updatedAt": time.strftime("%Y-%m-%d %H:%M:%S")
-                    })
+                if not b64 and streamed is None:
+                    print(f"{prefix} FAIL (no fileContent)")
+                    last_error = "no fileContent"
+                    sleep_with_metrics(2, metrics)
+                    continue
 
                 record_success(metrics)
                 break
 
+            except BudgetExceeded as e:
+                last_error = f"budget: {e}"
+                if e.reason == "run":
+                    print(f"{prefix} BUDGET ({e})")
+                    break
+                # Body grew past the cap while reading (no Content-Length): stream it next time
+                print(f"{prefix} BUDGET ({e}), retrying streamed")
+                incr_metric(metrics, "budget_downgrades")
+                stream_body = True
             except requests.exceptions.Timeout:
+                rate_limiter.observe(None)
+                if timeouts is not None:
+                    timeouts.observe("content", int(request_timeout * 1000))
+                last_error = "timeout"
                 if attempt < max_retries - 1:
-                    wait_time = 5 * (attempt + 1)
-                    print(f"  ⚠ Timeout on page {page}, retry {attempt + 1}/{max_retries} (waiting {wait_time}s)...")
-                    if metrics is not None:
-                        metrics["timeouts"] = metrics.get("timeouts", 0) + 1
-                    sleep_with_metrics(wait_time, metrics)
-                    current_limit = max(min_limit, current_limit // 2)
-                    record_failure_and_maybe_break(metrics)
+                    print(f"{prefix} TIMEOUT (retry {attempt + 1}/{max_retries})")
+                    incr_metric(metrics, "timeouts")
+                    sleep_with_metrics(backoff_seconds(attempt), metrics)
+                    record_failure_and_maybe_break(metrics, rate_limiter=rate_limiter)
                     continue
-                print(f"  ✗ Max retries exceeded for page {page}")
-                return None
+                print(f"{prefix} TIMEOUT (max retries)")
             except Exception as e:
-                print(f"  ✗ Error on page {page}: {e}")
-                record_failure_and_maybe_break(metrics)
-                return None
-    return all_items
+                print(f"{prefix} FAIL ({e})")
+                last_error = str(e)
+                sleep_with_metrics(2, metrics)
+                record_failure_and_maybe_break(metrics, rate_limiter=rate_limiter)
 
+        if not b64 and streamed is None:
+            return settle("failed")
 
-# -----------------------------
-# MAIN
-# -----------------------------
-def main() -> int:
-    base = os.environ["UNIT4_BASE"].rstrip("/")
-    user = os.environ.get("UNIT4_USER")
-    pwd = os.environ.get("UNIT4_PASS")
-    min_interval = float(os.environ.get("UNIT4_MIN_INTERVAL", "0.25"))
-    max_retries = int(os.environ.get("UNIT4_MAX_RETRIES", "3"))
-    limit = int(os.environ.get("UNIT4_LIMIT", "50"))
-    output_root = Path(os.environ.get("UNIT4_OUT_DIR", "artifacts"))
+    if not b64 and streamed is None:
+        print(f"{prefix} SKIP (no fileContent)")
+        last_error = "no fileContent"
+        return settle("failed")
 
-    if not user or not pwd:
-        print("Faltan UNIT4_USER / UNIT4_PASS")
-        return 2
+    try:
+        if streamed is None:
+            with stage_span(telemetry, "b64_decode"):
+                b64_clean = re.sub(r"^data:.*;base64,", "", b64)
+                binary = base64.b64decode(b64_clean)
 
-    url = f"{base}/documents"
-    auth = HTTPBasicAuth(user, pwd)
-
-    docs_root = output_root / "docs"
-    csv_root = output_root / "csv"
-    json_root = output_root / "json"
-    metrics_root = output_root / "metrics"
-    checkpoints_root = output_root / "checkpoints"
-    items_root = output_root / "items"
-    logs_root = output_root / "logs"
-
-    for p in (docs_root, csv_root, json_root, metrics_root, checkpoints_root, items_root, logs_root):
-        p.mkdir(parents=True, exist_ok=True)
-
-    doc_types = [
-        ("REPINV", "repinv_docs"),
-        ("REPTEC", "reptec_docs"),
-    ]
-
-    for doc_type, output_folder in doc_types:
-        print(f"\n{'='*60}")
-        print(f"Downloading ALL {doc_type} documents to {output_folder}/")
-        print(f"{'='*60}\n")
-
-        rate_limiter = RateLimiter(min_interval_sec=min_interval)
-        metrics = {
-            "docType": doc_type,
-            "outputFolder": output_folder,
-            "startTime": time.strftime("%Y-%m-%d %H:%M:%S"),
-            "minIntervalSec": min_interval,
-            "maxRetries": max_retries,
-            "limit": limit
-        }
+            with stage_span(telemetry, "sha256"):
+                sha256 = hashlib.sha256(binary).hexdigest()
+            size = len(binary)
+            with stage_span(telemetry, "disk_write"):
+                if store is not None:
+                    packed, stored = store.put(doc_id, sha256, size, data=binary)
+                    final_path = docs_root / SegmentStore.relpath(packed)
+                elif content_addressed and manifest is not None and manifest.has_blob(sha256):
+                    final_path, stored = docs_root / sha256[:2] / sha256, False
+                else:
+                    tmp_path = write_temp_file(docs_root if content_addressed else filepath.parent, binary)
+                    final_path, stored = place_document(
+                        tmp_path, sha256, filepath, docs_root, content_addressed, manifest, doc_id, overwrite
+                    )
+        elif store is not None:
+            tmp_path, sha256, size = streamed
+            with stage_span(telemetry, "disk_write"):
+                packed, stored = store.put(doc_id, sha256, size, tmp_path=tmp_path)
+            final_path = docs_root / SegmentStore.relpath(packed)
+        else:
+            tmp_path, sha256, size = streamed
+            with stage_span(telemetry, "disk_write"):
+                final_path, stored = place_document(
+                    tmp_path, sha256, filepath, docs_root, content_addressed, manifest, doc_id, overwrite
+                )
 
-        items_path = items_root / f"{output_folder}_items.jsonl"
-        checkpoint_path = checkpoints_root / f"{output_folder}_checkpoint.json"
-        metrics_path = metrics_root / f"{output_folder}_metrics.json"
-        docs_dir = docs_root / output_folder
+        if manifest is not None:
+            with stage_span(telemetry, "manifest"):
+                manifest.record(doc, sha256, size, relative_to_root(final_path, docs_root))
+            if claimed is not None and final_path != filepath:
+                manifest.release(claimed, doc_id)
+        size_kb = size / 1024
+        if stored:
+            print(f"{prefix} OK ({size_kb:.1f} KB)")
+        else:
+            print(f"{prefix} OK ({size_kb:.1f} KB, duplicate of {sha256[:12]})")
+            incr_metric(metrics, "files_deduplicated")
+        incr_metric(metrics, "files_downloaded")
+        incr_metric(metrics, "bytes_downloaded", size)
+        record_success(metrics)
+        return settle("downloaded", size, sha256)
+    except Exception as e:
+        print(f"{prefix} FAIL ({e})")
+        last_error = str(e)
+        incr_metric(metrics, "files_failed")
+        record_failure_and_maybe_break(metrics, rate_limiter=rate_limiter)
+        return settle("failed")
 
-        params_base = {
-            "companyId": "P2",
-            "indexes": "P2",
-            "docType": doc_type,
-            "withFileContent": False,
-        }
 
-        print("[step 1] Fetching metadata for all documents (no fileContent)...")
-        all_items = fetch_all_documents(
-            url,
-            params_base,
-            auth,
-            limit=limit,
-            max_retries=max_retries,
-            rate_limiter=rate_limiter,
-            metrics=metrics,
-            checkpoint_path=checkpoint_path,
-            items_path=items_path
-        )
+class DownloadScheduler:
+    """
+    Orders and time-boxes the download queue of a process. `order` is "api"
+    (listing order, stays lazy), "newest" (lastUpdate.updatedAt first),
+    "smallest" (size known from the manifest first; the listing carries no
+    size, so never-downloaded documents go last) or "mime" (position in
+    `mime_types`). With `mime_types` set, other mimeTypes are deferred.
+    Once `deadline` (epoch seconds) passes or `max_bytes` have been received
+    through `budget`, remaining documents are deferred instead of fetched;
+    they stay pending in the journal and are picked up by the next run
+    """
 
-        if all_items is None:
-            print(f"FAIL: Could not fetch {doc_type}")
-            metrics["endTime"] = time.strftime("%Y-%m-%d %H:%M:%S")
-            save_metrics(metrics_path, metrics)
-            continue
+    ORDERS = ("api", "newest", "smallest", "mime")
 
-        if not all_items:
-            print(f"No documents found for {doc_type}")
-            metrics["endTime"] = time.strftime("%Y-%m-%d %H:%M:%S")
-            save_metrics(metrics_path, metrics)
-            continue
+    def __init__(
+        self,
+        order: str = "api",
+        mime_types: Iterable[str] = (),
+        deadline: float | None = None,
+        max_bytes: int | None = None,
+        budget: MemoryBudget | None = None,
+        manifest: DocumentManifest | None = None
+    ) -> None:
+        if order not in self.ORDERS:
+            raise ValueError(f"unknown download order: {order}")
+        self.order_by = order
+        self.mime_types = [m.lower() for m in mime_types]
+        self.deadline = deadline
+        self.max_bytes = max_bytes or None
+        self.budget = budget
+        self.manifest = manifest
+        self._start_bytes = budget.received if budget is not None else 0
+        self._lock = threading.Lock()
+        self._deferred: list[dict] = []
 
-        print(f"\n[info] Total {doc_type} documents collected: {len(all_items)}\n")
+    def order(self, items: Iterable[dict]) -> Iterable[dict]:
+        if self.order_by == "api":
+            return items
+        docs = list(items)
+        if self.order_by == "newest":
+            # ISO timestamps sort as strings; undated documents ("") end up last
+            docs.sort(key=lambda d: d.get("lastUpdate", {}).get("updatedAt") or "", reverse=True)
+        elif self.order_by == "smallest":
+            def known_size(doc: dict) -> tuple[bool, int]:
+                entry = self.manifest.lookup(doc.get("id")) if self.manifest is not None else None
+                return (entry is None, entry["size"] if entry is not None else 0)
+            docs.sort(key=known_size)
+        else:
+            rank = {m: i for i, m in enumerate(self.mime_types)}
+            docs.sort(key=lambda d: rank.get((d.get("mimeType") or "").lower(), len(rank)))
+        return docs
 
-        response_data = {
-            "total": len(all_items),
-            "items": all_items
-        }
+    def stop_reason(self) -> str | None:
+        """
+        "deadline" or "bytes" once the run's time / byte budget is spent
+        """
+        if self.deadline is not None and time.time() >= self.deadline:
+            return "deadline"
+        if self.max_bytes is not None and self.budget is not None and self.budget.received - self._start_bytes >= self.max_bytes:
+            return "bytes"
+        return None
 
-        print("[step 2] Downloading file content for each document...")
-        if not download_documents(
-            response_data,
-            str(docs_dir),
+    def admit(self, doc: dict) -> str | None:
+        """
+        None when `doc` should be downloaded now, else the deferral reason
+        (which is recorded)
+        """
+        reason = self.stop_reason()
+        if reason is None and self.mime_types and (doc.get("mimeType") or "").lower() not in self.mime_types:
+            reason = "mime"
+        if reason is not None:
+            with self._lock:
+                self._deferred.append({
+                    "id": doc.get("id"),
+                    "fileName": doc.get("fileName"),
+                    "mimeType": doc.get("mimeType"),
+                    "updatedAt": doc.get("lastUpdate", {}).get("updatedAt"),
+                    "reason": reason,
+                })
+        return reason
+
+    def report(self, metrics: dict | None, path: Path | None = None) -> list[dict]:
+        """
+        Moves the documents deferred so far into `metrics` (counts by reason
+        and mimeType) and `path` (one JSON line each); returns them
+        """
+        with self._lock:
+            deferred, self._deferred = self._deferred, []
+        by_reason: dict[str, int] = {}
+        by_mime: dict[str, int] = {}
+        for doc in deferred:
+            by_reason[doc["reason"]] = by_reason.get(doc["reason"], 0) + 1
+            by_mime[doc["mimeType"] or "unknown"] = by_mime.get(doc["mimeType"] or "unknown", 0) + 1
+        update_metrics(metrics, {
+            "docs_deferred": len(deferred),
+            "deferred_by_reason": by_reason,
+            "deferred_by_mime": by_mime,
+        })
+        # Rewritten (or emptied) whenever there is something to say, so it never goes stale
+        if path is not None and (deferred or path.exists()):
+            tmp_path = path.with_name(f".{path.name}.part")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for doc in deferred:
+                    f.write(json.dumps(doc, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, path)
+        return deferred
+
+
+def parse_deadline(value: str, now: datetime | None = None) -> float | None:
+    """
+    UNIT4_DEADLINE as epoch seconds: "HH:MM" is the next such local time
+    (today or tomorrow), anything else an ISO datetime. Empty means none
+    """
+    value = value.strip()
+    if not value:
+        return None
+    now = now or datetime.now()
+    if re.fullmatch(r"\d{1,2}:\d{2}", value):
+        hour, minute = map(int, value.split(":"))
+        at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if at <= now:
+            at += timedelta(days=1)
+        return at.timestamp()
+    return datetime.fromisoformat(value).timestamp()
+
+
+def download_documents(
+    data: dict,
+    output_dir: str = ".",
+    auth: HTTPBasicAuth = None,
+    base_url: str = None,
+    max_retries: int = 3,
+    timeout: float = 180,
+    rate_limiter: RateLimiter | None = None,
+    metrics: dict | None = None,
+    workers: int = 1,
+    session: requests.Session | None = None,
+    stream: bool = False,
+    manifest: DocumentManifest | None = None,
+    content_addressed: bool = False,
+    docs_root: Path | None = None,
+    budget: MemoryBudget | None = None,
+    telemetry: Telemetry | None = None,
+    company_id: str | None = None,
+    journal: DocumentJournal | None = None,
+    store: SegmentStore | None = None,
+    scheduler: DownloadScheduler | None = None,
+    timeouts: AdaptiveTimeouts | None = None
+) -> bool:
+    """
+    Downloads document content either from fileContent or by fetching individually.
+    `data["items"]` may be a lazy iterable; pass `data["total"]` for progress.
+    With workers > 1 documents are fetched by a thread pool with at most
+    `workers` requests in flight, all drawing from the same rate limiter.
+    `scheduler` orders the queue and defers what does not fit its deadline /
+    byte budget; deferred documents do not count as failures
+    """
+    if not isinstance(data, dict) or "items" not in data:
+        print("FAIL: respuesta inesperada")
+        return False
+
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    items = data["items"]
+    total_docs = data["total"] if "total" in data else len(items)
+    rate_limiter = rate_limiter or RateLimiter()
+    workers = max(1, workers)
+    results = {"downloaded": 0, "skipped": 0, "failed": 0, "deferred": 0}
+    if scheduler is not None:
+        items = scheduler.order(items)
+
+    def run(idx: int, doc: dict) -> str:
+        return download_document(
+            idx,
+            total_docs,
+            doc,
+            output_dir,
             auth,
-            url,
+            base_url,
             max_retries=max_retries,
-            timeout=180,
+            timeout=timeout,
             rate_limiter=rate_limiter,
-            metrics=metrics
-        ):
-            print(f"FAIL: Could not download {doc_type}")
-            metrics["endTime"] = time.strftime("%Y-%m-%d %H:%M:%S")
-            save_metrics(metrics_path, metrics)
-            continue
+            metrics=metrics,
+            session=session,
+            stream=stream,
+            manifest=manifest,
+            content_addressed=content_addressed,
+            docs_root=docs_root,
+            budget=budget,
+            telemetry=telemetry,
+            company_id=company_id,
+            journal=journal,
+            store=store,
+            timeouts=timeouts
+        )
 
-        print("[step 3] Extracting and saving metadata...")
-        metadata = extract_metadata(response_data)
-        metadata_file = str(csv_root / f"{output_folder}_metadata.csv")
-        save_metadata_csv(metadata, metadata_file)
+    if workers == 1:
+        for idx, doc in enumerate(items, 1):
+            if scheduler is not None and scheduler.admit(doc) is not None:
+                results["deferred"] += 1
+                continue
+            results[run(idx, doc)] += 1
+    else:
+        print(f"[download] {workers} workers")
+        in_flight = threading.BoundedSemaphore(workers * 2)
+        results_lock = threading.Lock()
 
-        response_file = str(json_root / f"{output_folder}_response.json")
-        save_response_json(response_data, response_file)
+        def on_done(future) -> None:
+            in_flight.release()
+            try:
+                outcome = future.result()
+            except Exception as e:
+                print(f"  FAIL (worker error: {e})")
+                outcome = "failed"
+            with results_lock:
+                results[outcome] += 1
 
-        metrics["endTime"] = time.strftime("%Y-%m-%d %H:%M:%S")
-        save_metrics(metrics_path, metrics)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="unit4-dl") as pool:
+            for idx, doc in enumerate(items, 1):
+                if scheduler is not None and scheduler.admit(doc) is not None:
+                    with results_lock:
+                        results["deferred"] += 1
+                    continue
+                in_flight.acquire()
+                pool.submit(run, idx, doc).add_done_callback(on_done)
 
-        print(f"[smoke] PASS - All {doc_type} documents saved to {output_folder}/\n")
+    downloaded = results["downloaded"]
+    failed = results["failed"]
+    total_docs = total_docs or sum(results.values())
+    print(
+        f"\n[summary] Downloaded: {downloaded}/{total_docs}, Failed: {failed}"
+        + (f", Deferred: {results['deferred']}" if results["deferred"] else "")
+    )
+    return failed == 0
+
+
+# -----------------------------
+def extract_metadata(data: dict) -> Iterator[dict[str, Any]]:
+    """
+    Extracts metadata from API response items (excluding fileContent).
+    Lazy: `data["items"]` may be any iterable, e.g. iter_jsonl_items()
+    """
+    if not isinstance(data, dict) or "items" not in data:
+        return
+
+    for doc in data["items"]:
+        yield {
+            "id": doc.get("id"),
+            "fileName": doc.get("fileName"),
+            "mimeType": doc.get("mimeType"),
+            "docType": doc.get("docType"),
+            "companyId": doc.get("companyId"),
+            "status": doc.get("status"),
+            "revisionNo": doc.get("revisionNo"),
+            "updatedAt": doc.get("lastUpdate", {}).get("updatedAt"),
+            "updatedBy": doc.get("lastUpdate", {}).get("updatedBy"),
+        }
+
+
+def save_metadata_csv(metadata_list: Iterable[dict], filename: str) -> bool:
+    """
+    Saves metadata rows to CSV file, writing them as they are consumed
+    """
+    rows = iter(metadata_list)
+    first = next(rows, None)
+    if first is None:
+        print(f"No metadata to save for {filename}")
+        return False
+
+    try:
+        count = 1
+        with open(filename, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=first.keys())
+            writer.writeheader()
+            writer.writerow(first)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        print(f"✓ Metadata saved: {filename} ({count} rows)")
+        return True
+    except Exception as e:
+        print(f"Error saving metadata: {e}")
+        return False
+
+
+JSON_COMPRESSION_SUFFIX = {
+    None: "",
+    "gzip": ".gz",
+    "lzma": ".xz",
+}
+
+
+class ResponseJSONWriter:
+    """
+    Streams the `{start, items[], limit, count, total}` envelope to disk one
+    item at a time (fileContent stripped), optionally gzip / lzma compressed
+    and indented (2, like the original dump) or compact (indent=None).
+    count / total are written at close, after the items; the output goes to
+    a temp file that is renamed into place only then, so a crash never
+    leaves a truncated JSON behind
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        compression: str | None = None,
+        indent: int | None = 2,
+        replay: Iterable[dict] = (),
+        start: int = 0
+    ) -> None:
+        if compression not in JSON_COMPRESSION_SUFFIX:
+            raise ValueError(f"unsupported compression: {compression}")
+        self.path = path
+        self.indent = indent
+        self.count = 0
+        self._tmp_path = path.with_name(f".{path.name}.part")
+        if compression == "gzip":
+            self._fh = gzip.open(self._tmp_path, "wt", encoding="utf-8")
+        elif compression == "lzma":
+            self._fh = lzma.open(self._tmp_path, "wt", encoding="utf-8")
+        else:
+            self._fh = open(self._tmp_path, "w", encoding="utf-8")
+        if indent:
+            self._fh.write(f'{{\n  "start": {start},\n  "items": [')
+        else:
+            self._fh.write(f'{{"start":{start},"items":[')
+        for item in replay:
+            self.write_item(item)
+
+    def write_item(self, item: dict) -> None:
+        item_clean = {k: v for k, v in item.items() if k != "fileContent"}
+        if self.indent:
+            body = json.dumps(item_clean, indent=self.indent, ensure_ascii=False).replace("\n", "\n    ")
+            self._fh.write(("\n    " if self.count == 0 else ",\n    ") + body)
+        else:
+            body = json.dumps(item_clean, ensure_ascii=False, separators=(",", ":"))
+            self._fh.write(body if self.count == 0 else "," + body)
+        self.count += 1
+
+    def write_page(self, items: list[dict]) -> None:
+        for item in items:
+            self.write_item(item)
+
+    def close(self) -> None:
+        if self._fh is None:
+            return
+        n = self.count
+        if self.indent:
+            self._fh.write(("\n  " if n else "") + f'],\n  "limit": {n},\n  "count": {n},\n  "total": {n}\n}}\n')
+        else:
+            self._fh.write(f'],"limit":{n},"count":{n},"total":{n}}}')
+        self._fh.close()
+        self._fh = None
+        os.replace(self._tmp_path, self.path)
+        size_mb = self.path.stat().st_size / (1024 * 1024)
+        print(f"✓ Response JSON saved: {self.path} ({size_mb:.1f} MB)")
+
+
+def save_response_json(
+    data: dict,
+    filename: str,
+    compression: str | None = None,
+    indent: int | None = 2
+) -> bool:
+    """
+    Saves full API response to JSON file (excluding fileContent to keep size reasonable).
+    Items are streamed through ResponseJSONWriter, so `data["items"]` may be a lazy iterable
+    """
+    if not data or "items" not in data:
+        print(f"No data to save for {filename}")
+        return False
+
+    try:
+        writer = ResponseJSONWriter(
+            Path(filename),
+            compression=compression,
+            indent=indent,
+            replay=data["items"],
+            start=data.get("start", 0)
+        )
+        writer.close()
+        return True
+    except Exception as e:
+        print(f"Error saving response JSON: {e}")
+        return False
+
+
+def observe_pages(
+    pages: Iterable[list[dict]],
+    *sinks: Any
+) -> Iterator[list[dict]]:
+    """
+    Passes every page through to the consumer after handing it to each
+    sink's write_page(); sinks are closed when the listing ends, even on
+    failure, so whatever was enumerated stays readable
+    """
+    try:
+        for items in pages:
+            for sink in sinks:
+                sink.write_page(items)
+            yield items
+    finally:
+        for sink in sinks:
+            sink.close()
+
+
+class ParquetMetadataSink:
+    """
+    Writes typed metadata row groups page by page during enumeration:
+    parsed updatedAt, dictionary-encoded docType / mimeType / status,
+    file extension and, when the manifest already knows the document, size
+    and sha256. Written to a temp file and renamed on close; rewrite()
+    replays the listing once the downloads recorded size and sha256
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        manifest: DocumentManifest | None = None,
+        replay: Iterable[dict] = (),
+        batch_size: int = 500
+    ) -> None:
+        if pa is None:
+            raise RuntimeError("pyarrow is not installed (pip install pyarrow)")
+        self.path = path
+        self.manifest = manifest
+        self.rows = 0
+        self._tmp_path = path.with_name(f".{path.name}.part")
+        self._schema = pa.schema([
+            ("id", pa.string()),
+            ("fileName", pa.string()),
+            ("extension", pa.dictionary(pa.int32(), pa.string())),
+            ("mimeType", pa.dictionary(pa.int32(), pa.string())),
+            ("docType", pa.dictionary(pa.int32(), pa.string())),
+            ("companyId", pa.dictionary(pa.int32(), pa.string())),
+            ("status", pa.dictionary(pa.int32(), pa.string())),
+            ("revisionNo", pa.int32()),
+            ("updatedAt", pa.timestamp("ms")),
+            ("updatedBy", pa.string()),
+            ("size", pa.int64()),
+            ("sha256", pa.string()),
+        ])
+        self._writer = pq.ParquetWriter(self._tmp_path, self._schema, compression="zstd")
+        batch: list[dict] = []
+        for doc in replay:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                self.write_page(batch)
+                batch = []
+        self.write_page(batch)
+
+    @staticmethod
+    def _timestamp(value: str | None) -> datetime | None:
+        if not value:
+            return None
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return None
+
+    def write_page(self, items: list[dict]) -> None:
+        if not items or self._writer is None:
+            return
+        columns: dict[str, list] = {name: [] for name in self._schema.names}
+        for doc in items:
+            last_update = doc.get("lastUpdate", {})
+            stored = self.manifest.lookup(doc.get("id")) if self.manifest is not None else None
+            ext = re.search(r"\.(\w+)$", doc.get("fileName") or "")
+            columns["id"].append(doc.get("id"))
+            columns["fileName"].append(doc.get("fileName"))
+            columns["extension"].append(ext.group(1) if ext else None)
+            columns["mimeType"].append(doc.get("mimeType"))
+            columns["docType"].append(doc.get("docType"))
+            columns["companyId"].append(doc.get("companyId"))
+            columns["status"].append(doc.get("status"))
+            columns["revisionNo"].append(doc.get("revisionNo"))
+            columns["updatedAt"].append(self._timestamp(last_update.get("updatedAt")))
+            columns["updatedBy"].append(last_update.get("updatedBy"))
+            columns["size"].append(stored.get("size") if stored else None)
+            columns["sha256"].append(stored.get("sha256") if stored else None)
+        self._writer.write_table(pa.table(columns, schema=self._schema))
+        self.rows += len(items)
+
+    def close(self) -> None:
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._writer = None
+        os.replace(self._tmp_path, self.path)
+        print(f"✓ Parquet metadata saved: {self.path} ({self.rows} rows)")
+
+    @classmethod
+    def rewrite(cls, path: Path, manifest: DocumentManifest, items: Iterable[dict]) -> None:
+        """
+        Rewrites `path` from the listed `items` so size and sha256 reflect
+        what this run downloaded (the enumeration pass only knew earlier runs)
+        """
+        cls(path, manifest=manifest, replay=items).close()
+
+
+# -----------------------------
+# LISTING SUMMARY
+# -----------------------------
+class MetadataSummary:
+    """
+    Streaming counts of the listed metadata (the exploration notebook's
+    distributions: docType, companyId, status, mimeType, extension, revision,
+    year / month, updatedBy, filename prefix, plus the docType cross-tabs),
+    folded in page by page by fetch_all_documents and saved next to its
+    checkpoint. Summaries are plain counters, so shards and resumed runs
+    combine with merge() instead of re-reading the items
+    """
+
+    DIMENSIONS = (
+        "docType", "companyId", "status", "mimeType", "extension", "revisionNo",
+        "year", "yearMonth", "updatedBy", "namePrefix",
+    )
+    CROSSTABS = (("docType", "mimeType"), ("docType", "year"), ("docType", "status"), ("updatedBy", "docType"))
+    MISSING = "(none)"
+
+    def __init__(self, path: Path | None = None) -> None:
+        self.path = path
+        self.docs = 0
+        self.revision_total = 0
+        self.first_update: str | None = None
+        self.last_update: str | None = None
+        self.counts: dict[str, dict[str, int]] = {
+            name: {} for name in self.DIMENSIONS + tuple(f"{a}|{b}" for a, b in self.CROSSTABS)
+        }
+
+    def add(self, items: Iterable[dict]) -> None:
+        for doc in items:
+            last_update = doc.get("lastUpdate") or {}
+            updated_at = last_update.get("updatedAt") or ""
+            ext = re.search(r"\.(\w+)$", doc.get("fileName") or "")
+            prefix = re.match(r"^([A-Z0-9]+)", doc.get("fileName") or "")
+            dated = re.match(r"^(\d{4})-(\d{2})", updated_at)
+            values = {
+                "docType": doc.get("docType"),
+                "companyId": doc.get("companyId"),
+                "status": doc.get("status"),
+                "mimeType": doc.get("mimeType"),
+                "extension": ext.group(1) if ext else None,
+                "revisionNo": doc.get("revisionNo"),
+                "year": dated.group(1) if dated else None,
+                "yearMonth": f"{dated.group(1)}-{dated.group(2)}" if dated else None,
+                "updatedBy": last_update.get("updatedBy"),
+                "namePrefix": prefix.group(1) if prefix else None,
+            }
+            keys = {name: self.MISSING if value is None else str(value) for name, value in values.items()}
+            for name, key in keys.items():
+                counter = self.counts[name]
+                counter[key] = counter.get(key, 0) + 1
+            for a, b in self.CROSSTABS:
+                counter = self.counts[f"{a}|{b}"]
+                key = f"{keys[a]}|{keys[b]}"
+                counter[key] = counter.get(key, 0) + 1
+            self.docs += 1
+            if isinstance(doc.get("revisionNo"), int):
+                self.revision_total += doc["revisionNo"]
+            if updated_at:
+                # ISO timestamps compare correctly as strings
+                if self.first_update is None or updated_at < self.first_update:
+                    self.first_update = updated_at
+                if self.last_update is None or updated_at > self.last_update:
+                    self.last_update = updated_at
+
+    def merge(self, other: "MetadataSummary") -> "MetadataSummary":
+        self.docs += other.docs
+        self.revision_total += other.revision_total
+        for name, counter in other.counts.items():
+            mine = self.counts.setdefault(name, {})
+            for key, n in counter.items():
+                mine[key] = mine.get(key, 0) + n
+        if other.first_update and (self.first_update is None or other.first_update < self.first_update):
+            self.first_update = other.first_update
+        if other.last_update and (self.last_update is None or other.last_update > self.last_update):
+            self.last_update = other.last_update
+        return self
+
+    def top(self, name: str, n: int | None = 10) -> list[tuple[str, int]]:
+        return sorted(self.counts.get(name, {}).items(), key=lambda kv: (-kv[1], kv[0]))[:n]
+
+    def to_dict(self) -> dict:
+        return {
+            "docs": self.docs,
+            "revisionTotal": self.revision_total,
+            "firstUpdate": self.first_update,
+            "lastUpdate": self.last_update,
+            "counts": self.counts,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict, path: Path | None = None) -> "MetadataSummary":
+        summary = cls(path)
+        summary.docs = int(data.get("docs", 0))
+        summary.revision_total = int(data.get("revisionTotal", 0))
+        summary.first_update = data.get("firstUpdate")
+        summary.last_update = data.get("lastUpdate")
+        for name, counter in data.get("counts", {}).items():
+            summary.counts[name] = dict(counter)
+        return summary
+
+    @classmethod
+    def resume(cls, path: Path, items_path: Path) -> "MetadataSummary":
+        """
+        Loads the saved summary of a listing and lines it up with the items
+        already on disk: only items past its count (a crash between the
+        items append and the summary save) are folded in, and a summary that
+        counts more items than exist (the listing was reset) starts over
+        """
+        collected = count_jsonl_lines(items_path) if items_path.exists() else 0
+        summary = cls.from_dict(load_checkpoint(path), path)
+        if summary.docs > collected:
+            summary = cls(path)
+        if summary.docs < collected:
+            summary.add(islice(iter_jsonl_items(items_path), summary.docs, None))
+            summary.save()
+        return summary
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        tmp_path = self.path.with_name(f".{self.path.name}.part")
+        tmp_path.write_text(json.dumps(self.to_dict(), ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_path, self.path)
+
+
+def merge_summaries(paths: Iterable[Path]) -> MetadataSummary:
+    merged = MetadataSummary()
+    for path in paths:
+        merged.merge(MetadataSummary.from_dict(load_checkpoint(path)))
+    return merged
+
+
+def print_summary_report(summary: MetadataSummary, top: int = 10) -> None:
+    """
+    Prints the notebook's distributions from a (merged) summary
+    """
+    titles = {
+        "docType": "Document Type", "companyId": "Company ID", "status": "Status",
+        "mimeType": "MimeType", "extension": "File Extensions", "revisionNo": "Revision Numbers",
+        "year": "Documents by Year", "yearMonth": "Documents by Month", "updatedBy": "Most Active Users",
+        "namePrefix": "Filename Prefixes",
+    }
+    print("=" * 60)
+    print("UNIT4 DOCUMENT METADATA SUMMARY")
+    print("=" * 60)
+    for name in MetadataSummary.DIMENSIONS:
+        rows = summary.top(name, None) if name in ("year", "yearMonth") else summary.top(name, top)
+        if name in ("year", "yearMonth"):
+            rows = sorted(rows)[-24:]
+        print(f"\n=== {titles[name]} ===")
+        width = max((len(key) for key, _ in rows), default=0)
+        for key, n in rows:
+            share = n / summary.docs * 100 if summary.docs else 0.0
+            print(f"  {key:{width}s} {n:8d}  {share:5.1f}%")
+    print("\n" + "=" * 60)
+    print(f"{'Total Documents':25s}: {summary.docs}")
+    print(f"{'Unique Users':25s}: {len(summary.counts['updatedBy'])}")
+    print(f"{'File Types':25s}: {len(summary.counts['mimeType'])}")
+    print(f"{'Date Range':25s}: {summary.first_update} to {summary.last_update}")
+    if summary.docs:
+        print(f"{'Avg Revision No':25s}: {summary.revision_total / summary.docs:.2f}")
+    print("=" * 60)
+
+
+def export_summary(summary: MetadataSummary, path: Path) -> None:
+    """
+    Writes a summary as JSON or, for a .csv path, as dimension,key,count rows
+    (cross-tab dimensions are named "a|b", keys "x|y")
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.suffix.lower() == ".csv":
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["dimension", "key", "count"])
+            for name, counter in summary.counts.items():
+                for key, n in summary.top(name, None):
+                    writer.writerow([name, key, n])
+    else:
+        path.write_text(json.dumps(summary.to_dict(), indent=2, ensure_ascii=False), encoding="utf-8")
+
+
+# -----------------------------
+# DELTA SYNC
+# -----------------------------
+def reset_completed_listing(checkpoint_path: Path, items_path: Path) -> bool:
+    """
+    Starts a fresh listing when the previous one ran to completion, so a
+    delta run sees the current server state. An interrupted listing is kept
+    and resumed as usual
+    """
+    if not load_checkpoint(checkpoint_path).get("complete"):
+        return False
+    items_path.unlink(missing_ok=True)
+    checkpoint_path.unlink(missing_ok=True)
+    return True
+
+
+class ChangeTracker:
+    """
+    Classifies listed items against the manifest as they are seen:
+    new / changed / unchanged counts, listed ids and the max updatedAt.
+    Items must be observed before they are downloaded
+    """
+
+    def __init__(self, manifest: DocumentManifest) -> None:
+        self.manifest = manifest
+        self.counts = {"new": 0, "changed": 0, "unchanged": 0}
+        self.seen: set[str] = set()
+        self.max_updated_at: str | None = None
+
+    def observe(self, doc: dict) -> None:
+        self.seen.add(doc.get("id"))
+        updated_at = doc.get("lastUpdate", {}).get("updatedAt")
+        if updated_at and (self.max_updated_at is None or updated_at > self.max_updated_at):
+            self.max_updated_at = updated_at
+        if self.manifest.lookup(doc.get("id")) is None:
+            self.counts["new"] += 1
+        elif self.manifest.is_current(doc):
+            self.counts["unchanged"] += 1
+        else:
+            self.counts["changed"] += 1
+
+
+def report_deletions(
+    manifest: DocumentManifest,
+    seen_ids: set[str],
+    doc_type: str,
+    company_id: str,
+    report_path: Path
+) -> list[dict]:
+    """
+    Documents in the manifest for this docType/company that the full listing
+    no longer returns. They are marked deleted in the manifest (binaries are
+    kept) and appended to `report_path`
+    """
+    deleted = [e for e in manifest.entries(doc_type, company_id) if e["id"] not in seen_ids]
+    for entry in deleted:
+        manifest.record_deletion(entry)
+    if deleted:
+        append_jsonl_items(report_path, [
+            {**e, "deletedAt": time.strftime("%Y-%m-%d %H:%M:%S")} for e in deleted
+        ])
+    return deleted
+
+
+# ----
+# PAGINATION & BATCH PROCESSING
+# ----
+class PageSizeController:
+    """
+    AIMD page size shared by every page request of a crawl: halves on 5xx /
+    timeouts (down to `min_limit`), shrinks by a quarter on pages slower than
+    twice `target_latency_ms`, and grows by `step` after each page answered
+    within target (up to `max_limit`), so one bad page no longer pins the
+    rest of the crawl at the minimum
+    """
+
+    def __init__(
+        self,
+        limit: int,
+        min_limit: int = 10,
+        max_limit: int | None = None,
+        target_latency_ms: int = 5000,
+        step: int | None = None
+    ) -> None:
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit or limit)
+        self.target_latency_ms = target_latency_ms
+        self.step = step or self.min_limit
+        self.limit = min(self.max_limit, max(self.min_limit, limit))
+        self.lowest = self.highest = self.limit
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def _set(self, limit: int) -> int:
+        self.limit = min(self.max_limit, max(self.min_limit, limit))
+        self.lowest = min(self.lowest, self.limit)
+        self.highest = max(self.highest, self.limit)
+        return self.limit
+
+    def on_failure(self) -> int:
+        with self._lock:
+            self.failures += 1
+            return self._set(self.limit // 2)
+
+    def on_success(self, latency_ms: int) -> int:
+        with self._lock:
+            if latency_ms > 2 * self.target_latency_ms:
+                return self._set(self.limit * 3 // 4)
+            if latency_ms <= self.target_latency_ms:
+                return self._set(self.limit + self.step)
+            return self.limit
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "page_limit": self.limit,
+                "page_limit_min_seen": self.lowest,
+                "page_limit_max_seen": self.highest,
+                "page_limit_failures": self.failures,
+            }
+
+
+def fetch_page(
+    url: str,
+    params_base: dict,
+    auth: HTTPBasicAuth,
+    start: int,
+    limit: int,
+    page: int,
+    max_retries: int = 3,
+    rate_limiter: RateLimiter | None = None,
+    metrics: dict | None = None,
+    min_limit: int = 10,
+    session: requests.Session | None = None,
+    controller: PageSizeController | None = None,
+    timeout: float = 180,
+    budget: MemoryBudget | None = None,
+    telemetry: Telemetry | None = None,
+    timeouts: AdaptiveTimeouts | None = None
+) -> tuple[list[dict], int, int, int]:
+    """
+    Fetches up to `limit` items at `start` with retry logic; 5xx and timeouts
+    shrink the page size through `controller`. Safe to call from several threads.
+    With `timeouts` the request timeout follows observed latency instead of
+    the fixed `timeout`.
+    The body is read within `budget`: a page over the per-response cap is
+    abandoned before it is fully read and retried at half the size (down to
+    one item, below `min_limit` if need be); RSS pressure shrinks it too.
+    Returns (items, total, limit actually used, latency ms).
+    Raises Unit4FetchError if the page cannot be fetched
+    """
+    rate_limiter = rate_limiter or RateLimiter()
+    budget = budget or MemoryBudget()
+    controller = controller or PageSizeController(limit, min_limit=min_limit)
+    current_limit = limit
+
+    while True:
+        params = {**params_base, "start": start, "limit": current_limit}
+
+        for attempt in range(max_retries):
+            try:
+                budget.check_run(metrics)
+                if budget.under_pressure(metrics) and current_limit > controller.min_limit:
+                    current_limit = min(current_limit, controller.on_failure())
+                    params["limit"] = current_limit
+                    print(f"  ⚠ RSS over budget on page {page}, page size -> {current_limit}")
+                with stage_span(telemetry, "throttle"):
+                    rate_limiter.wait(metrics)
+                request_timeout = timeouts.timeout("list", attempt=attempt) if timeouts is not None else timeout
+                response, latency_ms = make_request(
+                    url, params, auth, timeout=request_timeout, session=session, stream=True,
+                    telemetry=telemetry, endpoint="list"
+                )
+                rate_limiter.observe(response.status_code, latency_ms)
+                if timeouts is not None:
+                    timeouts.observe("list", latency_ms)
+
+                incr_metric(metrics, "requests_total")
+                incr_metric(metrics, "latency_ms_total", latency_ms)
+
+                if response.status_code == 429:
+                    response.close()
+                    incr_metric(metrics, "http_429")
+                    retry_after = response.headers.get("Retry-After")
+                    wait_sec = float(retry_after) if retry_after else backoff_seconds(attempt)
+                    print(f"  ⚠ Rate limited on page {page} (wait {wait_sec:.1f}s)")
+                    rate_limiter.pause(wait_sec)
+                    sleep_with_metrics(wait_sec, metrics)
+                    record_failure_and_maybe_break(metrics, rate_limiter=rate_limiter)
+                    continue
+
+                if response.status_code >= 500:
+                    response.close()
+                    incr_metric(metrics, "http_5xx")
+                    wait_sec = backoff_seconds(attempt)
+                    print(f"  ⚠ Server error on page {page} (wait {wait_sec:.1f}s)")
+                    rate_limiter.pause(wait_sec)
+                    sleep_with_metrics(wait_sec, metrics)
+                    current_limit = min(current_limit, controller.on_failure())
+                    params["limit"] = current_limit
+                    record_failure_and_maybe_break(metrics, rate_limiter=rate_limiter)
+                    continue
+
+                if not validate_response(response, budget, metrics):
+                    incr_metric(metrics, "http_other")
+                    print(f"  ✗ Page {page} failed (status {response.status_code})")
+                    record_failure_and_maybe_break(metrics, rate_limiter=rate_limiter)
+                    raise Unit4FetchError(f"page {page} failed with status {response.status_code}")
+
+                with stage_span(telemetry, "http_body"):
+                    body = budget.read(response, metrics)
+                with stage_span(telemetry, "json_parse"):
+                    data = json.loads(body)
+                del body
+                record_success(metrics)
+                controller.on_success(latency_ms)
+                return data.get("items", []), data.get("total", 0), current_limit, latency_ms
+
+            except BudgetExceeded as e:
+                if e.reason == "run" or current_limit <= 1:
+                    print(f"  ✗ Page {page} over memory budget ({e})")
+                    raise Unit4FetchError(f"page {page} over memory budget: {e}") from e
+                current_limit = max(1, current_limit // 2)
+                controller.on_failure()
+                params["limit"] = current_limit
+                print(f"  ⚠ Page {page} over memory budget ({e}), page size -> {current_limit}")
+            except requests.exceptions.Timeout:
+                rate_limiter.observe(None)
+                if timeouts is not None:
+                    timeouts.observe("list", int(request_timeout * 1000))
+                if attempt < max_retries - 1:
+                    wait_time = backoff_seconds(attempt)
+                    print(f"  ⚠ Timeout on page {page}, retry {attempt + 1}/{max_retries} (waiting {wait_time}s)...")
+                    incr_metric(metrics, "timeouts")
+                    sleep_with_metrics(wait_time, metrics)
+                    current_limit = min(current_limit, controller.on_failure())
+                    params["limit"] = current_limit
+                    record_failure_and_maybe_break(metrics, rate_limiter=rate_limiter)
+                    continue
+                print(f"  ✗ Max retries exceeded for page {page}")
+                raise Unit4FetchError(f"max retries exceeded for page {page}")
+            except Unit4FetchError:
+                raise
+            except Exception as e:
+                print(f"  ✗ Error on page {page}: {e}")
+                record_failure_and_maybe_break(metrics, rate_limiter=rate_limiter)
+                raise Unit4FetchError(f"error on page {page}: {e}") from e
+
+
+def fetch_range(
+    url: str,
+    params_base: dict,
+    auth: HTTPBasicAuth,
+    start: int,
+    end: int,
+    limit: int,
+    page: int,
+    **page_kwargs: Any
+) -> tuple[list[dict], int, int]:
+    """
+    Fetches offsets [start, end), in several requests if the page size
+    shrinks on errors. Returns (items, total, last latency ms); fewer than
+    end - start items means the listing ended early
+    """
+    items: list[dict] = []
+    total = 0
+    latency_ms = 0
+    offset = start
+    controller = page_kwargs.get("controller")
+    while offset < end:
+        if controller is not None:
+            limit = controller.limit
+        chunk, total, limit, latency_ms = fetch_page(
+            url, params_base, auth, offset, min(limit, end - offset), page, **page_kwargs
+        )
+        if not chunk:
+            break
+        items.extend(chunk)
+        offset += len(chunk)
+    return items, total, latency_ms
+
+
+def prefetch_pages(
+    url: str,
+    params_base: dict,
+    auth: HTTPBasicAuth,
+    start: int,
+    total: int,
+    limit: int,
+    workers: int,
+    **page_kwargs: Any
+) -> Iterator[tuple[int, list[dict], int, int]]:
+    """
+    Fans out requests for the known offsets start, start+limit, ... < total
+    with at most `workers` in flight (plus as many completed pages buffered)
+    and yields (offset, items, total, latency ms) strictly in offset order.
+    Stops after the first short page so the caller can continue serially
+    from the contiguous high-water mark
+    """
+    offsets = iter(range(start, total, limit))
+    pending: dict = {}
+    done: dict[int, tuple[list[dict], int, int]] = {}
+    next_offset = start
+    window = workers * 2
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="unit4-page") as pool:
+        try:
+            while True:
+                while len(pending) + len(done) < window:
+                    offset = next(offsets, None)
+                    if offset is None:
+                        break
+                    future = pool.submit(
+                        fetch_range, url, params_base, auth, offset, offset + limit, limit,
+                        offset // limit + 1, **page_kwargs
+                    )
+                    pending[future] = offset
+                if not pending and next_offset not in done:
+                    return
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    offset = pending.pop(future)
+                    done[offset] = future.result()
+
+                while next_offset in done:
+                    items, page_total, latency_ms = done.pop(next_offset)
+                    yield next_offset, items, page_total, latency_ms
+                    if len(items) < limit:
+                        return
+                    next_offset += limit
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def fetch_all_documents(
+    url: str,
+    params_base: dict,
+    auth: HTTPBasicAuth,
+    limit: int = 50,
+    max_retries: int = 3,
+    rate_limiter: RateLimiter | None = None,
+    metrics: dict | None = None,
+    checkpoint_path: Path | None = None,
+    items_path: Path | None = None,
+    min_limit: int = 10,
+    session: requests.Session | None = None,
+    page_workers: int = 1,
+    max_limit: int | None = None,
+    target_latency_ms: int = 5000,
+    timeout: float = 180,
+    budget: MemoryBudget | None = None,
+    telemetry: Telemetry | None = None,
+    start_offset: int = 0,
+    end_offset: int | None = None,
+    timeouts: AdaptiveTimeouts | None = None,
+    summary: MetadataSummary | None = None
+) -> Iterator[list[dict]]:
+    """
+    Fetches ALL documents using pagination with retry logic.
+    Generator: yields each page of items as it arrives (and appends it to
+    `items_path`), so memory stays O(page size). Items from an earlier,
+    resumed run are not re-read; they are already in `items_path`.
+    With page_workers > 1, once the first page reports `total` the remaining
+    offsets are prefetched concurrently; pages are still written, yielded and
+    checkpointed in offset order.
+    Page size is adapted by a PageSizeController between `min_limit` and
+    `max_limit`; the current size is checkpointed so a resume starts from it.
+    Every page body is read within `budget` (see fetch_page).
+    With `start_offset` / `end_offset` only that slice of the listing is
+    fetched (one shard of a sharded run).
+    Each page is folded into `summary` (saved before the checkpoint).
+    Raises Unit4FetchError if a page cannot be fetched
+    """
+    rate_limiter = rate_limiter or RateLimiter()
+    budget = budget or MemoryBudget()
+    if str(params_base.get("withFileContent", "")).lower() == "true":
+        print("  ⚠ Listing with withFileContent=true: pages carry document bodies, "
+              f"each capped at {budget.max_response_bytes // (1024 * 1024)} MB")
+
+    collected = 0
+    start = start_offset
+    page = 1
+    known_total = 0
+    prefetched = False
+
+    if items_path is not None and items_path.exists():
+        collected = count_jsonl_lines(items_path)
+        start = start_offset + collected
+        update_metrics(metrics, {"resumed_items": collected})
+
+    if checkpoint_path is not None:
+        checkpoint = load_checkpoint(checkpoint_path)
+        start = max(start, int(checkpoint.get("start", 0)))
+        collected = max(collected, int(checkpoint.get("collected", 0)))
+        known_total = int(checkpoint.get("total", 0))
+        if start > start_offset:
+            page = ((start - start_offset) // max(limit, 1)) + 1
+        if checkpoint.get("limit") and not checkpoint.get("complete"):
+            limit = int(checkpoint["limit"])
+
+    controller = PageSizeController(
+        limit,
+        min_limit=min_limit,
+        max_limit=max(max_limit or 0, limit),
+        target_latency_ms=target_latency_ms
+    )
+    page_kwargs = {
+        "max_retries": max_retries,
+        "rate_limiter": rate_limiter,
+        "metrics": metrics,
+        "min_limit": min_limit,
+        "session": session,
+        "controller": controller,
+        "timeout": timeout,
+        "budget": budget,
+        "telemetry": telemetry,
+        "timeouts": timeouts,
+    }
 
+    def commit(items: list[dict], total: int, latency_ms: int) -> None:
+        nonlocal collected, start, page
+        collected += len(items)
+        if items_path is not None:
+            append_jsonl_items(items_path, items)
+        if summary is not None:
+            summary.add(items)
+            summary.save()
+
+        print(f"  ✓ Page {page}: {len(items)} docs | Total so far: {collected}/{total} | Latency: {latency_ms}ms")
+
+        start += len(items)
+        page += 1
+
+        sizes = controller.snapshot()
+        update_metrics(metrics, sizes)
+        if checkpoint_path is not None:
+            save_checkpoint(checkpoint_path, {
+                "start": start,
+                "total": total,
+                "collected": collected,
+                "limit": sizes["page_limit"],
+                "updatedAt": time.strftime("%Y-%m-%d %H:%M:%S")
+            })
+
+    def complete(total: int) -> None:
+        if checkpoint_path is not None:
+            save_checkpoint(checkpoint_path, {
+                "start": start,
+                "total": total,
+                "collected": collected,
+                "limit": controller.limit,
+                "complete": True,
+                "updatedAt": time.strftime("%Y-%m-%d %H:%M:%S")
+            })
+
+    if end_offset is not None:
+        print(f"Starting pagination of offsets {start_offset}..{end_offset} (limit={controller.limit})...")
+    else:
+        print(f"Starting pagination (limit={controller.limit})...")
+
+    while True:
+        stop = known_total if end_offset is None else min(known_total, end_offset)
+        if page_workers > 1 and not prefetched and start < stop:
+            prefetched = True
+            print(f"[prefetch] {page_workers} workers for offsets {start}..{stop}")
+            for _, items, total, latency_ms in prefetch_pages(
+                url, params_base, auth, start, stop, controller.limit, page_workers, **page_kwargs
+            ):
+                if items:
+                    commit(items, total, latency_ms)
+                    yield items
+            continue
+
+        if end_offset is not None and start >= end_offset:
+            print(f"  ✓ Reached end of range at offset {end_offset} (total collected: {collected})")
+            complete(known_total)
+            return
+
+        page_limit = controller.limit if end_offset is None else min(controller.limit, end_offset - start)
+        items, total, _, latency_ms = fetch_page(
+            url, params_base, auth, start, page_limit, page, **page_kwargs
+        )
+        known_total = total
+
+        if not items:
+            print(f"  ✓ Page {page}: No more documents (total collected: {collected})")
+            complete(total)
+            return
+
+        commit(items, total, latency_ms)
+        yield items
+
+
+# -----------------------------
+# PIPELINE
+# -----------------------------
+def run_pipeline(
+    pages: Iterable[list[dict]],
+    resumed_items: Iterable[dict] = (),
+    queue_size: int = 500,
+    on_item: Callable[[dict], None] | None = None,
+    total: int = 0,
+    **download_kwargs: Any
+) -> tuple[bool, BaseException | None]:
+    """
+    Runs listing and downloads concurrently: a producer thread drains
+    `resumed_items` then `pages` into a bounded queue (backpressure keeps
+    memory bounded) while download_documents consumes it right away.
+    Returns (downloads ok, listing error or None)
+    """
+    q: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+    end = object()
+    errors: list[BaseException] = []
+
+    def produce() -> None:
+        try:
+            for doc in resumed_items:
+                if on_item is not None:
+                    on_item(doc)
+                q.put(doc)
+            for page_items in pages:
+                for doc in page_items:
+                    if on_item is not None:
+                        on_item(doc)
+                    q.put(doc)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            q.put(end)
+
+    def consume() -> Iterator[dict]:
+        while (doc := q.get()) is not end:
+            yield doc
+
+    producer = threading.Thread(target=produce, name="unit4-listing", daemon=True)
+    producer.start()
+    ok = download_documents({"total": total, "items": consume()}, **download_kwargs)
+    producer.join()
+    return ok and not errors, errors[0] if errors else None
+
+
+# -----------------------------
+# INTEGRITY VERIFICATION
+# -----------------------------
+# Leading bytes each mimeType must start with (any of); unlisted types are not checked
+MAGIC_BYTES = {
+    "application/pdf": (b"%PDF-",),
+    "application/zip": (b"PK\x03\x04",),
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": (b"PK\x03\x04",),
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": (b"PK\x03\x04",),
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation": (b"PK\x03\x04",),
+    "application/msword": (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1",),
+    "application/vnd.ms-excel": (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1",),
+    "application/vnd.ms-powerpoint": (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1",),
+    "application/vnd.ms-outlook": (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1",),
+    "image/png": (b"\x89PNG\r\n\x1a\n",),
+    "image/jpeg": (b"\xff\xd8\xff",),
+    "image/gif": (b"GIF87a", b"GIF89a"),
+    "image/tiff": (b"II*\x00", b"MM\x00*"),
+}
+
+
+def verify_files(jobs: list[dict]) -> list[dict]:
+    """
+    Process-pool worker: re-hashes a batch of stored documents through mmap
+    and checks size, sha256 and magic bytes against the manifest. Each job
+    carries id, path, size, sha256, mimeType and, when packed, offset.
+    Returns one {id, problem, detail} per bad document
+    """
+    problems = []
+    for job in jobs:
+        offset = job.get("offset")
+        size = job["size"]
+        try:
+            with open(job["path"], "rb") as f:
+                file_size = os.fstat(f.fileno()).st_size
+                if (offset is None and file_size != size) or (offset is not None and offset + size > file_size):
+                    problems.append({"id": job["id"], "problem": "size", "detail": f"{file_size} bytes, expected {size}"})
+                    continue
+                if size == 0:
+                    sha256, head = hashlib.sha256(b"").hexdigest(), b""
+                else:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                        start = offset or 0
+                        view = memoryview(m)[start:start + size]
+                        sha256 = hashlib.sha256(view).hexdigest()
+                        head = bytes(view[:16])
+                        view.release()
+        except FileNotFoundError:
+            problems.append({"id": job["id"], "problem": "missing", "detail": job["path"]})
+            continue
+        except OSError as e:
+            problems.append({"id": job["id"], "problem": "unreadable", "detail": str(e)})
+            continue
+        if sha256 != job["sha256"]:
+            problems.append({"id": job["id"], "problem": "sha256", "detail": f"{sha256[:12]}, expected {job['sha256'][:12]}"})
+            continue
+        magic = MAGIC_BYTES.get((job.get("mimeType") or "").lower())
+        if magic and not head.startswith(magic):
+            problems.append({"id": job["id"], "problem": "magic", "detail": f"starts with {head[:8]!r} for {job['mimeType']}"})
+    return problems
+
+
+def verify_corpus(
+    docs_root: Path,
+    report_path: Path,
+    metrics_path: Path,
+    workers: int = 0,
+    batch_size: int = 64,
+    repair: bool = False,
+    journal: DocumentJournal | None = None,
+    shard_of: Callable[[dict], str] | None = None
+) -> dict:
+    """
+    Re-hashes every document of the manifest on a process pool (memory-mapped
+    reads) and checks size, sha256 and the magic bytes of its mimeType; files
+    under docs/ the manifest does not know are reported as orphans. Bad
+    documents go to `report_path` (one JSON line each). With `repair` their
+    files are moved to docs/.quarantine/ (packed copies are unindexed), their
+    manifest entries dropped and, in `journal`, they are marked failed under
+    shard_of(entry) so --retry-failed re-downloads exactly those.
+    Returns the metrics, also saved to `metrics_path`
+    """
+    started = time.perf_counter()
+    manifest = DocumentManifest(docs_root / "manifest.jsonl", compact=False)
+    entries = {e["id"]: e for e in manifest.entries()}
+    jobs = []
+    for entry in entries.values():
+        # Packed documents live at segments/<segment>#<offset>
+        path, _, offset = entry["path"].partition("#")
+        jobs.append({
+            "id": entry["id"],
+            "path": str(docs_root / path),
+            "offset": int(offset) if offset else None,
+            "size": entry["size"],
+            "sha256": entry["sha256"],
+            "mimeType": entry.get("mimeType"),
+        })
+    workers = workers or os.cpu_count() or 1
+    print(f"[verify] {len(jobs)} documents on {workers} processes...")
+
+    problems: list[dict] = []
+    pool_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context) as pool:
+        batches = [jobs[i:i + batch_size] for i in range(0, len(jobs), batch_size)]
+        for found in pool.map(verify_files, batches):
+            problems += found
+
+    known = {e["path"] for e in entries.values()}
+    orphans = []
+    for dirpath, dirnames, filenames in os.walk(docs_root):
+        dirnames[:] = [d for d in dirnames if d not in ("segments", ".quarantine")]
+        for filename in filenames:
+            path = Path(dirpath) / filename
+            relpath = relative_to_root(path, docs_root)
+            if relpath != "manifest.jsonl" and not filename.startswith(".") and relpath not in known:
+                orphans.append(relpath)
+
+    tmp_path = report_path.with_name(f".{report_path.name}.part")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for problem in problems:
+            entry = entries[problem["id"]]
+            f.write(json.dumps({**problem, "path": entry["path"], "fileName": entry.get("fileName")}, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, report_path)
+
+    repaired = 0
+    if repair and problems:
+        store = SegmentStore(docs_root / "segments") if (docs_root / "segments" / "index.jsonl").exists() else None
+        for problem in problems:
+            entry = entries[problem["id"]]
+            path, _, offset = entry["path"].partition("#")
+            if offset:
+                if store is not None:
+                    store.forget(entry["id"])
+            elif (docs_root / path).exists():
+                quarantined = docs_root / ".quarantine" / path
+                quarantined.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(docs_root / path, quarantined)
+            manifest.forget(entry, problem["problem"])
+            if journal is not None and shard_of is not None:
+                item = {k: entry.get(k) for k in ("id", "companyId", "docType", "mimeType", "fileName", "revisionNo")}
+                journal.requeue(entry["id"], shard_of(entry), item, f"verify: {problem['problem']} ({problem['detail']})")
+            repaired += 1
+        if store is not None:
+            store.close()
+    manifest.close()
+
+    by_problem: dict[str, int] = {}
+    for problem in problems:
+        by_problem[problem["problem"]] = by_problem.get(problem["problem"], 0) + 1
+    elapsed = time.perf_counter() - started
+    total_mb = sum(job["size"] for job in jobs) / (1024 * 1024)
+    metrics = {
+        "verifiedAt": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "documents": len(jobs),
+        "workers": workers,
+        "bad": len(problems),
+        "by_problem": by_problem,
+        "orphans": len(orphans),
+        "orphan_sample": orphans[:100],
+        "repaired": repaired,
+        "elapsedSec": round(elapsed, 3),
+        "files_per_sec": round(len(jobs) / elapsed, 1) if elapsed else 0.0,
+        "mb_per_sec": round(total_mb / elapsed, 1) if elapsed else 0.0,
+    }
+    save_metrics(metrics_path, metrics)
+    print(
+        f"[verify] {len(jobs) - len(problems)}/{len(jobs)} ok, bad={len(problems)}{f' {by_problem}' if by_problem else ''} "
+        f"orphans={len(orphans)} ({metrics['files_per_sec']} files/s, {metrics['mb_per_sec']} MB/s)"
+    )
+    if problems:
+        print(f"[verify] bad documents listed in {report_path}" + (f"; {repaired} queued for re-download (--retry-failed)" if repaired else ""))
+    return metrics
+
+
+# -----------------------------
+# TEXT EXTRACTION
+# -----------------------------
+# OOXML part holding the text of each extension (glob on the zip member names)
+OOXML_TEXT_PARTS = {
+    ".docx": ("word/document.xml",),
+    ".xlsx": ("xl/sharedStrings.xml",),
+    ".pptx": ("ppt/slides/slide",),
+}
+PLAIN_TEXT_EXTENSIONS = (".txt", ".csv", ".xml", ".json", ".html", ".htm")
+
+
+def ooxml_text(path: Path | io.BytesIO, extension: str) -> tuple[str, int]:
+    """
+    Text of a .docx / .xlsx / .pptx straight from its XML parts (no Office
+    dependency). Returns (text, pages): slides for .pptx, sheets for .xlsx,
+    0 for .docx (which has no stored page count)
+    """
+    with zipfile.ZipFile(path) as z:
+        names = z.namelist()
+        parts = sorted(n for n in names if n.endswith(".xml") and n.startswith(OOXML_TEXT_PARTS[extension]))
+        blocks = []
+        for name in parts:
+            root = ET.fromstring(z.read(name))
+            # <w:p> / <a:p> paragraphs and <si> shared strings become lines
+            for block in root.iter():
+                if block.tag.rsplit("}", 1)[-1] in ("p", "si"):
+                    line = "".join(t.text or "" for t in block.iter() if t.tag.rsplit("}", 1)[-1] == "t")
+                    if line:
+                        blocks.append(line)
+        if extension == ".pptx":
+            pages = len(parts)
+        elif extension == ".xlsx":
+            pages = sum(1 for n in names if n.startswith("xl/worksheets/sheet"))
+        else:
+            pages = 0
+    return "\n".join(blocks), pages
+
+
+def extract_text_file(
+    path: str,
+    file_name: str | None = None,
+    mime_type: str | None = None,
+    offset: int | None = None,
+    length: int | None = None
+) -> dict:
+    """
+    Process-pool worker: text and basic stats of one stored document, or of
+    `length` bytes at `offset` of a packed segment. The kind comes from the
+    file name's extension (CAS blobs have none), falling back to mimeType.
+    Returns {status, extractor, pages, chars, words, ms,
+    text}; status is "ok", "unsupported" or "failed" (with error)
+    """
+    started = time.perf_counter()
+    extension = Path(file_name or path).suffix.lower()
+    if not extension and mime_type:
+        extension = {
+            "application/pdf": ".pdf",
+            "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ".docx",
+            "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": ".xlsx",
+            "application/vnd.openxmlformats-officedocument.presentationml.presentation": ".pptx",
+            "text/plain": ".txt",
+        }.get(mime_type, "")
+    result = {"status": "ok", "extractor": extension.lstrip(".") or None, "pages": 0, "text": ""}
+    try:
+        source: Path | io.BytesIO = Path(path)
+        if offset is not None:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                source = io.BytesIO(m[offset:offset + length])
+        if extension == ".pdf":
+            if pypdf is None:
+                result.update(status="unsupported", error="pypdf not installed")
+            else:
+                reader = pypdf.PdfReader(source)
+                result["pages"] = len(reader.pages)
+                result["text"] = "\f".join(page.extract_text() or "" for page in reader.pages)
+        elif extension in OOXML_TEXT_PARTS:
+            result["text"], result["pages"] = ooxml_text(source, extension)
+        elif extension in PLAIN_TEXT_EXTENSIONS:
+            raw = source.getvalue() if isinstance(source, io.BytesIO) else source.read_bytes()
+            result["text"] = raw.decode("utf-8", errors="replace")
+        else:
+            result.update(status="unsupported", error=f"no extractor for {extension or mime_type or 'unknown'}")
+    except Exception as e:
+        result.update(status="failed", error=f"{type(e).__name__}: {e}", text="")
+    result["chars"] = len(result["text"])
+    result["words"] = len(result["text"].split())
+    result["ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+
+def run_text_extraction(docs_root: Path, text_root: Path, metrics_path: Path, workers: int = 0) -> dict:
+    """
+    Extracts text from every document in the manifest with a process pool
+    and writes text/corpus.jsonl (one line per document: id, docType,
+    companyId, fileName, mimeType, sha256, pages, chars, words, text).
+    Results are cached by sha256 under text/cache/<sha[:2]>/<sha>.json, so
+    an unchanged document is never extracted twice; extraction timings go to
+    `metrics_path`. Returns the metrics
+    """
+    cache_root = text_root / "cache"
+    cache_root.mkdir(parents=True, exist_ok=True)
+    manifest = DocumentManifest(docs_root / "manifest.jsonl", compact=False)
+    entries = manifest.entries()
+    manifest.close()
+
+    def cache_path(sha256: str) -> Path:
+        return cache_root / sha256[:2] / f"{sha256}.json"
+
+    metrics: dict[str, Any] = {
+        "startTime": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "documents": len(entries),
+        "workers": workers or os.cpu_count() or 1,
+        "pypdf": pypdf is not None,
+        "cached": 0,
+        "extracted": 0,
+        "unsupported": 0,
+        "failed": 0,
+        "files": [],
+    }
+    todo: dict[str, dict] = {}
+    for entry in entries:
+        if entry["sha256"] not in todo and not cache_path(entry["sha256"]).exists():
+            todo[entry["sha256"]] = entry
+    metrics["cached"] = len({e["sha256"] for e in entries}) - len(todo)
+    print(f"[text] {len(entries)} documents, {len(todo)} to extract ({metrics['cached']} cached) on {metrics['workers']} processes")
+
+    histogram = LatencyHistogram()
+    started = time.perf_counter()
+    if todo:
+        pool_context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=metrics["workers"], mp_context=pool_context) as pool:
+            futures = {}
+            for sha, e in todo.items():
+                # Packed documents live at segments/<segment>#<offset>
+                path, _, offset = e["path"].partition("#")
+                futures[pool.submit(
+                    extract_text_file, str(docs_root / path), e.get("fileName"), e.get("mimeType"),
+                    int(offset) if offset else None, e["size"] if offset else None
+                )] = sha
+            for future in as_completed(futures):
+                sha256 = futures[future]
+                entry = todo[sha256]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"status": "failed", "error": f"worker died: {e}", "text": "", "pages": 0, "chars": 0, "words": 0, "ms": 0}
+                key = "extracted" if result["status"] == "ok" else result["status"]
+                metrics[key] += 1
+                histogram.observe(result["ms"])
+                metrics["files"].append({
+                    "id": entry["id"], "sha256": sha256, "status": result["status"], "extractor": result.get("extractor"),
+                    "ms": result["ms"], "pages": result["pages"], "chars": result["chars"], "error": result.get("error"),
+                })
+                # Failures (and PDFs skipped for lack of pypdf) are not cached, so the next run retries them
+                if result["status"] == "ok" or (result["status"] == "unsupported" and result.get("extractor") != "pdf"):
+                    path = cache_path(sha256)
+                    path.parent.mkdir(exist_ok=True)
+                    tmp_path = path.with_name(f".{path.name}.part")
+                    tmp_path.write_text(json.dumps(result, ensure_ascii=False), encoding="utf-8")
+                    os.replace(tmp_path, path)
+
+    corpus_path = text_root / "corpus.jsonl"
+    tmp_path = text_root / ".corpus.jsonl.part"
+    written = 0
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for entry in entries:
+            path = cache_path(entry["sha256"])
+            if not path.exists():
+                continue
+            result = json.loads(path.read_text(encoding="utf-8"))
+            if result["status"] != "ok":
+                continue
+            f.write(json.dumps({
+                "id": entry["id"],
+                "docType": entry.get("docType"),
+                "companyId": entry.get("companyId"),
+                "fileName": entry.get("fileName"),
+                "mimeType": entry.get("mimeType"),
+                "sha256": entry["sha256"],
+                "pages": result["pages"],
+                "chars": result["chars"],
+                "words": result["words"],
+                "text": result["text"],
+            }, ensure_ascii=False) + "\n")
+            written += 1
+    os.replace(tmp_path, corpus_path)
+
+    metrics["corpusDocuments"] = written
+    metrics["elapsedSec"] = round(time.perf_counter() - started, 3)
+    metrics["extraction_ms"] = histogram.summary()
+    metrics["endTime"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    save_metrics(metrics_path, metrics)
+    print(
+        f"[text] extracted={metrics['extracted']} unsupported={metrics['unsupported']} failed={metrics['failed']} "
+        f"-> {corpus_path} ({written} documents)"
+    )
+    return metrics
+
+
+# -----------------------------
+# RUN SETUP & SHARDS
+# -----------------------------
+def load_settings() -> dict:
+    """
+    Reads the UNIT4_* environment once into a plain (picklable) dict, so
+    shard processes run with exactly the parent's configuration
+    """
+    limit = int(os.environ.get("UNIT4_LIMIT", "50"))
+    unit4_env = os.environ.get("UNIT4_ENV", "PROD").upper()
+    download_workers = int(os.environ.get("UNIT4_DOWNLOAD_WORKERS", "1"))
+    json_compression = os.environ.get("UNIT4_JSON_COMPRESSION", "none").lower()
+    docs_layout = os.environ.get("UNIT4_DOCS_LAYOUT", "name").lower()
+    return {
+        "base": os.environ.get("UNIT4_BASE", "").rstrip("/"),
+        "user": os.environ.get("UNIT4_USER"),
+        "pwd": os.environ.get("UNIT4_PASS"),
+        "companies": [c.strip() for c in os.environ.get("UNIT4_COMPANIES", "P2").split(",") if c.strip()],
+        "doc_types": [t.strip().upper() for t in os.environ.get("UNIT4_DOC_TYPES", "REPINV,REPTEC").split(",") if t.strip()],
+        "shard_processes": int(os.environ.get("UNIT4_SHARD_PROCESSES", "1")),
+        "shard_split": int(os.environ.get("UNIT4_SHARD_SPLIT", "1")),
+        "min_interval": float(os.environ.get("UNIT4_MIN_INTERVAL", "0.25")),
+        "adaptive_rate": os.environ.get("UNIT4_ADAPTIVE_RATE", "false").lower() == "true",
+        "unit4_env": unit4_env,
+        "rate_floor": float(os.environ.get("UNIT4_RATE_FLOOR", str(ENV_MIN_INTERVAL_FLOOR.get(unit4_env, 0.25)))),
+        "rate_ceiling": float(os.environ.get("UNIT4_RATE_MAX_INTERVAL", "5.0")),
+        "max_retries": int(os.environ.get("UNIT4_MAX_RETRIES", "3")),
+        "download_workers": download_workers,
+        "pool_size": int(os.environ.get("UNIT4_POOL_SIZE", str(max(10, download_workers)))),
+        "page_workers": int(os.environ.get("UNIT4_PAGE_WORKERS", "1")),
+        "stream_download": os.environ.get("UNIT4_STREAM_DOWNLOAD", "false").lower() == "true",
+        "pipeline": os.environ.get("UNIT4_PIPELINE", "false").lower() == "true",
+        "pipeline_queue": int(os.environ.get("UNIT4_PIPELINE_QUEUE", "500")),
+        "parquet_enabled": os.environ.get("UNIT4_PARQUET", "false").lower() == "true",
+        "json_compression": None if json_compression in ("", "none") else json_compression,
+        "json_indent": int(os.environ.get("UNIT4_JSON_INDENT", "2")) or None,
+        "docs_layout": docs_layout,
+        "content_addressed": docs_layout == "cas",
+        "packed": docs_layout == "packed",
+        "segment_mb": float(os.environ.get("UNIT4_SEGMENT_MB", "1024")),
+        "sync_mode": os.environ.get("UNIT4_SYNC_MODE", "full").lower(),
+        "since_param": os.environ.get("UNIT4_UPDATED_SINCE_PARAM", "").strip(),
+        "limit": limit,
+        "min_limit": int(os.environ.get("UNIT4_MIN_LIMIT", "10")),
+        "max_limit": int(os.environ.get("UNIT4_MAX_LIMIT", str(limit))),
+        "page_target_ms": int(os.environ.get("UNIT4_PAGE_TARGET_MS", "5000")),
+        "max_response_mb": float(os.environ.get("UNIT4_MAX_RESPONSE_MB", "256")),
+        "max_run_mb": float(os.environ.get("UNIT4_MAX_RUN_MB", "0")),
+        "max_rss_mb": float(os.environ.get("UNIT4_MAX_RSS_MB", "0")),
+        "metrics_flush_sec": float(os.environ.get("UNIT4_METRICS_FLUSH_SEC", "15")),
+        "prom_textfile": os.environ.get("UNIT4_PROM_TEXTFILE", "").strip(),
+        "output_root": os.environ.get("UNIT4_OUT_DIR", "artifacts"),
+        "extract_text": os.environ.get("UNIT4_EXTRACT_TEXT", "false").lower() == "true",
+        "extract_workers": int(os.environ.get("UNIT4_EXTRACT_WORKERS", "0")),
+        "verify_workers": int(os.environ.get("UNIT4_VERIFY_WORKERS", "0")),
+        "plan_sample": int(os.environ.get("UNIT4_PLAN_SAMPLE", "5")),
+        "max_run_hours": float(os.environ.get("UNIT4_MAX_RUN_HOURS", "0")),
+        "profile": os.environ.get("UNIT4_PROFILE", "false").lower() == "true",
+        "profile_memory": os.environ.get("UNIT4_PROFILE_MEMORY", "false").lower() == "true",
+        "profile_cpu": os.environ.get("UNIT4_PROFILE_CPU", "false").lower() == "true",
+        "download_order": os.environ.get("UNIT4_DOWNLOAD_ORDER", "api").lower(),
+        "mime_allow": [m.strip() for m in os.environ.get("UNIT4_MIME_ALLOW", "").split(",") if m.strip()],
+        "deadline": os.environ.get("UNIT4_DEADLINE", ""),
+        "max_download_mb": float(os.environ.get("UNIT4_MAX_DOWNLOAD_MB", "0")),
+        "timeout": float(os.environ.get("UNIT4_TIMEOUT", "180")),
+        "adaptive_timeout": os.environ.get("UNIT4_ADAPTIVE_TIMEOUT", "false").lower() == "true",
+        "timeout_floor": float(os.environ.get("UNIT4_TIMEOUT_FLOOR", "10")),
+        "hedge": os.environ.get("UNIT4_HEDGE", "false").lower() == "true",
+        "retry_failed": False,
+    }
+
+
+def output_dirs(settings: dict) -> dict[str, Path]:
+    root = Path(settings["output_root"])
+    return {
+        name: root / name
+        for name in ("docs", "csv", "json", "metrics", "checkpoints", "items", "logs", "parquet", "text", "summaries")
+    }
+
+
+def open_run(settings: dict, shard: dict | None = None, reset_rate_budget: bool = False) -> dict:
+    """
+    Builds what one process shares across its shards: session, rate limiter
+    (backed by the cross-process budget file when sharding over processes),
+    memory budget, telemetry, manifest, document journal, download scheduler
+    and, for the packed layout, the segment store. `shard` is set inside a shard
+    process, which then gets its own Prometheus textfile
+    """
+    dirs = output_dirs(settings)
+    env = settings["unit4_env"].lower()
+    sharded = settings["shard_processes"] > 1
+    shared = SharedRateBudget(dirs["checkpoints"] / f"rate_budget_{env}.bin", reset=reset_rate_budget) if sharded else None
+
+    # One limiter for every shard of the process, so the budget is global to the run
+    if settings["adaptive_rate"]:
+        rate_limiter = AdaptiveRateLimiter.load(
+            dirs["checkpoints"] / f"rate_limiter_{env}.json",
+            settings["min_interval"],
+            settings["rate_floor"],
+            ceiling_sec=settings["rate_ceiling"],
+            shared=shared
+        )
+        if shard is None:
+            print(
+                f"[rate] adaptive ({settings['unit4_env']}), starting at "
+                f"{rate_limiter.min_interval_sec:.3f}s, floor {settings['rate_floor']}s"
+            )
+    else:
+        rate_limiter = RateLimiter(min_interval_sec=settings["min_interval"], shared=shared)
+
+    prom_path = Path(settings["prom_textfile"]) if settings["prom_textfile"] else dirs["metrics"] / "unit4_audit.prom"
+    if shard is not None:
+        prom_path = prom_path.with_name(f"{prom_path.stem}_{shard['name']}{prom_path.suffix}")
+    telemetry = Telemetry(prom_path=prom_path, interval_sec=settings["metrics_flush_sec"], profile=settings["profile"])
+    telemetry.start()
+
+    auth = HTTPBasicAuth(settings["user"], settings["pwd"])
+    budget = MemoryBudget(
+        max_response_bytes=int(settings["max_response_mb"] * 1024 * 1024),
+        max_run_bytes=int(settings["max_run_mb"] * 1024 * 1024),
+        max_rss_mb=settings["max_rss_mb"]
+    )
+    manifest = DocumentManifest(dirs["docs"] / "manifest.jsonl", compact=shard is None)
+    return {
+        "url": f"{settings['base']}/documents",
+        "auth": auth,
+        "session": build_session(auth, pool_size=settings["pool_size"]),
+        "rate_limiter": rate_limiter,
+        # Likewise one memory budget and one download scheduler per process
+        "budget": budget,
+        "scheduler": DownloadScheduler(
+            settings["download_order"],
+            settings["mime_allow"],
+            deadline=settings["deadline"],
+            max_bytes=int(settings["max_download_mb"] * 1024 * 1024),
+            budget=budget,
+            manifest=manifest
+        ),
+        "telemetry": telemetry,
+        "timeouts": AdaptiveTimeouts(
+            ceiling_sec=settings["timeout"], floor_sec=settings["timeout_floor"], hedge=settings["hedge"],
+            max_workers=max(2, settings["download_workers"] * 2)
+        ) if settings["adaptive_timeout"] or settings["hedge"] else None,
+        "manifest": manifest,
+        "journal": DocumentJournal(dirs["checkpoints"] / "journal.sqlite"),
+        "store": SegmentStore(
+            dirs["docs"] / "segments", segment_bytes=int(settings["segment_mb"] * 1024 * 1024)
+        ) if settings["packed"] else None,
+    }
+
+
+def close_run(ctx: dict) -> None:
+    ctx["telemetry"].stop()
+    ctx["manifest"].close()
+    ctx["journal"].close()
+    if ctx["timeouts"] is not None:
+        ctx["timeouts"].close()
+    if ctx["store"] is not None:
+        ctx["store"].close()
+    ctx["session"].close()
+
+
+def shard_folder(settings: dict, company_id: str, doc_type: str) -> str:
+    folder = f"{doc_type.lower()}_docs"
+    if len(settings["companies"]) > 1:
+        folder = f"{company_id.lower()}_{folder}"
+    return folder
+
+
+def planned_shard_names(settings: dict) -> list[str]:
+    """
+    Shard names of the current plan, from the settings and the ranges saved in
+    checkpoints/shard_plan.json, without listing anything
+    """
+    split = max(1, settings["shard_split"])
+    saved = load_checkpoint(output_dirs(settings)["checkpoints"] / "shard_plan.json")
+    ranges = saved.get("ranges", {}) if saved.get("split") == split else {}
+    names = []
+    for company_id in settings["companies"]:
+        for doc_type in settings["doc_types"]:
+            folder = shard_folder(settings, company_id, doc_type)
+            if split == 1:
+                names.append(folder)
+            else:
+                names += [f"{folder}_{start:07d}" for start, _ in ranges.get(f"{company_id}/{doc_type}", [])]
+    return names
+
+
+def plan_shards(settings: dict, ctx: dict) -> list[dict]:
+    """
+    One shard per (companyId, docType), each split into UNIT4_SHARD_SPLIT
+    offset ranges when asked. Ranges are sized from a one-item probe of the
+    listing and saved to checkpoints/shard_plan.json, so a resumed run reuses
+    them (and its per-shard checkpoints) even if totals moved. The last
+    range is open-ended
+    """
+    split = max(1, settings["shard_split"])
+    plan_path = output_dirs(settings)["checkpoints"] / "shard_plan.json"
+    saved = load_checkpoint(plan_path)
+    ranges = saved.get("ranges", {}) if saved.get("split") == split else {}
+
+    shards = []
+    for company_id in settings["companies"]:
+        for doc_type in settings["doc_types"]:
+            folder = shard_folder(settings, company_id, doc_type)
+            base = {"companyId": company_id, "docType": doc_type, "folder": folder}
+            if split == 1:
+                shards.append({**base, "name": folder, "start": 0, "end": None})
+                continue
+
+            key = f"{company_id}/{doc_type}"
+            if key not in ranges:
+                params = {"companyId": company_id, "indexes": company_id, "docType": doc_type, "withFileContent": False}
+                _, total, _, _ = fetch_page(
+                    ctx["url"], params, ctx["auth"], 0, 1, page=0,
+                    rate_limiter=ctx["rate_limiter"], session=ctx["session"], min_limit=1,
+                    budget=ctx["budget"], telemetry=ctx["telemetry"]
+                )
+                size = max(1, -(-total // split))
+                ranges[key] = [[i * size, (i + 1) * size] for i in range(split) if i * size < total] or [[0, 0]]
+                ranges[key][-1][1] = None
+                print(f"[shards] {key}: {total} docs -> {len(ranges[key])} ranges of {size}")
+            for start, end in ranges[key]:
+                shards.append({**base, "name": f"{folder}_{start:07d}", "start": start, "end": end})
+
+    if split > 1:
+        save_checkpoint(plan_path, {"split": split, "ranges": ranges})
+    return shards
+
+
+def run_shard(shard: dict, settings: dict, ctx: dict) -> str:
+    """
+    Lists, downloads and exports one shard (a companyId/docType pair, or an
+    offset range of one) with its own checkpoint, items file and metrics.
+    With settings["retry_failed"] it only re-downloads the documents the
+    journal holds as failed for the shard, without listing.
+    Returns "ok", "empty", "deferred", "fetch_failed" or "download_failed"
+    """
+    dirs = output_dirs(settings)
+    doc_type = shard["docType"]
+    company_id = shard["companyId"]
+    name = shard["name"]
+    ranged = shard["start"] > 0 or shard["end"] is not None
+    session = ctx["session"]
+    rate_limiter = ctx["rate_limiter"]
+    manifest = ctx["manifest"]
+    journal = ctx["journal"]
+    scheduler = ctx["scheduler"]
+    telemetry = ctx["telemetry"]
+    pipeline = settings["pipeline"]
+    json_compression = settings["json_compression"]
+
+    print(f"\n{'='*60}")
+    print(f"Downloading ALL {company_id}/{doc_type} documents to {shard['folder']}/" + (f" (shard {name})" if ranged else ""))
+    print(f"{'='*60}\n")
+
+    metrics = {
+        "docType": doc_type,
+        "companyId": company_id,
+        "shard": name,
+        "offsetStart": shard["start"],
+        "offsetEnd": shard["end"],
+        "outputFolder": shard["folder"],
+        "startTime": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "minIntervalSec": rate_limiter.min_interval_sec,
+        "adaptiveRate": settings["adaptive_rate"],
+        "maxRetries": settings["max_retries"],
+        "limit": settings["limit"],
+        "downloadWorkers": settings["download_workers"],
+        "pageWorkers": settings["page_workers"],
+        "poolSize": settings["pool_size"],
+        "shardProcesses": settings["shard_processes"],
+        "streamDownload": settings["stream_download"],
+        "docsLayout": settings["docs_layout"],
+        "syncMode": settings["sync_mode"],
+        "retryFailed": settings["retry_failed"],
+        "downloadOrder": settings["download_order"],
+        "deadline": datetime.fromtimestamp(settings["deadline"]).isoformat(timespec="minutes") if settings["deadline"] else None,
+        "pipeline": pipeline,
+        "maxResponseMb": settings["max_response_mb"],
+        "maxRunMb": settings["max_run_mb"] or None,
+        "maxRssMb": settings["max_rss_mb"] or None
+    }
+    conn_baseline = connection_stats(session)
+
+    items_path = dirs["items"] / f"{name}_items.jsonl"
+    checkpoint_path = dirs["checkpoints"] / f"{name}_checkpoint.json"
+    metrics_path = dirs["metrics"] / f"{name}_metrics.json"
+    sync_state_path = dirs["checkpoints"] / f"{name}_sync.json"
+    deletions_path = dirs["checkpoints"] / f"{name}_deleted.jsonl"
+    docs_dir = dirs["docs"] if settings["content_addressed"] or settings["packed"] else dirs["docs"] / shard["folder"]
+    telemetry.track(name, metrics, metrics_path)
+    profiler = ShardProfiler(memory=settings["profile_memory"], cpu=settings["profile_cpu"])
+    profiler.start()
+
+    def finish(status: str) -> str:
+        deferred = scheduler.report(metrics, dirs["checkpoints"] / f"{name}_deferred.jsonl")
+        if deferred:
+            print(f"[schedule] {len(deferred)} documents deferred, listed in {name}_deferred.jsonl")
+        profiler.stop(metrics, dirs["metrics"] / f"{name}.prof")
+        update_metrics(metrics, {"journal": journal.counts(name)})
+        if ctx["timeouts"] is not None:
+            update_metrics(metrics, ctx["timeouts"].snapshot())
+        finish_metrics(metrics_path, metrics, session, conn_baseline, rate_limiter, telemetry)
+        return status
+
+    download_kwargs = {
+        "output_dir": str(docs_dir),
+        "auth": ctx["auth"],
+        "base_url": ctx["url"],
+        "max_retries": settings["max_retries"],
+        "timeout": settings["timeout"],
+        "rate_limiter": rate_limiter,
+        "metrics": metrics,
+        "workers": settings["download_workers"],
+        "session": session,
+        "stream": settings["stream_download"],
+        "manifest": manifest,
+        "content_addressed": settings["content_addressed"],
+        "docs_root": dirs["docs"],
+        "budget": ctx["budget"],
+        "telemetry": telemetry,
+        "company_id": company_id,
+        "journal": journal,
+        "store": ctx["store"],
+        "scheduler": scheduler,
+        "timeouts": ctx["timeouts"],
+    }
+
+    reason = scheduler.stop_reason()
+    if reason is not None:
+        print(f"[schedule] {'deadline passed' if reason == 'deadline' else 'byte budget spent'}, shard {name} deferred to the next run")
+        return finish("deferred")
+    if pipeline and settings["download_order"] != "api":
+        print(f"[schedule] order '{settings['download_order']}' needs the whole listing: pipelined downloads start after it")
+
+    if settings["retry_failed"]:
+        failed_docs = journal.failed_items(name)
+        update_metrics(metrics, {"retried": len(failed_docs)})
+        if not failed_docs:
+            print(f"[retry] No failed documents in {name}")
+            return finish("empty")
+        print(f"[retry] Re-downloading {len(failed_docs)} failed documents...")
+        downloads_ok = download_documents({"total": len(failed_docs), "items": failed_docs}, **download_kwargs)
+        return finish("ok" if downloads_ok else "download_failed")
+
+    params_base = {
+        "companyId": company_id,
+        "indexes": company_id,
+        "docType": doc_type,
+        "withFileContent": False,
+    }
+
+    sync_state = load_checkpoint(sync_state_path)
+    filtered = False
+    if settings["sync_mode"] == "delta":
+        if reset_completed_listing(checkpoint_path, items_path):
+            print("[delta] previous listing complete, starting a fresh one")
+        since_param = settings["since_param"]
+        # Offset ranges only line up on the same (unfiltered) listing
+        if since_param and sync_state.get("lastSyncAt") and not ranged:
+            params_base[since_param] = sync_state["lastSyncAt"]
+            filtered = True
+            print(f"[delta] server-side filter {since_param}={sync_state['lastSyncAt']}")
+
+    pages = fetch_all_documents(
+        ctx["url"],
+        params_base,
+        ctx["auth"],
+        limit=settings["limit"],
+        max_retries=settings["max_retries"],
+        rate_limiter=rate_limiter,
+        metrics=metrics,
+        checkpoint_path=checkpoint_path,
+        items_path=items_path,
+        session=session,
+        page_workers=settings["page_workers"],
+        min_limit=settings["min_limit"],
+        max_limit=settings["max_limit"],
+        target_latency_ms=settings["page_target_ms"],
+        budget=ctx["budget"],
+        telemetry=telemetry,
+        start_offset=shard["start"],
+        end_offset=shard["end"],
+        timeout=settings["timeout"],
+        timeouts=ctx["timeouts"],
+        summary=MetadataSummary.resume(dirs["summaries"] / f"{name}.json", items_path)
+    )
+    response_file = dirs["json"] / f"{name}_response.json{JSON_COMPRESSION_SUFFIX[json_compression]}"
+    sinks = [ResponseJSONWriter(
+        response_file,
+        compression=json_compression,
+        indent=settings["json_indent"],
+        replay=iter_jsonl_items(items_path),
+        start=shard["start"]
+    )]
+    if settings["parquet_enabled"]:
+        # A resumed listing replays the items already on disk so the file is complete
+        sinks.append(ParquetMetadataSink(
+            dirs["parquet"] / f"{name}_metadata.parquet",
+            manifest=manifest,
+            replay=iter_jsonl_items(items_path)
+        ))
+    sinks.append(JournalSink(journal, name, replay=iter_jsonl_items(items_path)))
+    pages = observe_pages(pages, *sinks)
+    tracker = ChangeTracker(manifest) if settings["sync_mode"] == "delta" else None
+
+    if pipeline:
+        print("[step 1+2] Fetching metadata and downloading file content (pipelined)...")
+        resumed = count_jsonl_lines(items_path)
+        downloads_ok, fetch_error = run_pipeline(
+            pages,
+            islice(iter_jsonl_items(items_path), resumed),
+            queue_size=settings["pipeline_queue"],
+            on_item=tracker.observe if tracker is not None else None,
+            total=int(load_checkpoint(checkpoint_path).get("total", 0)),
+            **download_kwargs
+        )
+        if fetch_error is not None:
+            print(f"FAIL: Could not fetch {doc_type} ({fetch_error})")
+            return finish("fetch_failed")
+    else:
+        print("[step 1] Fetching metadata for all documents (no fileContent)...")
+        try:
+            for _ in pages:
+                pass
+        except Unit4FetchError:
+            print(f"FAIL: Could not fetch {doc_type}")
+            return finish("fetch_failed")
+
+    collected = count_jsonl_lines(items_path)
+    if not collected:
+        print(f"No documents found for {doc_type}")
+        return finish("empty")
+
+    print(f"\n[info] Total {doc_type} documents collected: {collected}\n")
+
+    if tracker is not None:
+        if not pipeline:
+            for doc in iter_jsonl_items(items_path):
+                tracker.observe(doc)
+        changes = tracker.counts
+        deleted = []
+        if not filtered and not ranged:
+            deleted = report_deletions(manifest, tracker.seen, doc_type, company_id, deletions_path)
+        update_metrics(metrics, {
+            "docs_new": changes["new"],
+            "docs_changed": changes["changed"],
+            "docs_unchanged": changes["unchanged"],
+            "docs_deleted": len(deleted),
+        })
+        print(
+            f"[delta] new={changes['new']} changed={changes['changed']} "
+            f"unchanged={changes['unchanged']} deleted={len(deleted)}"
+            + (" (deletions not checked: filtered listing)" if filtered else "")
+            + (" (deletions not checked: offset shard)" if ranged else "")
+        )
+
+    if not pipeline:
+        print("[step 2] Downloading file content for each document...")
+        downloads_ok = download_documents(jsonl_envelope(items_path, collected), **download_kwargs)
+
+    if settings["parquet_enabled"] and manifest is not None:
+        # Written during enumeration, before this run's downloads filled in size / sha256
+        ParquetMetadataSink.rewrite(dirs["parquet"] / f"{name}_metadata.parquet", manifest, iter_jsonl_items(items_path))
+
+    if not downloads_ok:
+        print(f"FAIL: Could not download {doc_type}")
+        return finish("download_failed")
+
+    if tracker is not None:
+        save_checkpoint(sync_state_path, {
+            "lastSyncAt": max(filter(None, [tracker.max_updated_at, sync_state.get("lastSyncAt")]), default=None),
+            "lastRunAt": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "listed": collected,
+            "filtered": filtered,
+        })
+
+    print("[step 3] Extracting and saving metadata...")
+    metadata = extract_metadata(jsonl_envelope(items_path, collected))
+    metadata_file = str(dirs["csv"] / f"{name}_metadata.csv")
+    save_metadata_csv(metadata, metadata_file)
+
+    finish("ok")
+    print(f"[smoke] PASS - All {doc_type} documents saved to {shard['folder']}/\n")
+    return "ok"
+
+
+def run_shard_process(shard: dict, settings: dict) -> tuple[str, str]:
+    """
+    Process-pool entry point: runs one shard with its own session and
+    manifest handle, drawing from the shared rate budget; output goes to
+    logs/<shard>.log. Returns (shard name, status)
+    """
+    log_path = output_dirs(settings)["logs"] / f"{shard['name']}.log"
+    with open(log_path, "a", encoding="utf-8", buffering=1) as log:
+        sys.stdout = sys.stderr = log
+        ctx = open_run(settings, shard=shard)
+        try:
+            status = run_shard(shard, settings, ctx)
+        except Exception as e:
+            print(f"FAIL: shard {shard['name']} crashed ({e})")
+            status = "crashed"
+        finally:
+            close_run(ctx)
+            sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    return shard["name"], status
+
+
+def run_shard_pool(shards: list[dict], settings: dict) -> None:
+    """
+    Runs `shards` on UNIT4_SHARD_PROCESSES spawned processes and prints a
+    status line per shard as each one finishes
+    """
+    dirs = output_dirs(settings)
+    processes = min(settings["shard_processes"], len(shards))
+    print(f"[shards] {len(shards)} shards on {processes} processes (logs in {dirs['logs']}/)")
+    results: dict[str, str] = {}
+    pool_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=pool_context) as pool:
+        futures = {pool.submit(run_shard_process, shard, settings): shard["name"] for shard in shards}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                _, status = future.result()
+            except Exception as e:
+                print(f"  ✗ {name}: worker died ({e})")
+                status = "crashed"
+            results[name] = status
+            mark = "✓" if status in ("ok", "empty", "deferred") else "✗"
+            print(f"  {mark} {name}: {status} ({len(results)}/{len(shards)})")
+
+    failed = [name for name, status in results.items() if status not in ("ok", "empty", "deferred")]
+    print(f"\n[summary] {len(shards) - len(failed)}/{len(shards)} shards ok" + (f", failed: {', '.join(failed)}" if failed else ""))
+
+
+# -----------------------------
+# PRE-FLIGHT PLAN
+# -----------------------------
+def sample_content_bytes(
+    url: str,
+    params: dict,
+    auth: HTTPBasicAuth,
+    rate_limiter: RateLimiter,
+    session: requests.Session | None = None,
+    budget: MemoryBudget | None = None,
+    telemetry: Telemetry | None = None,
+    timeout: float = 180
+) -> tuple[int, int]:
+    """
+    Fetches one document with fileContent and counts the body without
+    keeping it. Returns (response bytes, latency ms).
+    Raises Unit4FetchError on a non-200 answer
+    """
+    budget = budget or MemoryBudget()
+    rate_limiter.wait()
+    response, latency_ms = make_request(
+        url, params, auth, timeout=timeout, session=session, stream=True, telemetry=telemetry, endpoint="content"
+    )
+    rate_limiter.observe(response.status_code, latency_ms)
+    try:
+        if response.status_code != 200:
+            raise Unit4FetchError(f"content sample answered {response.status_code}")
+        size = sum(len(chunk) for chunk in budget.iter_content(response))
+    finally:
+        response.close()
+    return size, latency_ms
+
+
+def plan_run(settings: dict, ctx: dict) -> dict:
+    """
+    Sizes a run before it starts: `total` of every (companyId, docType) from
+    a limit=1 listing, plus UNIT4_PLAN_SAMPLE documents at random offsets
+    fetched with content. Projects requests, bytes, peak memory and run time
+    under the configured interval, workers and page size, and compares them
+    with UNIT4_MAX_RUN_MB / UNIT4_MAX_RSS_MB / UNIT4_MAX_RUN_HOURS.
+    The plan lands in metrics/plan.json; plan["withinBudget"] says whether
+    the run may start
+    """
+    rng = random.Random()
+    # Samples are capped per response but not charged to the run's byte budget
+    budget = MemoryBudget(max_response_bytes=ctx["budget"].max_response_bytes)
+    page_kwargs = {
+        "rate_limiter": ctx["rate_limiter"], "session": ctx["session"], "min_limit": 1,
+        "budget": budget, "telemetry": ctx["telemetry"],
+    }
+    targets = []
+    item_bytes: list[int] = []
+    list_latencies: list[int] = []
+    content_bytes: list[int] = []
+    content_latencies: list[int] = []
+    for company_id in settings["companies"]:
+        for doc_type in settings["doc_types"]:
+            params = {"companyId": company_id, "indexes": company_id, "docType": doc_type, "withFileContent": False}
+            items, total, _, latency_ms = fetch_page(ctx["url"], params, ctx["auth"], 0, 1, page=0, **page_kwargs)
+            list_latencies.append(latency_ms)
+            item_bytes += [len(json.dumps(item, ensure_ascii=False)) for item in items]
+            targets.append({"companyId": company_id, "docType": doc_type, "total": total})
+            print(f"[plan] {company_id}/{doc_type}: {total} documents")
+            for offset in rng.sample(range(total), min(settings["plan_sample"], total)):
+                try:
+                    sampled, _, _, latency_ms = fetch_page(ctx["url"], params, ctx["auth"], offset, 1, page=0, **page_kwargs)
+                    list_latencies.append(latency_ms)
+                    if not sampled or not sampled[0].get("id"):
+                        continue
+                    size, latency_ms = sample_content_bytes(
+                        ctx["url"],
+                        {"companyId": company_id, "indexes": company_id, "id": sampled[0]["id"], "withFileContent": True},
+                        ctx["auth"], ctx["rate_limiter"], ctx["session"], budget, ctx["telemetry"]
+                    )
+                except (Unit4FetchError, BudgetExceeded, requests.exceptions.RequestException) as e:
+                    print(f"[plan] sample at offset {offset} failed ({e})")
+                    continue
+                content_bytes.append(size)
+                content_latencies.append(latency_ms)
+
+    docs = sum(t["total"] for t in targets)
+    limit = max(1, settings["limit"])
+    list_requests = sum(-(-t["total"] // limit) for t in targets)
+    mean_item = sum(item_bytes) / len(item_bytes) if item_bytes else 0
+    mean_content = sum(content_bytes) / len(content_bytes) if content_bytes else None
+    max_content = max(content_bytes, default=0)
+    mean_list_ms = sum(list_latencies) / len(list_latencies) if list_latencies else 0
+    mean_content_ms = sum(content_latencies) / len(content_latencies) if content_latencies else 0
+
+    # Bodies carry Base64 (4/3 of the file); an in-memory download holds the
+    # body, the Base64 string and the decoded bytes at once
+    received = docs * mean_item + (docs * mean_content if mean_content is not None else 0)
+    processes = max(1, settings["shard_processes"])
+    if settings["stream_download"]:
+        per_download = 2 * 256 * 1024
+    else:
+        per_download = min(max_content, settings["max_response_mb"] * 1024 * 1024) * (1 + 1 + 0.75)
+    per_process = (
+        settings["download_workers"] * per_download
+        + settings["page_workers"] * settings["max_limit"] * mean_item * 2
+    )
+    peak_mb = current_rss_mb() + per_process / (1024 * 1024)
+
+    requests_total = list_requests + docs
+    rate_bound = requests_total * settings["min_interval"]
+    latency_bound = (
+        list_requests * mean_list_ms / max(1, settings["page_workers"])
+        + docs * mean_content_ms / max(1, settings["download_workers"])
+    ) / 1000 / processes
+    seconds = max(rate_bound, latency_bound)
+
+    plan = {
+        "plannedAt": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "targets": targets,
+        "documents": docs,
+        "sampled": len(content_bytes),
+        "meanItemBytes": round(mean_item),
+        "meanContentBytes": round(mean_content) if mean_content is not None else None,
+        "maxContentBytes": max_content,
+        "listRequests": list_requests,
+        "contentRequests": docs,
+        "requestsTotal": requests_total,
+        "projectedReceivedMb": round(received / (1024 * 1024), 1),
+        "projectedDiskMb": round(docs * (mean_content or 0) * 0.75 / (1024 * 1024), 1),
+        "projectedPeakRssMbPerProcess": round(peak_mb, 1),
+        "projectedHours": round(seconds / 3600, 3),
+        "rateBoundHours": round(rate_bound / 3600, 3),
+        "latencyBoundHours": round(latency_bound / 3600, 3),
+        "minIntervalSec": settings["min_interval"],
+        "downloadWorkers": settings["download_workers"],
+        "pageWorkers": settings["page_workers"],
+        "shardProcesses": processes,
+        "limit": limit,
+        "streamDownload": settings["stream_download"],
+    }
+    over = []
+    if settings["max_run_mb"] and received / (1024 * 1024) > settings["max_run_mb"]:
+        over.append(f"received {plan['projectedReceivedMb']} MB > UNIT4_MAX_RUN_MB {settings['max_run_mb']}")
+    if settings["max_rss_mb"] and peak_mb > settings["max_rss_mb"]:
+        over.append(f"peak RSS {plan['projectedPeakRssMbPerProcess']} MB > UNIT4_MAX_RSS_MB {settings['max_rss_mb']}")
+    if settings["max_run_hours"] and seconds / 3600 > settings["max_run_hours"]:
+        over.append(f"run time {seconds / 60:.1f} min > UNIT4_MAX_RUN_HOURS {settings['max_run_hours']} h")
+    if mean_content is None and docs:
+        print("[plan] WARNING: no content sample succeeded, bytes and memory are unknown")
+    plan["overBudget"] = over
+    plan["withinBudget"] = not over
+
+    print(f"\n{'='*60}")
+    print(f"Plan: {docs} documents, {requests_total} requests ({list_requests} listing + {docs} content)")
+    print(f"  received     ~{plan['projectedReceivedMb']} MB (disk ~{plan['projectedDiskMb']} MB, "
+          f"mean doc {round((mean_content or 0) / 1024)} KB from {len(content_bytes)} samples)")
+    print(f"  peak RSS     ~{plan['projectedPeakRssMbPerProcess']} MB per process")
+    print(f"  run time     ~{seconds / 60:.1f} min (rate bound {rate_bound / 60:.1f} min, "
+          f"latency bound {latency_bound / 60:.1f} min)")
+    for reason in over:
+        print(f"  ✗ over budget: {reason}")
+    print(f"{'='*60}\n")
+    save_metrics(output_dirs(settings)["metrics"] / "plan.json", plan)
+    return plan
+
+
+# -----------------------------
+# MAIN
+# -----------------------------
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Unit4 REPINV / REPTEC document audit (configured via UNIT4_* env vars)")
+    parser.add_argument(
+        "--retry-failed", action="store_true",
+        help="only re-download the documents the journal holds as failed (no listing)"
+    )
+    parser.add_argument(
+        "--export-loose", metavar="DIR",
+        help="rebuild the by-name file layout under DIR from the packed segment store and exit"
+    )
+    parser.add_argument(
+        "--plan", action="store_true",
+        help="size the run first (totals + sampled content) and refuse to start when it exceeds the budgets"
+    )
+    parser.add_argument("--plan-only", action="store_true", help="print the plan and exit")
+    parser.add_argument(
+        "--verify", action="store_true",
+        help="re-hash the stored corpus against the manifest (size, sha256, magic bytes) and exit; 1 when bad"
+    )
+    parser.add_argument(
+        "--repair", action="store_true",
+        help="with --verify: quarantine bad documents and queue them in the journal for --retry-failed"
+    )
+    parser.add_argument(
+        "--report", nargs="?", const="", metavar="FILE",
+        help="merge the per-shard listing summaries, print the distributions and exit; "
+             "FILE (.json or .csv) also exports them"
+    )
+    args = parser.parse_args(argv)
+
+    settings = load_settings()
+    settings["retry_failed"] = args.retry_failed
+
+    if args.export_loose:
+        docs_root = output_dirs(settings)["docs"]
+        if not (docs_root / "segments" / "index.jsonl").exists():
+            print(f"No packed segment store under {docs_root}/segments")
+            return 2
+        store = SegmentStore(docs_root / "segments")
+        manifest = DocumentManifest(docs_root / "manifest.jsonl")
+        written = store.export(manifest, Path(args.export_loose))
+        manifest.close()
+        store.close()
+        print(f"✓ Exported {written} documents to {args.export_loose}/")
+        return 0
+
+    if args.report is not None:
+        # Only the current plan's shards: summaries left by an older split or
+        # company list cover the same documents again
+        summaries_root = output_dirs(settings)["summaries"]
+        summary_paths = [summaries_root / f"{name}.json" for name in planned_shard_names(settings)]
+        summary_paths = [p for p in summary_paths if p.exists()]
+        if not summary_paths:
+            print(f"No listing summaries under {output_dirs(settings)['summaries']}")
+            return 2
+        summary = merge_summaries(summary_paths)
+        print(f"[report] {len(summary_paths)} shard summaries")
+        print_summary_report(summary)
+        if args.report:
+            export_summary(summary, Path(args.report))
+            print(f"✓ Summary exported to {args.report}")
+        return 0
+
+    if args.repair and not args.verify:
+        print("--repair requiere --verify")
+        return 2
+
+    if args.verify:
+        dirs = output_dirs(settings)
+        if not (dirs["docs"] / "manifest.jsonl").exists():
+            print(f"No manifest under {dirs['docs']}")
+            return 2
+        dirs["metrics"].mkdir(parents=True, exist_ok=True)
+        dirs["checkpoints"].mkdir(parents=True, exist_ok=True)
+        split_ranges = load_checkpoint(dirs["checkpoints"] / "shard_plan.json").get("ranges", {})
+
+        def shard_of(entry: dict) -> str:
+            # Same naming as plan_shards; split shards queue under their first range
+            folder = shard_folder(settings, entry["companyId"], entry["docType"])
+            if settings["shard_split"] > 1 and f"{entry['companyId']}/{entry['docType']}" in split_ranges:
+                folder = f"{folder}_{0:07d}"
+            return folder
+
+        journal = DocumentJournal(dirs["checkpoints"] / "journal.sqlite") if args.repair else None
+        metrics = verify_corpus(
+            dirs["docs"], dirs["checkpoints"] / "verify_bad.jsonl", dirs["metrics"] / "verify_metrics.json",
+            workers=settings["verify_workers"], repair=args.repair, journal=journal, shard_of=shard_of
+        )
+        if journal is not None:
+            journal.close()
+        return 1 if metrics["bad"] and not args.repair else 0
+
+    if not settings["base"]:
+        print("Falta UNIT4_BASE")
+        return 2
+
+    if not settings["user"] or not settings["pwd"]:
+        print("Faltan UNIT4_USER / UNIT4_PASS")
+        return 2
+
+    if settings["download_order"] not in DownloadScheduler.ORDERS:
+        print(f"UNIT4_DOWNLOAD_ORDER inválido: {settings['download_order']} ({', '.join(DownloadScheduler.ORDERS)})")
+        return 2
+
+    try:
+        # Resolved once here so every shard process shares the same instant
+        settings["deadline"] = parse_deadline(settings["deadline"])
+    except ValueError:
+        print(f"UNIT4_DEADLINE inválido: {settings['deadline']} (HH:MM o fecha ISO)")
+        return 2
+
+    if settings["docs_layout"] not in ("name", "cas", "packed"):
+        print(f"UNIT4_DOCS_LAYOUT inválido: {settings['docs_layout']} (name, cas, packed)")
+        return 2
+
+    if settings["json_compression"] not in JSON_COMPRESSION_SUFFIX:
+        print(f"UNIT4_JSON_COMPRESSION inválido: {settings['json_compression']} (none, gzip, lzma)")
+        return 2
+
+    if settings["shard_processes"] > 1 and fcntl is None:
+        print("UNIT4_SHARD_PROCESSES > 1 requiere fcntl (Linux / macOS)")
+        return 2
+
+    dirs = output_dirs(settings)
+    for name, p in dirs.items():
+        if name not in ("parquet", "text"):
+            p.mkdir(parents=True, exist_ok=True)
+
+    if settings["parquet_enabled"] and pa is None:
+        print("[parquet] pyarrow not installed, UNIT4_PARQUET ignored")
+        settings["parquet_enabled"] = False
+    if settings["parquet_enabled"]:
+        dirs["parquet"].mkdir(parents=True, exist_ok=True)
+
+    ctx = open_run(settings, reset_rate_budget=True)
+    if args.plan or args.plan_only:
+        try:
+            plan = plan_run(settings, ctx)
+        except Unit4FetchError as e:
+            print(f"FAIL: could not plan the run ({e})")
+            close_run(ctx)
+            return 1
+        if args.plan_only or not plan["withinBudget"]:
+            close_run(ctx)
+            if not plan["withinBudget"]:
+                print("FAIL: projected run exceeds the configured budgets, not starting")
+                return 1
+            return 0
+
+    try:
+        shards = plan_shards(settings, ctx)
+    except Unit4FetchError as e:
+        print(f"FAIL: could not plan shards ({e})")
+        close_run(ctx)
+        return 1
+
+    if settings["shard_processes"] <= 1:
+        for shard in shards:
+            run_shard(shard, settings, ctx)
+        close_run(ctx)
+    else:
+        # The parent only plans (and compacts the manifest); shards run in the pool
+        close_run(ctx)
+        run_shard_pool(shards, settings)
+
+    summary_paths = [dirs["summaries"] / f"{shard['name']}.json" for shard in shards]
+    export_summary(merge_summaries(p for p in summary_paths if p.exists()), dirs["metrics"] / "summary.json")
+
+    if settings["extract_text"]:
+        run_text_extraction(
+            dirs["docs"], dirs["text"], dirs["metrics"] / "text_extraction_metrics.json", settings["extract_workers"]
+        )
     return 0
 
 
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark: runs the metadata listing (fetch_all_documents) and
+the content download (download_documents) against the local mock server
+for a set of scenarios, and reports docs/s, MB/s, request latency
+percentiles and peak RSS.
+
+Each scenario runs in a fresh subprocess so peak RSS is per scenario; the
+mock runs in this process. Results are saved under benchmarks/results/ and
+compared against the committed benchmarks/baseline.json (exit 1 on
+regression; exit 2 when there is no baseline or a scenario's parameters no
+longer match the ones it was recorded with):
+
+    python unit4_benchmark.py --update-baseline   # record a baseline
+    python unit4_benchmark.py                     # compare against it
+    python unit4_benchmark.py --scenario faults
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from unit4_mock_server import MockUnit4Server
+
+
+BENCH_DIR = Path(__file__).resolve().parent / "benchmarks"
+BASELINE_PATH = BENCH_DIR / "baseline.json"
+
+CLIENT_DEFAULTS = {
+    "doc_type": "REPINV",
+    "limit": 50,
+    "min_limit": 10,
+    "page_workers": 1,
+    "workers": 4,
+    "pool_size": 10,
+    "min_interval": 0.005,
+    "max_retries": 3,
+    "timeout": 30,
+    "stream": False,
+}
+
+SCENARIOS = {
+    "baseline": {
+        "mock": {"docs": 300, "doc_size": 64 * 1024},
+        "client": {},
+    },
+    "large_docs": {
+        "mock": {"docs": 30, "doc_size": 4 * 1024 * 1024, "doc_size_max": 12 * 1024 * 1024},
+        "client": {"stream": True},
+    },
+    "faults": {
+        "mock": {
+            "docs": 150,
+            "doc_size": 32 * 1024,
+            "rate_429": 0.03,
+            "retry_after": 1,
+            "rate_5xx": 0.03,
+            "rate_timeout": 0.01,
+            "hang_sec": 3.0,
+            "rate_slow": 0.05,
+            "slow_ms": 500,
+        },
+        "client": {"timeout": 2, "page_workers": 2},
+    },
+}
+
+# (metric, True if higher is better) — compared against the baseline
+COMPARED = [
+    ("docs_per_sec", True),
+    ("mb_per_sec", True),
+    ("p95_ms", False),
+    ("peak_rss_mb", False),
+]
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return float(ordered[index])
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+# -----------------------------
+# WORKER (runs in the subprocess)
+# -----------------------------
+def run_worker(config: dict) -> dict:
+    """
+    One listing + download pass with the client settings in `config`;
+    stdout from the audit code is discarded, only the result is returned
+    """
+    import unit4_audit as audit
+    from requests.auth import HTTPBasicAuth
+
+    client = config["client"]
+    latencies: dict[str, list[int]] = {"list": [], "content": []}
+    make_request = audit.make_request
+
+    def timed_request(url, params, *args, **kwargs):
+        response, latency_ms = make_request(url, params, *args, **kwargs)
+        latencies["content" if "id" in params else "list"].append(latency_ms)
+        return response, latency_ms
+
+    audit.make_request = timed_request
+
+    out = Path(config["out_dir"])
+    docs_dir = out / "docs"
+    docs_dir.mkdir(parents=True, exist_ok=True)
+    items_path = out / "items.jsonl"
+    auth = HTTPBasicAuth("bench", "bench")
+    session = audit.build_session(auth, pool_size=client["pool_size"])
+    rate_limiter = audit.RateLimiter(client["min_interval"])
+    metrics: dict = {}
+    params_base = {"companyId": "P2", "indexes": "P2", "docType": client["doc_type"]}
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        pages = audit.fetch_all_documents(
+            config["url"],
+            params_base,
+            auth,
+            limit=client["limit"],
+            max_retries=client["max_retries"],
+            rate_limiter=rate_limiter,
+            metrics=metrics,
+            items_path=items_path,
+            min_limit=client["min_limit"],
+            session=session,
+            page_workers=client["page_workers"],
+            timeout=client["timeout"],
+        )
+        listed = sum(len(items) for items in pages)
+        listed_at = time.perf_counter()
+
+        manifest = audit.DocumentManifest(docs_dir / "manifest.jsonl")
+        audit.download_documents(
+            audit.jsonl_envelope(items_path, listed),
+            output_dir=str(docs_dir),
+            auth=auth,
+            base_url=config["url"],
+            max_retries=client["max_retries"],
+            timeout=client["timeout"],
+            rate_limiter=rate_limiter,
+            metrics=metrics,
+            workers=client["workers"],
+            session=session,
+            stream=client["stream"],
+            manifest=manifest,
+            docs_root=docs_dir,
+        )
+        finished = time.perf_counter()
+        manifest.close()
+        session.close()
+
+    all_latencies = latencies["list"] + latencies["content"]
+    elapsed = finished - started
+    downloaded = metrics.get("files_downloaded", 0)
+    mb = metrics.get("bytes_downloaded", 0) / (1024 * 1024)
+    return {
+        "docs_listed": listed,
+        "docs_downloaded": downloaded,
+        "docs_failed": listed - downloaded - metrics.get("files_skipped", 0),
+        "mb_downloaded": round(mb, 2),
+        "list_sec": round(listed_at - started, 3),
+        "download_sec": round(finished - listed_at, 3),
+        "elapsed_sec": round(elapsed, 3),
+        "docs_per_sec": round(downloaded / elapsed, 2) if elapsed else 0.0,
+        "mb_per_sec": round(mb / elapsed, 2) if elapsed else 0.0,
+        "requests": len(all_latencies),
+        "p50_ms": percentile(all_latencies, 50),
+        "p95_ms": percentile(all_latencies, 95),
+        "p99_ms": percentile(all_latencies, 99),
+        "list_p95_ms": percentile(latencies["list"], 95),
+        "content_p95_ms": percentile(latencies["content"], 95),
+        "http_429": metrics.get("http_429", 0),
+        "http_5xx": metrics.get("http_5xx", 0),
+        "timeouts": metrics.get("timeouts", 0),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+# -----------------------------
+# DRIVER
+# -----------------------------
+def run_scenario(name: str, scenario: dict) -> dict:
+    """
+    Starts a mock for the scenario, runs the worker subprocess against it
+    and returns the worker result plus what the mock saw
+    """
+    client = {**CLIENT_DEFAULTS, **scenario["client"]}
+    mock_options = {"doc_types": [client["doc_type"]], **scenario["mock"]}
+    server = MockUnit4Server(mock_options).start()
+    try:
+        with tempfile.TemporaryDirectory(prefix=f"unit4-bench-{name}-") as out_dir:
+            config = {"url": server.url, "client": client, "out_dir": out_dir}
+            proc = subprocess.run(
+                [sys.executable, __file__, "--worker"],
+                input=json.dumps(config),
+                capture_output=True,
+                text=True,
+                cwd=Path(__file__).resolve().parent,
+            )
+    finally:
+        server.stop()
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"scenario {name} failed:\n{proc.stderr.strip()}")
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["mock"] = server.stats
+    result["params"] = {"mock": mock_options, "client": client}
+    return result
+
+
+def stale_scenarios(results: dict, baseline: dict) -> list[str]:
+    """
+    Scenarios the baseline has no comparable numbers for: missing, or recorded
+    with other mock / client parameters
+    """
+    stale = []
+    for name, result in results.items():
+        reference = baseline.get("scenarios", {}).get(name)
+        if not reference:
+            stale.append(f"{name}: not in the baseline")
+        elif reference.get("params") != result["params"]:
+            stale.append(f"{name}: parameters differ from the baseline's")
+    return stale
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Returns one line per metric that is worse than the baseline by more
+    than `tolerance` (relative)
+    """
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get("scenarios", {}).get(name)
+        if not reference:
+            continue
+        for metric, higher_is_better in COMPARED:
+            old, new = reference.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{name}.{metric}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+def print_table(results: dict, baseline: dict | None) -> None:
+    columns = ["docs_per_sec", "mb_per_sec", "p50_ms", "p95_ms", "p99_ms", "peak_rss_mb", "docs_failed"]
+    print(f"{'scenario':<12}" + "".join(f"{c:>14}" for c in columns))
+    for name, result in results.items():
+        print(f"{name:<12}" + "".join(f"{result.get(c, ''):>14}" for c in columns))
+        reference = (baseline or {}).get("scenarios", {}).get(name)
+        if reference:
+            print(f"{'  baseline':<12}" + "".join(f"{reference.get(c, ''):>14}" for c in columns))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Unit4 audit end-to-end benchmark against the local mock")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="run only these (repeatable)")
+    parser.add_argument("--update-baseline", action="store_true", help="store results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression (default 0.25)")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(json.load(sys.stdin))))
+        return 0
+
+    names = args.scenario or list(SCENARIOS)
+    results = {}
+    for name in names:
+        print(f"[bench] {name} ...", flush=True)
+        results[name] = run_scenario(name, SCENARIOS[name])
+
+    baseline = json.loads(BASELINE_PATH.read_text(encoding="utf-8")) if BASELINE_PATH.exists() else None
+    print_table(results, baseline)
+
+    report = {
+        "createdAt": datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "scenarios": results,
+    }
+    results_dir = BENCH_DIR / "results"
+    results_dir.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    (results_dir / f"{stamp}.json").write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+    if args.update_baseline:
+        merged = {**(baseline or {}), **report, "scenarios": {**(baseline or {}).get("scenarios", {}), **results}}
+        BASELINE_PATH.write_text(json.dumps(merged, indent=2), encoding="utf-8")
+        print(f"✓ Baseline updated: {BASELINE_PATH}")
+        return 0
+
+    if baseline is None:
+        print(f"✗ No baseline at {BASELINE_PATH} (record one with --update-baseline and commit it)")
+        return 2
+
+    stale = stale_scenarios(results, baseline)
+    for line in stale:
+        print(f"✗ Not comparable {line} (re-record with --update-baseline)")
+    if stale:
+        return 2
+
+    regressions = compare(results, baseline, args.tolerance)
+    for line in regressions:
+        print(f"✗ Regression {line}")
+    if not regressions:
+        print(f"✓ No regressions beyond {args.tolerance:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Unit4 BusinessWorld /documents endpoint.
+
+Serves a deterministic, synthetic document catalog with the same envelope as
+the real API ({start, limit, count, total, items[]}), Base64 `fileContent` of
+configurable size, and injectable faults (429 + Retry-After, 5xx, hung
+requests, slow responses). Used by unit4_benchmark.py, and handy for running
+unit4_audit.py without touching PROD:
+
+    python unit4_mock_server.py --port 8080 --docs 200 --doc-size 500000
+    UNIT4_BASE=http://127.0.0.1:8080 UNIT4_USER=x UNIT4_PASS=x python unit4_audit.py
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+from urllib.parse import parse_qs, urlparse
+
+
+MOCK_DEFAULTS = {
+    "doc_types": ["REPINV", "REPTEC"],
+    "company_id": "P2",
+    "docs": 100,                # documents per docType
+    "doc_size": 64 * 1024,      # decoded bytes per document (lower bound)
+    "doc_size_max": None,       # when set, sizes spread deterministically up to this
+    "latency_ms": 20,           # base latency added to every response
+    "jitter_ms": 10,
+    "max_limit": 1000,          # server-side cap on `limit`
+    "rate_429": 0.0,            # probability of a 429 per request
+    "retry_after": 1,           # Retry-After seconds sent with 429
+    "rate_5xx": 0.0,            # probability of a 503 per request
+    "rate_timeout": 0.0,        # probability of a hung request
+    "hang_sec": 5.0,            # how long a hung request stalls before closing
+    "rate_slow": 0.0,           # probability of a slow (but successful) response
+    "slow_ms": 2000,
+    "seed": 1234,
+    "name_pool": 0,             # when set, fileNames repeat every name_pool documents
+}
+
+MIME_TYPES = [
+    ("application/pdf", ".pdf", b"%PDF-1.4\n"),
+    ("application/vnd.openxmlformats-officedocument.wordprocessingml.document", ".docx", b"PK\x03\x04"),
+    ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", ".xlsx", b"PK\x03\x04"),
+    ("image/png", ".png", b"\x89PNG\r\n\x1a\n"),
+    ("text/plain", ".txt", b""),
+]
+
+# Raw bytes per Base64 chunk; a multiple of 3 so chunks encode independently
+CONTENT_CHUNK = 3 * 64 * 1024
+
+
+# -----------------------------
+# CATALOG
+# -----------------------------
+class MockCatalog:
+    """
+    Deterministic document catalog: the same options always produce the same
+    ids, metadata and content, so runs are comparable
+    """
+
+    def __init__(self, options: dict) -> None:
+        self.options = options
+        self.by_type: dict[str, list[dict]] = {}
+        self.by_id: dict[str, dict] = {}
+        for doc_type in options["doc_types"]:
+            docs = [self._document(doc_type, i) for i in range(options["docs"])]
+            self.by_type[doc_type] = docs
+            self.by_id.update((doc["id"], doc) for doc in docs)
+
+    def _document(self, doc_type: str, i: int) -> dict:
+        doc_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"unit4-mock/{doc_type}/{i}"))
+        mime_type, extension, _ = MIME_TYPES[i % len(MIME_TYPES)]
+        name_index = i % self.options["name_pool"] if self.options.get("name_pool") else i
+        return {
+            "companyId": self.options["company_id"],
+            "docType": doc_type,
+            "mimeType": mime_type,
+            "id": doc_id,
+            "status": "N",
+            "revisionNo": 1,
+            "fileName": f"{doc_type.lower()}_{name_index:06d}{extension}",
+            "checkoutUserId": "",
+            "lastUpdate": {
+                "updatedAt": f"2025-{1 + i % 12:02d}-{1 + i % 28:02d}T10:{i % 60:02d}:00.000",
+                "updatedBy": f"USER{i % 7}",
+            },
+            "indexes": [],
+            "title": f"Document {i}",
+            "description": "",
+            "expiryDate": None,
+        }
+
+    def size_of(self, doc: dict) -> int:
+        low = self.options["doc_size"]
+        high = self.options["doc_size_max"]
+        if not high or high <= low:
+            return low
+        spread = int(hashlib.sha256(doc["id"].encode()).hexdigest()[:8], 16)
+        return low + spread % (high - low + 1)
+
+    def content(self, doc: dict) -> Iterator[bytes]:
+        """
+        Yields the decoded document in CONTENT_CHUNK pieces: the magic bytes
+        for its mimeType followed by a filler seeded from the id
+        """
+        size = self.size_of(doc)
+        magic = next((m for t, _, m in MIME_TYPES if t == doc["mimeType"]), b"")
+        seed = hashlib.sha256(doc["id"].encode()).digest()
+        filler = (seed * (CONTENT_CHUNK // len(seed) + 1))[:CONTENT_CHUNK]
+        head = (magic + filler)[:min(size, CONTENT_CHUNK)]
+        yield head
+        remaining = size - len(head)
+        while remaining > 0:
+            piece = filler[:min(remaining, CONTENT_CHUNK)]
+            remaining -= len(piece)
+            yield piece
+
+    def encoded_length(self, doc: dict) -> int:
+        return 4 * ((self.size_of(doc) + 2) // 3)
+
+    def encoded(self, doc: dict) -> Iterator[bytes]:
+        """
+        Base64 of `content`, chunk by chunk (every chunk but the last is a
+        multiple of 3 bytes, so no re-buffering is needed)
+        """
+        for chunk in self.content(doc):
+            yield base64.b64encode(chunk)
+
+
+# -----------------------------
+# HTTP
+# -----------------------------
+class MockUnit4Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "MockUnit4Server"
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        parsed = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        server = self.server
+        server.count("requests")
+
+        fault = server.pick_fault()
+        if fault == "timeout":
+            server.count("injected_timeouts")
+            time.sleep(server.options["hang_sec"])
+            self.close_connection = True
+            return
+
+        time.sleep(server.delay_sec(slow=fault == "slow"))
+
+        if fault == "429":
+            server.count("injected_429")
+            self._send_empty(429, {"Retry-After": str(server.options["retry_after"])})
+            return
+        if fault == "5xx":
+            server.count("injected_5xx")
+            self._send_empty(503)
+            return
+
+        if not parsed.path.rstrip("/").endswith("/documents"):
+            self._send_empty(404)
+            return
+
+        with_content = query.get("withFileContent", "").lower() == "true"
+        if "id" in query:
+            doc = server.catalog.by_id.get(query["id"])
+            if doc is None:
+                self._send_empty(404)
+                return
+            self._send_envelope(0, 1, 1, [doc], with_content=with_content)
+            return
+
+        docs = server.catalog.by_type.get(query.get("docType", ""), [])
+        start = max(0, int(query.get("start", 0)))
+        limit = min(max(1, int(query.get("limit", 50))), server.options["max_limit"])
+        self._send_envelope(start, limit, len(docs), docs[start:start + limit], with_content=with_content)
+
+    def _send_empty(self, status: int, headers: dict | None = None) -> None:
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _send_envelope(self, start: int, limit: int, total: int, items: list[dict], with_content: bool) -> None:
+        """
+        Writes {start, limit, count, total, items[]} with each item's
+        fileContent streamed in chunks, so the mock stays cheap even for
+        large documents
+        """
+        catalog = self.server.catalog
+        head = json.dumps({"start": start, "limit": limit, "count": len(items), "total": total})
+        parts: list[bytes | dict] = [head[:-1].encode() + b', "items": [']
+        for n, doc in enumerate(items):
+            sep = b", " if n else b""
+            if with_content:
+                prefix = json.dumps(doc)[:-1] + f', "fileContent": "data:{doc["mimeType"]};base64,'
+                parts.append(sep + prefix.encode())
+                parts.append(doc)
+                parts.append(b'"}')
+            else:
+                parts.append(sep + json.dumps(doc).encode())
+        parts.append(b"]}")
+
+        length = sum(catalog.encoded_length(p) if isinstance(p, dict) else len(p) for p in parts)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+        try:
+            for part in parts:
+                if isinstance(part, dict):
+                    for chunk in catalog.encoded(part):
+                        self.wfile.write(chunk)
+                else:
+                    self.wfile.write(part)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+            return
+        self.server.count("bytes_sent", length)
+
+
+class MockUnit4Server(ThreadingHTTPServer):
+    """
+    Threaded mock server; start() serves from a background thread so it can
+    be embedded in a benchmark, stop() shuts it down
+    """
+
+    daemon_threads = True
+
+    def __init__(self, options: dict | None = None, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.options = {**MOCK_DEFAULTS, **(options or {})}
+        self.catalog = MockCatalog(self.options)
+        self._random = random.Random(self.options["seed"])
+        self._lock = threading.Lock()
+        self.stats: dict[str, int] = {}
+        self._thread: threading.Thread | None = None
+        super().__init__((host, port), MockUnit4Handler)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/documents"
+
+    def count(self, key: str, amount: int = 1) -> None:
+        with self._lock:
+            self.stats[key] = self.stats.get(key, 0) + amount
+
+    def pick_fault(self) -> str | None:
+        with self._lock:
+            roll = self._random.random()
+        for fault, key in (("429", "rate_429"), ("5xx", "rate_5xx"), ("timeout", "rate_timeout"), ("slow", "rate_slow")):
+            if roll < self.options[key]:
+                return fault
+            roll -= self.options[key]
+        return None
+
+    def delay_sec(self, slow: bool = False) -> float:
+        with self._lock:
+            jitter = self._random.uniform(0, self.options["jitter_ms"])
+        base = self.options["slow_ms"] if slow else self.options["latency_ms"]
+        return (base + jitter) / 1000
+
+    def handle_error(self, request, client_address) -> None:
+        # Clients hanging up mid-body (timeouts, budget aborts) are expected
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+    def start(self) -> "MockUnit4Server":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+# -----------------------------
+# MAIN
+# -----------------------------
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Local stand-in for the Unit4 /documents API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--doc-types", default=",".join(MOCK_DEFAULTS["doc_types"]))
+    parser.add_argument("--company-id", default=MOCK_DEFAULTS["company_id"])
+    for key, value in MOCK_DEFAULTS.items():
+        if key in ("doc_types", "company_id"):
+            continue
+        kind = float if isinstance(value, float) or key.startswith("rate_") else int
+        parser.add_argument(f"--{key.replace('_', '-')}", type=kind, default=value)
+    args = parser.parse_args()
+
+    options = {key: getattr(args, key) for key in MOCK_DEFAULTS}
+    options["doc_types"] = [t.strip() for t in args.doc_types.split(",") if t.strip()]
+    server = MockUnit4Server(options, host=args.host, port=args.port)
+    print(f"✓ Mock Unit4 API on {server.url} ({options['docs']} docs x {len(options['doc_types'])} docTypes)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Stats: {json.dumps(server.stats)}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())